@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2013  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for the hot paths of tcollector and the runner.
+
+Run all of them with ./benchmarks.py, or only some of them by name,
+e.g.: ./benchmarks.py reader_latency
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import re
+import resource
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+from Queue import Empty
+from Queue import Full
+from Queue import Queue
+
+import runner
+import tcollector
+from collectors.lib.backpressure import CollectorQueue
+from collectors.lib.backpressure import PressureQueue
+from collectors.lib import procfs
+from collectors.lib.batching import Batcher
+from collectors.lib.datapoint import parse_line
+from collectors.lib.httppool import HTTPConnectionPool
+from collectors.lib.httppool import unverified_ssl_context
+from collectors.lib.putjson import PutEncoder
+
+# the builtin collectors are loaded from their directory, like the runner does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'collectors', 'builtin'))
+import iostat
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """Registers a benchmark function."""
+    BENCHMARKS.append(func)
+    return func
+
+
+def report(name, **results):
+    print '%-30s %s' % (name, '  '.join('%s=%s' % (k, results[k])
+                                        for k in sorted(results)))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+LATENCY_COLLECTOR = r'''
+import random, sys, time
+time.sleep(1)  # let the benchmark spawn everybody else first
+end = time.time() + %(duration)f
+while time.time() < end:
+    time.sleep(random.uniform(0.05, 0.3))
+    now = time.time()
+    sys.stdout.write('bench.latency %%d %%.6f\n' %% (now, now))
+    sys.stdout.flush()
+'''
+
+
+def measure_reader_latency(poller, collectors=50, duration=5):
+    """Spawns collectors printing the time at which they wrote each line, and
+       returns the delays until the ReaderThread enqueued those lines."""
+
+    tcollector.COLLECTORS.clear()
+    tcollector.POLLER = poller
+    script = LATENCY_COLLECTOR % {'duration': duration}
+    for i in xrange(collectors):
+        col = tcollector.Collector('latency%d' % i, 0,
+                                   [sys.executable, '-c', script])
+        tcollector.register_collector(col)
+        tcollector.spawn_collector(col)
+    reader = tcollector.ReaderThread(0, 1, poller)
+    reader.start()
+
+    delays = []
+    end = time.time() + duration + 2
+    while time.time() < end:
+        try:
+            line = reader.readerq.get(True, 0.1)
+        except Empty:
+            continue
+        delays.append(time.time() - float(line.split()[2]))
+
+    tcollector.ALIVE = False
+    reader.join()
+    tcollector.ALIVE = True
+    for col in tcollector.all_living_collectors():
+        col.shutdown()
+    tcollector.COLLECTORS.clear()
+    tcollector.POLLER = None
+    return delays
+
+
+@benchmark
+def reader_latency():
+    """Per-line enqueue delay of the polling and the epoll ReaderThread."""
+    for mode in ('poll', 'epoll'):
+        poller = tcollector.CollectorPoller() if mode == 'epoll' else None
+        delays = measure_reader_latency(poller)
+        report('reader_latency.%s' % mode, lines=len(delays),
+               mean_ms='%.2f' % (1000 * sum(delays) / max(len(delays), 1)),
+               p50_ms='%.2f' % (1000 * percentile(delays, 50)),
+               p99_ms='%.2f' % (1000 * percentile(delays, 99)),
+               max_ms='%.2f' % (1000 * max(delays or [0])))
+        if poller is not None:
+            poller.close()
+
+
+def synthetic_lines(count):
+    return ['proc.stat.cpu %d %d type=user cpu=%d' % (1500000000 + i, i, i % 64)
+            for i in xrange(count)]
+
+
+def legacy_parse_line(line):
+    """The parsing ReaderThread.process_line used to do inline."""
+    parsed = re.match('^([-_./a-zA-Z0-9]+)\s+'
+                      '(\d+\.?\d+)\s+'
+                      '(\S+?)'
+                      '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$',
+                      line)
+    metric, timestamp, value, tags = parsed.groups()
+    timestamp = int(timestamp)
+    len(str(timestamp))
+    return metric, timestamp, value, tags
+
+
+def legacy_add_tags_to_line(line, tags):
+    """The formatting SenderThread.send_data used to do per line."""
+    for tag, value in tags:
+        if ' %s=' % tag not in line:
+            line += ' %s=%s' % (tag, value)
+    return line
+
+
+@benchmark
+def parse_lines(count=1000000):
+    """Parsing and re-formatting of a million synthetic lines."""
+    lines = synthetic_lines(count)
+    tags = [('host', 'foo')]
+    tag_strings = ['host=foo']
+
+    start = time.time()
+    for line in lines:
+        legacy_parse_line(line)
+    legacy_parse = time.time() - start
+    start = time.time()
+    for line in lines:
+        legacy_add_tags_to_line(line, tags)
+    legacy_format = time.time() - start
+
+    start = time.time()
+    for line in lines:
+        parse_line(line)
+    parse = time.time() - start
+    dps = [parse_line(line) for line in lines]
+    start = time.time()
+    for dp in dps:
+        dp.to_line(tag_strings)
+    format_ = time.time() - start
+
+    report('parse_lines.legacy', lines=count,
+           parse_lines_per_s=int(count / legacy_parse),
+           format_lines_per_s=int(count / legacy_format))
+    report('parse_lines.datapoint', lines=count,
+           parse_lines_per_s=int(count / parse),
+           format_lines_per_s=int(count / format_))
+
+
+class LegacyCollector(tcollector.Collector):
+    """A Collector reading lines the way Collector.read used to."""
+
+    def __init__(self, *args):
+        super(LegacyCollector, self).__init__(*args)
+        self.datalines = []
+
+    def read(self):
+        try:
+            self.buffer += self.proc.stdout.read()
+        except IOError:
+            pass
+        while self.buffer:
+            idx = self.buffer.find('\n')
+            if idx == -1:
+                break
+            line = self.buffer[0:idx].strip()
+            if line:
+                self.datalines.append(line)
+                self.last_datapoint = int(time.time())
+            self.buffer = self.buffer[idx+1:]
+
+    def collect(self):
+        while self.proc is not None:
+            self.read()
+            if not len(self.datalines):
+                return
+            while len(self.datalines):
+                yield self.datalines.pop(0)
+
+
+BURST_COLLECTOR = r'''
+import sys
+line = 'bench.burst 1500000000 12345 host=foo tag=%%s\n'
+sys.stdout.write(''.join(line %% (i %% 1000) for i in xrange(%(lines)d)))
+'''
+
+
+def measure_burst(cls, size):
+    """Feeds size bytes through a collector pipe, returns (lines, seconds)."""
+    script = BURST_COLLECTOR % {'lines': size / len('bench.burst 1500000000 '
+                                                   '12345 host=foo tag=500\n')}
+    col = cls('burst', 0, [sys.executable, '-c', script])
+    tcollector.spawn_collector(col)
+    lines = 0
+    start = time.time()
+    while True:
+        for line in col.collect():
+            lines += 1
+        if col.proc.poll() is not None:
+            for line in col.collect():
+                lines += 1
+            break
+    return lines, time.time() - start
+
+
+@benchmark
+def collector_burst(size=50 * 1024 * 1024):
+    """A 50 MB burst written at once into a collector pipe."""
+    for name, cls in (('legacy', LegacyCollector),
+                      ('split', tcollector.Collector)):
+        lines, elapsed = measure_burst(cls, size)
+        report('collector_burst.%s' % name, lines=lines,
+               seconds='%.2f' % elapsed,
+               mb_per_s='%.1f' % (size / elapsed / 1024 / 1024))
+
+
+@benchmark
+def dedup_footprint(series=200000):
+    """Memory held by the dedup cache of a high cardinality collector."""
+    lines = ['app.requests.latency 1500000000 %d host=foo endpoint=/api/%d '
+             'status=200 method=GET' % (i % 100, i) for i in xrange(series)]
+
+    # what Collector.values used to keep: (value, repeated, line, timestamp)
+    legacy = {}
+    start = time.time()
+    for line in lines:
+        metric, timestamp, value, tags = legacy_parse_line(line)
+        legacy[(metric, tags)] = (value, False, line, timestamp)
+    legacy_put = time.time() - start
+    size = sys.getsizeof(legacy)
+    for key, entry in legacy.iteritems():
+        size += sys.getsizeof(key) + sys.getsizeof(key[1])
+        size += sys.getsizeof(entry) + sys.getsizeof(entry[2])
+    report('dedup_footprint.legacy', series=series, kb=size / 1024,
+           puts_per_s=int(series / legacy_put))
+
+    cache = tcollector.DedupCache()
+    start = time.time()
+    for line in lines:
+        dp = parse_line(line)
+        cache.put((dp.metric, dp.tags), dp.value, dp.timestamp)
+    put = time.time() - start
+    start = time.time()
+    cache.evict(1500000000 + tcollector.EVICT_BUCKET_WIDTH)
+    report('dedup_footprint.cache', series=series,
+           kb=cache.footprint() / 1024, puts_per_s=int(series / put),
+           evict_ms='%.1f' % (1000 * (time.time() - start)))
+
+
+class PutHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """A stand-in for the /api/put endpoint of a TSD, counting the
+       connections and the bytes it gets."""
+
+    protocol_version = 'HTTP/1.1'
+    # answer in a single write like a TSD does, instead of a write per
+    # header line which delayed ACKs make very slow on a kept-alive
+    # connection
+    wbufsize = -1
+
+    def setup(self):
+        self.server.connections += 1
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        self.rfile.read(length)
+        self.server.bytes += (len(self.raw_requestline) + len(str(self.headers))
+                              + 2 + length)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class PutServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), PutHandler)
+        self.connections = 0
+        self.bytes = 0
+
+    def handle_error(self, request, client_address):
+        # clients hanging up on TLS connections without a close_notify
+        pass
+
+
+def start_put_server(certfile=None):
+    server = PutServer()
+    if certfile is not None:
+        server.socket = ssl.wrap_socket(server.socket, certfile=certfile,
+                                        server_side=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def put_payloads(batches, points):
+    """JSON bodies like the ones SenderThread.send_data_via_http sends."""
+    return [json.dumps([{'metric': 'proc.stat.cpu', 'timestamp': 1500000000 + i,
+                         'value': float(i * points + j),
+                         'tags': {'host': 'foo', 'type': 'user', 'cpu': str(j % 64)}}
+                        for j in xrange(points)])
+            for i in xrange(batches)]
+
+
+def self_signed_cert(directory):
+    """Writes a throwaway certificate and its key to a PEM file."""
+    path = os.path.join(directory, 'bench.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-nodes', '-newkey',
+                           'rsa:2048', '-days', '1', '-subj', '/CN=127.0.0.1',
+                           '-keyout', path, '-out', path],
+                          stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    return path
+
+
+@benchmark
+def http_put(batches=500, points=500):
+    """Batches POSTed to a local /api/put stand-in, with urllib2 and with
+       the keep-alive connection pool, over HTTP and HTTPS."""
+    payloads = put_payloads(batches, points)
+    headers = {'Content-Type': 'application/json'}
+    tmpdir = tempfile.mkdtemp()
+    try:
+        certfile = self_signed_cert(tmpdir)
+        for use_ssl in (False, True):
+            measure_http_put(payloads, headers, use_ssl and certfile)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def measure_http_put(payloads, headers, certfile):
+    protocol = 'https' if certfile else 'http'
+    context = unverified_ssl_context()
+
+    def send_urllib2(server, payload):
+        # what the senders used to do for every batch
+        url = '%s://127.0.0.1:%d/api/put?details' % (protocol,
+                                                     server.server_port)
+        urllib2.urlopen(urllib2.Request(url, payload, headers),
+                        context=context).read()
+
+    pools = []
+    def send_pool(compression):
+        pool = HTTPConnectionPool(bool(certfile), compression=compression,
+                                  ssl_context=context)
+        pools.append(pool)
+        def send(server, payload):
+            pool.post('127.0.0.1', server.server_port, '/api/put?details',
+                      payload, headers)
+        return send
+
+    points = sum(payload.count('"metric"') for payload in payloads)
+    for name, send in (('urllib2', send_urllib2),
+                       ('pool', send_pool('none')),
+                       ('pool_gzip', send_pool('gzip')),
+                       ('pool_deflate', send_pool('deflate'))):
+        server = start_put_server(certfile or None)
+        start = time.time()
+        for payload in payloads:
+            send(server, payload)
+        elapsed = time.time() - start
+        for pool in pools:
+            pool.close()
+        server.shutdown()
+        report('http_put.%s.%s' % (protocol, name), batches=len(payloads),
+               points_per_s=int(points / elapsed),
+               wire_kb=server.bytes / 1024, connections=server.connections)
+
+
+def legacy_process(line, tags, maxtags=8):
+    """The dict runner.Sender.process used to build for every line."""
+    parts = line.split(None, 3)
+    if len(parts) == 4:
+        (metric, timestamp, value, raw_tags) = parts
+    else:
+        (metric, timestamp, value) = parts
+        raw_tags = ""
+    metric_tags = {}
+    for tag in raw_tags.strip().split():
+        (tag_key, tag_value) = tag.split("=", 1)
+        metric_tags[tag_key] = tag_value
+    metric_entry = {}
+    metric_entry["metric"] = metric
+    metric_entry["timestamp"] = long(timestamp)
+    try:
+        metric_entry["value"] = long(value)
+    except:
+        metric_entry["value"] = float(value)
+    metric_entry["tags"] = dict(tags).copy()
+    metric_entry["tags"].update(metric_tags)
+    return metric_entry
+
+
+def peak_rss_growth(func):
+    """Runs func in a child process, returns (the growth of its peak RSS
+       in KB, how long func took)."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, '%d %f' % (after - before, elapsed))
+        os._exit(0)
+    os.close(write_fd)
+    result = os.read(read_fd, 100)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    growth, elapsed = result.split()
+    return int(growth), float(elapsed)
+
+
+@benchmark
+def put_payload(points=100000):
+    """Encoding a 100k point batch into an /api/put payload."""
+    lines = ['proc.stat.cpu %d %d type=user cpu=%d' % (1500000000 + i, i, i % 64)
+             for i in xrange(points)]
+    tags = {'host': 'foo', 'cluster': 'bar'}
+    token = 'abcdef0123456789'
+    encoder = PutEncoder(tags)
+
+    def legacy():
+        metrics = [legacy_process(line, tags) for line in lines]
+        json.dumps({'token': token, 'metrics': metrics})
+
+    def streaming():
+        encoder.encode_lines(lines, '{"token":%s,"metrics":[' % json.dumps(token),
+                             ']}')
+
+    for name, func in (('legacy', legacy), ('streaming', streaming)):
+        growth, elapsed = peak_rss_growth(func)
+        report('put_payload.%s' % name, points=points,
+               points_per_s=int(points / elapsed), peak_rss_growth_kb=growth)
+
+
+class LegacyReadQueue(Queue):
+    """The readq of the runner before nput_many and get_many."""
+
+    def nput(self, value):
+        try:
+            self.put(value, False)
+        except Full:
+            return False
+        return True
+
+
+def drain_readq(readq, total):
+    """Batches total lines off readq the way the runner's Sender does."""
+    batcher = Batcher(runner.MAX_SENDQ_SIZE, 5000, 1000)
+    done = 0
+    while done < total:
+        lines = []
+        batcher.fill(readq, lines, 5)
+        done += len(lines)
+
+
+@benchmark
+def readq_batch(collectors=20, points=500, cycles=50):
+    """Collectors of the runner queueing hundreds of points per collection
+       while the sender drains them, one line at a time and in bulk."""
+    lines = ['proc.stat.cpu %d %d type=user cpu=%d' % (1500000000, i, i)
+             for i in xrange(points)]
+    total = collectors * points * cycles
+
+    def per_line(readq):
+        for _ in xrange(cycles):
+            for line in lines:
+                readq.nput(line)
+
+    def batched(readq):
+        for _ in xrange(cycles):
+            readq.nput_many(lines)
+
+    def collector_queue(readq, i):
+        return CollectorQueue(readq, 'collector%d' % i)
+
+    for name, readq, handle, collect in (
+            ('per_line', LegacyReadQueue(), lambda readq, i: readq, per_line),
+            ('batched', PressureQueue(0), collector_queue, batched)):
+        threads = [threading.Thread(target=collect, args=(handle(readq, i),))
+                   for i in xrange(collectors)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        drain_readq(readq, total)
+        elapsed = time.time() - start
+        for thread in threads:
+            thread.join()
+        report('readq_batch.%s' % name, points=total,
+               points_per_s=int(total / elapsed), seconds=round(elapsed, 2))
+
+
+class DiskstatsSnapshot(object):
+    """The /proc/uptime and /proc/diskstats of a tick, made up."""
+
+    def __init__(self, uptime, diskstats):
+        self._uptime = procfs.Uptime(uptime, 0.0)
+        self._diskstats = procfs.parse_diskstats(diskstats)
+
+    def uptime(self):
+        return self._uptime
+
+    def diskstats(self):
+        return self._diskstats
+
+
+def synthetic_diskstats(devices, step):
+    """A /proc/diskstats of NVMe namespaces with the discard and flush
+       fields of the later kernels, every counter step times bigger."""
+    return ''.join(' 259 %7d nvme%dn1 %s\n'
+                   % (i, i, ' '.join(str(step * (i + j + 1)) for j in xrange(17)))
+                   for i in xrange(devices))
+
+
+@benchmark
+def iostat_collect(devices=200, collections=2):
+    """Collections of the iostat collector over a 200 device diskstats."""
+    sys_block = tempfile.mkdtemp()
+    saved = iostat.SYS_BLOCK, procfs.snapshot
+    try:
+        for i in xrange(devices):
+            os.mkdir(os.path.join(sys_block, 'nvme%dn1' % i))
+        iostat.SYS_BLOCK = sys_block
+        collector = iostat.Iostat(None, None, tcollector.ReaderQueue(1000000))
+        elapsed = []
+        for n in xrange(collections):
+            snap = DiskstatsSnapshot(100.0 + 10 * n,
+                                     synthetic_diskstats(devices, n + 1))
+            procfs.snapshot = lambda tick=None: snap
+            collector.set_tick(1500000000 + 10 * n)
+            start = time.time()
+            collector()
+            elapsed.append(time.time() - start)
+        points = len(collector._readq.get_many(1000000))
+    finally:
+        iostat.SYS_BLOCK, procfs.snapshot = saved
+        shutil.rmtree(sys_block)
+    report('iostat_collect', devices=devices, points=points,
+           first_ms='%.2f' % (1000 * elapsed[0]),
+           next_ms='%.2f' % (1000 * sum(elapsed[1:]) / max(len(elapsed) - 1, 1)))
+
+
+def main(argv):
+    tcollector.setup_logging()
+    tcollector.LOG.setLevel(tcollector.logging.WARNING)
+    wanted = set(argv[1:])
+    for func in BENCHMARKS:
+        if not wanted or func.__name__ in wanted:
+            func()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.realpath(sys.argv[0])))
+    sys.exit(main(sys.argv))
@@ -14,13 +14,12 @@
 #
 """Cloudwiz Client stats for TSDB"""
 
-import subprocess
 import time
 import re
-import os
 import ast
 from Queue import Queue
 
+from collectors.lib import procfs
 from collectors.lib.collectorbase import CollectorBase
 
 collector_pid_file = '/opt/cloudwiz-agent/altenv/var/run/collector.pid'
@@ -46,6 +45,8 @@ class Cloudwiz(CollectorBase):
 
     def get_pids(self):
         self.metrics = {}
+        # one walk of /proc per tick, shared with the other collectors, rather than a pgrep per process
+        processes = procfs.snapshot(self._tick).processes()
 
         if len(self.process):
             for proc in self.process:
@@ -54,7 +55,7 @@ class Cloudwiz(CollectorBase):
                     continue
                 name = arr[0]
                 cmd = arr[1]
-                pid = self.get_pid_from_pgrep(cmd)
+                pid = self.get_pid(processes, cmd)
                 if pid != 0:
                     self.metrics["cloudwiz."+name] = pid
                 else:
@@ -75,70 +76,49 @@ class Cloudwiz(CollectorBase):
                 self.cpu_utime.pop(pid)
                 break
 
-    def get_pid_from_pgrep(self, cmd):
-        proc = subprocess.Popen(['/usr/bin/pgrep', '-f', str(cmd)], stdout=subprocess.PIPE)
-        line = proc.stdout.readline()
-        if line == '':
+    def get_pid(self, processes, cmd):
+        """ the lowest pid whose command line matches the regular expression cmd, like pgrep -f, or 0 """
+        try:
+            pattern = re.compile(str(cmd))
+        except re.error as e:
+            self.log_error("invalid process pattern %s: %s" % (cmd, e))
             return 0
-        else:
-            return int(line)
+        pids = [proc.pid for proc in processes if pattern.search(proc.cmdline)]
+        return min(pids) if pids else 0
 
     def collect_memory(self, metric, pid, ts_curr):
-        last = None
-        proc = subprocess.Popen(['/usr/bin/pmap', '-x', str(pid)], stdout=subprocess.PIPE)
-        while True:
-            line = proc.stdout.readline()
-            if line == '':
-                break
-            last = line
-        if last != None:
-            arr = last.split()
-            self._readq.nput("%s.memory.total %s %s" % (metric, ts_curr, arr[2]))
-            self._readq.nput("%s.memory.rss %s %s" % (metric, ts_curr, arr[3]))
-            self._readq.nput("%s.memory.dirty %s %s" % (metric, ts_curr, arr[4]))
-
-    def get_cpu_total(self):
-        total = 0
-        try:
-            f = open(os.path.join('/', 'proc', 'stat'), 'r')
-            for line in f:
-                if line.startswith('cpu '):
-                    tokens = line.split()
-                    for i in range(1, len(tokens)-1):
-                        total += int(tokens[i])
-            f.close()
-        except Exception as e:
-            self.log_error("Can't read /proc/stat: " + str(e))
-        return total
-
-    def get_cpu_stime(self, pid):
-        stime = 0
-        try:
-            f = open(os.path.join('/', 'proc', str(pid), 'stat'), 'r')
-            line = f.readline()
-            tokens = line.split()
-            stime = int(tokens[14]) + int(tokens[16])
-            f.close()
-        except Exception as e:
-            self.log_error("Can't read /proc/"+str(pid)+"/stat")
-        return stime
+        # in kB, like the total line of pmap -x
+        snap = procfs.snapshot(self._tick)
+        stat = snap.pid_stat(pid)
+        dirty = snap.pid_dirty(pid)
+        if stat is None or dirty is None:
+            self.log_error("Can't get memory stat for pid " + str(pid))
+            return
+        self._readq.nput("%s.memory.total %s %s" % (metric, ts_curr, stat.vsize / 1024))
+        self._readq.nput("%s.memory.rss %s %s" % (metric, ts_curr, stat.rss * procfs.PAGE_SIZE / 1024))
+        self._readq.nput("%s.memory.dirty %s %s" % (metric, ts_curr, dirty))
+
+    def get_cpu_total(self, snap):
+        stat = snap.stat()
+        if stat is None:
+            self.log_error("Can't read /proc/stat")
+            return 0
+        # all but guest_nice, like always
+        return sum(stat.cpu[:-1])
 
-    def get_cpu_utime(self, pid):
-        utime = 0
-        try:
-            f = open(os.path.join('/', 'proc', str(pid), 'stat'), 'r')
-            line = f.readline()
-            tokens = line.split()
-            utime = int(tokens[13]) + int(tokens[15])
-            f.close()
-        except Exception as e:
+    def get_cpu_times(self, snap, pid):
+        """ returns the (stime, utime) of a process, their children's included """
+        stat = snap.pid_stat(pid)
+        if stat is None:
             self.log_error("Can't read /proc/"+str(pid)+"/stat")
-        return utime
+            return 0, 0
+        return stat.stime + stat.cstime, stat.utime + stat.cutime
 
     def collect_cpu(self, metric, pid, ts_curr):
-        total = self.get_cpu_total()
-        stime = self.get_cpu_stime(pid)
-        utime = self.get_cpu_utime(pid)
+        # /proc/stat and the stat file of the process are read once per tick
+        snap = procfs.snapshot(self._tick)
+        total = self.get_cpu_total(snap)
+        stime, utime = self.get_cpu_times(snap, pid)
 
         if str(pid) in self.cpu_total:
             sys = 100 * (stime - int(self.cpu_stime[str(pid)])) / (total - int(self.cpu_total[str(pid)]))
@@ -153,18 +133,12 @@ class Cloudwiz(CollectorBase):
     #def collect_net(self, metric, pid, ts_curr):
 
     def collect_io(self, metric, pid, ts_curr):
-        try:
-            f = open(os.path.join('/', 'proc', str(pid), 'io'), 'r')
-            for line in f:
-                if line.startswith('read_bytes: '):
-                    token = line.split()
-                    self._readq.nput("%s.io.read %s %s" % (metric, ts_curr, token[1]))
-                elif line.startswith('write_bytes: '):
-                    token = line.split()
-                    self._readq.nput("%s.io.write %s %s" % (metric, ts_curr, token[1]))
-            f.close()
-        except Exception as e:
+        io = procfs.snapshot(self._tick).pid_io(pid)
+        if io is None or 'read_bytes' not in io:
             self.log_error("Can't get io stat for pid " + str(pid))
+            return
+        self._readq.nput("%s.io.read %s %s" % (metric, ts_curr, io['read_bytes']))
+        self._readq.nput("%s.io.write %s %s" % (metric, ts_curr, io['write_bytes']))
 
     def collect_one_metric(self, metric, pid, ts_curr):
         # collect CPU usage
@@ -14,7 +14,6 @@
 #
 """network interface stats for TSDB"""
 
-import time
 import re
 
 from collectors.lib import utils
@@ -55,7 +54,8 @@ class Ifstat(CollectorBase):
             # you bond.  By skipping bond we avoid double counting.
 
             self.f_netdev.seek(0)
-            ts = int(time.time())
+            ts = self.timestamp()
+            counters = []
             for line in self.f_netdev:
                 m = re.match("\s+(eth?\d+|em\d+_\d+/\d+|em\d+_\d+|em\d+|"
                              "p\d+p\d+_\d+/\d+|p\d+p\d+_\d+|p\d+p\d+):(.*)", line)
@@ -69,7 +69,8 @@ class Ifstat(CollectorBase):
                         return "out"
                     return "in"
                 for i in xrange(16):
-                    self._readq.nput("proc.net.%s.%s %d %s iface=%s" % (FIELDS[i], direction(i), ts, stats[i], intf))
+                    counters.append(("proc.net.%s.%s" % (FIELDS[i], direction(i)), stats[i], "iface=%s" % intf))
+            self.emit_counters(ts, counters)
 
     def cleanup(self):
         self.safe_close(self.f_netdev)
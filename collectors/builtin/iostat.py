@@ -24,7 +24,8 @@
 # particular operation), so let's just let TSD do the rate
 # calculation for us.
 #
-# /proc/diskstats has 11 stats for a given device
+# /proc/diskstats has 11 stats for a given device, 15 since 4.18 and 17
+# since 5.5 (discards, then flushes, see FIELDS_DISK below)
 # these are all rate counters except ios_in_progress
 # .read_requests       Number of reads completed
 # .read_merged         Number of reads merged
@@ -57,6 +58,12 @@
 # partition series.  To fix this, we output by-disk data to iostat.disk.*
 # and by-partition data to iostat.part.*.
 
+# For the whole disks, which we tell from the partitions by /sys/block
+# once per device, we also calculate the iostat -x stats since the previous
+# collection: requests and kB per second, average request size and queue
+# length, await, svctm and util, from the counters of every disk we keep
+# in arrays from one collection to the next.
+
 # TODO: Add additional tags to map partitions/disks back to mount
 # points/swap so you can (for example) plot just swap partition
 # activity or /var/lib/mysql partition activity no matter which
@@ -65,12 +72,13 @@
 # swap partitions from /proc/swaps, etc.
 
 
-import time
 import os
-import re
-import copy
+from array import array
+
+from collectors.lib import procfs
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib.rates import wrapped
 
 # Docs come from the Linux kernel's Documentation/iostats.txt
 FIELDS_DISK = (
@@ -85,7 +93,16 @@ FIELDS_DISK = (
     "ios_in_progress",  # Number of actual I/O requests currently in flight.
     "msec_total",  # Amount of time during which ios_in_progress >= 1.
     "msec_weighted_total",  # Measure of recent I/O completion time and backlog.
+    # Linux 4.18 and later
+    "discard_requests",  # Total number of discards completed successfully.
+    "discard_merged",  # Adjacent discard requests merged in a single req.
+    "discard_sectors",  # Total number of sectors discarded successfully.
+    "msec_discard",  # Total number of ms spent by all discards.
+    # Linux 5.5 and later
+    "flush_requests",  # Total number of flush requests completed successfully.
+    "msec_flush",  # Total number of ms spent by all flush requests.
 )
+IN_PROGRESS = FIELDS_DISK.index("ios_in_progress")
 
 FIELDS_PART = (
     "read_issued",
@@ -94,21 +111,14 @@ FIELDS_PART = (
     "write_sectors",
 )
 
-prev_times = (0, 0)
-
+# The fields of a full line we keep from one collection to the next for
+# the iostat -x style stats, by their index in FIELDS_DISK.
+RD_IOS, RD_SEC, RD_TICKS, WR_IOS, WR_SEC, WR_TICKS, TOT_TICKS, RQ_TICKS = \
+    0, 2, 3, 4, 6, 7, 9, 10
+EXTENDED = (RD_IOS, RD_SEC, RD_TICKS, WR_IOS, WR_SEC, WR_TICKS, TOT_TICKS, RQ_TICKS)
 
-def read_uptime():
-    global prev_times, f_uptime
-    try:
-        f_uptime = open("/proc/uptime")
-        line = f_uptime.readline()
-
-        curr_times = line.split(None)
-        delta_times = (float(curr_times[0]) - float(prev_times[0]), float(curr_times[1]) - float(prev_times[1]))
-        prev_times = curr_times
-        return delta_times
-    finally:
-        f_uptime.close()
+SYS_BLOCK = "/sys/block"
+DISK, PART = "iostat.disk.", "iostat.part."
 
 
 def get_system_hz():
@@ -121,117 +131,166 @@ def get_system_hz():
         return ticks
 
 
-def is_device(device_name, allow_virtual):
-    """Test whether given name is a device or a partition, using sysfs."""
-    device_name = re.sub('/', '!', device_name)
-
-    if allow_virtual:
-        devicename = "/sys/block/" + device_name + "/device"
-    else:
-        devicename = "/sys/block/" + device_name
-
-    return os.access(devicename, os.F_OK)
+def classify(major, minor, device):
+    """
+    Whether a device is a whole disk or a partition: whole disks are in
+    /sys/block, including NVMe namespaces and mmc cards whose minors don't
+    come by 16.  Without sysfs, we go by the minor like we used to.
+    """
+    if os.path.isdir(SYS_BLOCK):
+        if os.path.exists(os.path.join(SYS_BLOCK, device.replace('/', '!'))):
+            return DISK
+        return PART
+    if minor % 16 == 0 and major > 1:
+        return DISK
+    return PART
+
+
+class DeviceTable(object):
+    """
+    The previous counters of the devices, kept from one collection to the
+    next as one array('d') column per field of EXTENDED, at the index of the
+    device, along with what the device is.
+    """
+
+    def __init__(self):
+        self.index = {}  # (major, minor, device) -> index in the columns
+        self.kinds = []  # DISK or PART, by index
+        self.columns = tuple(array('d') for _ in EXTENDED)
+        self.seen = array('b')  # whether the columns hold a sample yet
+
+    def lookup(self, major, minor, device):
+        """Returns the index of a device, classifying it the first time."""
+        key = (major, minor, device)
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.kinds)
+            self.kinds.append(classify(major, minor, device))
+            for column in self.columns:
+                column.append(0)
+            self.seen.append(0)
+        return i
+
+    def forget(self, keep):
+        """Forgets about the devices not in keep, e.g. unplugged ones."""
+        kept = sorted((i, key) for key, i in self.index.iteritems() if key in keep)
+        self.index = dict((key, new) for new, (_, key) in enumerate(kept))
+        self.kinds = [self.kinds[i] for i, _ in kept]
+        self.columns = tuple(array('d', [column[i] for i, _ in kept])
+                             for column in self.columns)
+        self.seen = array('b', [self.seen[i] for i, _ in kept])
 
 
 # noinspection SpellCheckingInspection
 class Iostat(CollectorBase):
     def __init__(self, config, logger, readq):
         super(Iostat, self).__init__(config, logger, readq)
-        self.f_diskstats = open("/proc/diskstats")
         self.hz = get_system_hz()
+        self.devices = DeviceTable()
+        self.prev_uptime = None
+        # what the deltas of a device are computed into, reused every time
+        self.deltas = array('d', [0] * len(EXTENDED))
 
     def __call__(self):
-        init_stats = {
-            "read_requests": 0,
-            "read_merged": 0,
-            "read_sectors": 0,
-            "msec_read": 0,
-            "write_requests": 0,
-            "write_merged": 0,
-            "write_sectors": 0,
-            "msec_write": 0,
-            "ios_in_progress": 0,
-            "msec_total": 0,
-            "msec_weighted_total": 0,
-        }
-        prev_stats = dict()
-        with utils.lower_privileges(self._logger):
-            self.f_diskstats.seek(0)
-            ts = int(time.time())
-            itv = read_uptime()[0]
-            for line in self.f_diskstats:
-                # maj, min, devicename, [list of stats, see above]
-                values = line.split(None)
+        with utils.lower_privileges(self._logger), self.batch():
+            # /proc/uptime and /proc/diskstats are read once per tick for all the collectors
+            snap = procfs.snapshot(self._tick)
+            ts = self.timestamp()
+            uptime = snap.uptime()
+            if uptime is None:
+                raise IOError("cannot read /proc/uptime")
+            itv = uptime.total - self.prev_uptime if self.prev_uptime is not None else 0
+            self.prev_uptime = uptime.total
+            disks = snap.diskstats()
+            if disks is None:
+                raise IOError("cannot read /proc/diskstats")
+
+            devices = self.devices
+            if len(devices.index) > len(disks):
+                devices.forget(set((disk.major, disk.minor, disk.device) for disk in disks))
+            counters = []
+            for major, minor, device, stats in disks:
                 # shortcut the deduper and just skip disks that
                 # haven't done a single read.  This eliminates a bunch
                 # of loopback, ramdisk, and cdrom devices but still
                 # lets us report on the rare case that we actually use
                 # a ramdisk.
-                if values[3] == "0":
+                if stats[0] == 0:
                     continue
 
-                if int(values[1]) % 16 == 0 and int(values[0]) > 1:
-                    metric = "iostat.disk."
-                else:
-                    metric = "iostat.part."
-
-                device = values[2]
-                if len(values) == 14:
-                    # full stats line
-                    for i in range(11):
-                        self._readq.nput("%s%s %d %s dev=%s" % (metric, FIELDS_DISK[i], ts, values[i + 3], device))
-
-                    ret = is_device(device, 0)
-                    # if a device or a partition, calculate the svctm/await/util
-                    if ret:
-                        stats = dict(zip(FIELDS_DISK, values[3:]))
-                        if device not in prev_stats:
-                            prev_stats[device] = init_stats
-                        rd_ios = float(stats.get("read_requests"))
-                        wr_ios = float(stats.get("write_requests"))
-                        nr_ios = rd_ios + wr_ios
-                        prev_rd_ios = float(prev_stats[device].get("read_requests"))
-                        prev_wr_ios = float(prev_stats[device].get("write_requests"))
-                        prev_nr_ios = prev_rd_ios + prev_wr_ios
-                        tput = ((nr_ios - prev_nr_ios) * float(self.hz) / float(itv))
-                        util = ((float(stats.get("msec_total")) - float(prev_stats[device].get("msec_total"))) * float(self.hz) / float(itv))
-                        svctm = 0.0
-                        await = 0.0
-                        r_await = 0.0
-                        w_await = 0.0
-
-                        if tput:
-                            svctm = util / tput
-
-                        rd_ticks = stats.get("msec_read")
-                        wr_ticks = stats.get("msec_write")
-                        prev_rd_ticks = prev_stats[device].get("msec_read")
-                        prev_wr_ticks = prev_stats[device].get("msec_write")
-                        if rd_ios != prev_rd_ios:
-                            r_await = (float(rd_ticks) - float(prev_rd_ticks)) / float(rd_ios - prev_rd_ios)
-                        if wr_ios != prev_wr_ios:
-                            w_await = (float(wr_ticks) - float(prev_wr_ticks)) / float(wr_ios - prev_wr_ios)
-                        if nr_ios != prev_nr_ios:
-                            await = (float(rd_ticks) + float(wr_ticks) - float(prev_rd_ticks) - float(prev_wr_ticks)) / float(nr_ios - prev_nr_ios)
-                        self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "svctm", ts, svctm, device))
-                        self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "r_await", ts, r_await, device))
-                        self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "w_await", ts, w_await, device))
-                        self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "await", ts, await, device))
-                        # can't work for our
-                        #self._readq.nput("%s%s %d %.2f dev=%s" % (metric, "util", ts, float(util / 1000.0), device))
-
-                        prev_stats[device] = copy.deepcopy(stats)
-
-                elif len(values) == 7:
+                i = devices.lookup(major, minor, device)
+                metric = devices.kinds[i]
+                tags = "dev=%s" % device
+                if len(stats) >= 11:
+                    # full stats line, with the discard and flush stats of the later kernels
+                    for field, value in zip(FIELDS_DISK, stats):
+                        if field != "ios_in_progress":
+                            counters.append((metric + field, value, tags))
+                    self._readq.nput("%s%s %d %s %s" % (metric, "ios_in_progress", ts, stats[IN_PROGRESS], tags))
+
+                    # for the whole devices, calculate the iostat -x stats
+                    if metric == DISK:
+                        self.extended(i, stats, itv, ts, tags)
+
+                elif len(stats) == 4:
                     # partial stats line
-                    for i in range(4):
-                        self._readq.nput("%s%s %d %s dev=%s" % (metric, FIELDS_PART[i], ts, values[i + 3], device))
+                    for field, value in zip(FIELDS_PART, stats):
+                        counters.append((metric + field, value, tags))
                 else:
-                    self.log_error("Cannot parse /proc/diskstats line: %s", line)
+                    self.log_error("Cannot parse /proc/diskstats line: %s %s %s %s", major, minor, device, stats)
                     continue
-
-    def cleanup(self):
-        self.safe_close(self.f_diskstats)
+            self.emit_counters(ts, counters)
+
+    def extended(self, i, stats, itv, ts, tags):
+        """
+        the iostat -x stats of a device since the previous collection: the requests and kB per second, the
+        average request size and queue length, the waits and service time in ms, and the utilization in %
+        """
+        columns, deltas = self.devices.columns, self.deltas
+        complete = True
+        for j, field in enumerate(EXTENDED):
+            value = stats[field]
+            prev = columns[j][i]
+            columns[j][i] = value
+            if value >= prev:
+                deltas[j] = value - prev
+            else:
+                delta = wrapped(prev, value)
+                if delta is None:  # the device was reset
+                    complete = False
+                deltas[j] = delta or 0
+        seen = self.devices.seen[i]
+        self.devices.seen[i] = 1
+        if not seen or not complete or itv <= 0:
+            return
+
+        rd_ios, rd_sec, rd_ticks, wr_ios, wr_sec, wr_ticks, tot_ticks, rq_ticks = deltas
+        nr_ios = rd_ios + wr_ios
+        svctm = await = r_await = w_await = avgrq_sz = 0.0
+        if nr_ios:
+            svctm = tot_ticks / nr_ios
+            await = (rd_ticks + wr_ticks) / nr_ios
+            avgrq_sz = (rd_sec + wr_sec) / nr_ios
+        if rd_ios:
+            r_await = rd_ticks / rd_ios
+        if wr_ios:
+            w_await = wr_ticks / wr_ios
+        # the busy time of the devices with several hardware queues, like NVMe ones, may add up to more than that
+        util = min(tot_ticks / itv / 10.0, 100.0)
+        lines = []
+        for name, value in (("reads_per_sec", rd_ios / itv),
+                            ("writes_per_sec", wr_ios / itv),
+                            ("read_kbytes_per_sec", rd_sec / 2.0 / itv),
+                            ("write_kbytes_per_sec", wr_sec / 2.0 / itv),
+                            ("avgrq_sz", avgrq_sz),
+                            ("avgqu_sz", rq_ticks / itv / 1000.0),
+                            ("svctm", svctm),
+                            ("r_await", r_await),
+                            ("w_await", w_await),
+                            ("await", await),
+                            ("util", util)):
+            lines.append("%s%s %d %.2f %s" % (DISK, name, ts, value, tags))
+        self._readq.nput_many(lines)
 
 if __name__ == "__main__":
     from Queue import Queue
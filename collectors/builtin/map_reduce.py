@@ -2,6 +2,7 @@ import time
 import requests
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib.httpengine import get_engine
 
 # reference by https://hadoop.apache.org/docs/r2.7.2/hadoop-mapreduce-client/hadoop-mapreduce-client-core/MapredAppMasterRest.html
 REST_API = {"YARN_APPS_PATH": "ws/v1/cluster/apps",
@@ -148,9 +149,10 @@ class MapReduce(CollectorBase):
         '''
         try:
             running_jobs = {}
-            for app_id, (app_name, tracking_url) in running_apps.iteritems():
-                ts = time.time()
-                metrics_json = self.request_url("%s%s" % (tracking_url,REST_API['MAPREDUCE_JOBS_PATH']))
+            apps = running_apps.values()
+            responses = self.request_urls(["%s%s" % (tracking_url, REST_API['MAPREDUCE_JOBS_PATH']) for _, tracking_url in apps])
+            ts = time.time()
+            for (app_name, tracking_url), metrics_json in zip(apps, responses):
                 if metrics_json.get('jobs'):
                     if metrics_json['jobs'].get('job'):
                         for job_json in metrics_json['jobs']['job']:
@@ -179,11 +181,12 @@ class MapReduce(CollectorBase):
         Get custom metrics specified for each counter
         '''
         try:
-            for job_id, job_metrics in running_jobs.iteritems():
-                ts = time.time()
+            jobs = [job_metrics for job_metrics in running_jobs.itervalues() if job_metrics['job_name']]
+            responses = self.request_urls(["%s%s" % (job_metrics['tracking_url'], '/counters') for job_metrics in jobs])
+            ts = time.time()
+            for job_metrics, metrics_json in zip(jobs, responses):
                 job_name = job_metrics['job_name']
                 if job_name:
-                    metrics_json = self.request_url("%s%s" % (job_metrics['tracking_url'],'/counters'))
                     if metrics_json.get('jobCounters'):
                         if metrics_json['jobCounters'].get('counterGroup'):
                             for counter_group in metrics_json['jobCounters']['counterGroup']:
@@ -205,9 +208,10 @@ class MapReduce(CollectorBase):
             Return a dictionary of {task_id: 'tracking_url'} for each MapReduce task
             '''
             try:
-                for job_id, job_stats in running_jobs.iteritems():
-                    ts = time.time()
-                    metrics_json = self.request_url("%s%s" % (job_stats['tracking_url'],'/tasks'))
+                jobs = running_jobs.values()
+                responses = self.request_urls(["%s%s" % (job_stats['tracking_url'], '/tasks') for job_stats in jobs])
+                ts = time.time()
+                for job_stats, metrics_json in zip(jobs, responses):
                     if metrics_json.get('tasks'):
                         if metrics_json['tasks'].get('task'):
                             for task in metrics_json['tasks']['task']:
@@ -231,14 +235,15 @@ class MapReduce(CollectorBase):
 
             return resp.json()
 
-    def request_url(self, url):
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            if resp.status_code > 500:
-                self.log_exception("mapreduce collector can not access url : %s" % url)
-            raise HTTPError(url)
-
-        return resp.json()
+    def request_urls(self, urls):
+        """ get the json of many urls at once, the requests run concurrently on the shared http engine """
+        responses = get_engine().get_json(urls)
+        for url, resp in zip(urls, responses):
+            if isinstance(resp, Exception):
+                if resp.status is None or resp.status > 500:
+                    self.log_error("mapreduce collector can not access url %s: %s" % (url, resp))
+                raise HTTPError(url)
+        return responses
 
 
 class HTTPError(RuntimeError):
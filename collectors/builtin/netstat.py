@@ -249,13 +249,6 @@ class Netstat(CollectorBase):
         if value is not None:
             self._readq.nput("net.sockstat.%s %d %s%s" % (metric, ts, value, tags))
 
-    def print_netstat(self, statstype, metric, ts, value, tags=""):
-        if tags:
-            space = " "
-        else:
-            tags = space = ""
-        self._readq.nput("net.stat.%s.%s %d %s%s%s" % (statstype, metric, ts, value, space, tags))
-
     def parse_stats(self, stats_str, filename, ts):
         statsdikt = {}
         # /proc/net/{netstat,snmp} have a retarded column-oriented format.  It
@@ -282,6 +275,7 @@ class Netstat(CollectorBase):
             data.pop(0)
             stats = dict(zip(header, data))
             statsdikt.setdefault(known_statstypes[statstype], {}).update(stats)
+        counters = []
         for statstype, stats in statsdikt.iteritems():
             # Undo the kernel's double counting
             if "ListenDrops" in stats:
@@ -291,7 +285,8 @@ class Netstat(CollectorBase):
             for stat, (metric, tags) in known_stats[statstype].iteritems():
                 value = stats.get(stat)
                 if value is not None:
-                    self.print_netstat(statstype, metric, ts, value, tags)
+                    counters.append(("net.stat.%s.%s" % (statstype, metric), value, tags or ""))
+        self.emit_counters(ts, counters)
 
     def cleanup(self):
         self.safe_close(self.sockstat)
@@ -299,37 +294,39 @@ class Netstat(CollectorBase):
         self.safe_close(self.snmp)
 
     def __call__(self):
-        ts = int(time.time())
-        self.sockstat.seek(0)
-        self.netstat.seek(0)
-        self.snmp.seek(0)
-        data = self.sockstat.read()
-        netstats = self.netstat.read()
-        snmpstats = self.snmp.read()
-        m = re.match(self.regexp, data)
-        if not m:
-            self.log_error("Cannot parse sockstat: %r", data)
-            raise
+        # all the lines of a collection are queued at once
+        with self.batch():
+            ts = int(time.time())
+            self.sockstat.seek(0)
+            self.netstat.seek(0)
+            self.snmp.seek(0)
+            data = self.sockstat.read()
+            netstats = self.netstat.read()
+            snmpstats = self.snmp.read()
+            m = re.match(self.regexp, data)
+            if not m:
+                self.log_error("Cannot parse sockstat: %r", data)
+                raise
 
-        # The difference between the first two values is the number of
-        # sockets allocated vs the number of sockets actually in use.
-        self.print_sockstat("num_sockets", ts, m.group("tcp_sockets"), " type=tcp")
-        self.print_sockstat("num_timewait", ts, m.group("tw_count"))
-        self.print_sockstat("sockets_inuse", ts, m.group("tcp_inuse"), " type=tcp")
-        self.print_sockstat("sockets_inuse", ts, m.group("udp_inuse"), " type=udp")
-        self.print_sockstat("sockets_inuse", ts, m.group("udplite_inuse"), " type=udplite")
-        self.print_sockstat("sockets_inuse", ts, m.group("raw_inuse"), " type=raw")
+            # The difference between the first two values is the number of
+            # sockets allocated vs the number of sockets actually in use.
+            self.print_sockstat("num_sockets", ts, m.group("tcp_sockets"), " type=tcp")
+            self.print_sockstat("num_timewait", ts, m.group("tw_count"))
+            self.print_sockstat("sockets_inuse", ts, m.group("tcp_inuse"), " type=tcp")
+            self.print_sockstat("sockets_inuse", ts, m.group("udp_inuse"), " type=udp")
+            self.print_sockstat("sockets_inuse", ts, m.group("udplite_inuse"), " type=udplite")
+            self.print_sockstat("sockets_inuse", ts, m.group("raw_inuse"), " type=raw")
 
-        self.print_sockstat("num_orphans", ts, m.group("orphans"))
-        self.print_sockstat("memory", ts, int(m.group("tcp_pages")) * self.page_size, " type=tcp")
-        if m.group("udp_pages") is not None:
-            self.print_sockstat("memory", ts, int(m.group("udp_pages")) * self.page_size, " type=udp")
-        self.print_sockstat("memory", ts, m.group("ip_frag_mem"), " type=ipfrag")
-        self.print_sockstat("ipfragqueues", ts, m.group("ip_frag_nqueues"))
+            self.print_sockstat("num_orphans", ts, m.group("orphans"))
+            self.print_sockstat("memory", ts, int(m.group("tcp_pages")) * self.page_size, " type=tcp")
+            if m.group("udp_pages") is not None:
+                self.print_sockstat("memory", ts, int(m.group("udp_pages")) * self.page_size, " type=udp")
+            self.print_sockstat("memory", ts, m.group("ip_frag_mem"), " type=ipfrag")
+            self.print_sockstat("ipfragqueues", ts, m.group("ip_frag_nqueues"))
 
-        self.parse_stats(netstats, self.netstat.name, ts)
-        self.parse_stats(snmpstats, self.snmp.name, ts)
-        self._readq.nput("netstat.state %s %s" % (int(time.time()), '0'))
+            self.parse_stats(netstats, self.netstat.name, ts)
+            self.parse_stats(snmpstats, self.snmp.name, ts)
+            self._readq.nput("netstat.state %s %s" % (int(time.time()), '0'))
 
 
 if __name__ == "__main__":
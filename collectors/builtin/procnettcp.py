@@ -14,7 +14,8 @@
 
 """TCP socket state data for TSDB"""
 #
-# Read /proc/net/tcp, which gives netstat -a type
+# Dump the TCP sockets through netlink (sock_diag) like ss does, or read
+# /proc/net/tcp where we can't, which gives netstat -a type
 # data for all TCP sockets.
 
 # Note this collector generates a lot of lines, given that there are
@@ -50,8 +51,10 @@
 
 import os
 import pwd
+import socket
 import time
 
+from collectors.lib import sockdiag
 from collectors.lib import utils
 from Queue import Queue
 from collectors.lib.collectorbase import CollectorBase
@@ -121,6 +124,37 @@ TCPSTATES = {
     }
 
 
+# The indexes of the counters of a run, in integer-keyed arrays rather
+# than by "state=... service=..." strings: state x service x endpoint x user.
+STATE_NAMES = [None] * (sockdiag.TCP_CLOSING + 1)
+for state, name in TCPSTATES.iteritems():
+    STATE_NAMES[int(state, 16)] = name
+SERVICE_NAMES = SERVICES + ("other",)
+SERVICE_INDEX = dict((port, SERVICE_NAMES.index(name))
+                     for port, name in PORTS.iteritems())
+OTHER_SERVICE = len(SERVICES)
+INTERNAL, EXTERNAL = 0, 1
+ENDPOINTS = 2
+
+
+def is_public_prefix(byte1, byte2):
+    """
+    Whether the first two bytes of an IPv4 address
+    are public IP space (i.e. not RFC1918, loopback, or broadcast).
+    """
+    if byte1 in (10, 0, 127):
+        return False
+    if byte1 == 172 and byte2 > 16:
+        return False
+    if byte1 == 192 and byte2 == 168:
+        return False
+    return True
+
+# by the first two bytes of the address
+PUBLIC_PREFIXES = bytearray(is_public_prefix(prefix >> 8, prefix & 0xFF)
+                            for prefix in xrange(1 << 16))
+
+
 def is_public_ip(ipstr):
     """
     Take a /proc/net/tcp encoded src or dest string
@@ -131,15 +165,16 @@ def is_public_ip(ipstr):
     """
     addr = ipstr.split(":")[0]
     addr = int(addr, 16)
-    byte1 = addr & 0xFF
-    byte2 = (addr >> 8) & 0xFF
-    if byte1 in (10, 0, 127):
-        return False
-    if byte1 == 172 and byte2 > 16:
-        return False
-    if byte1 == 192 and byte2 == 168:
-        return False
-    return True
+    return is_public_prefix(addr & 0xFF, (addr >> 8) & 0xFF)
+
+
+def is_public_addr(addr):
+    """
+    Same as is_public_ip for the address of a sock_diag dump, in network
+    order.  Like in /proc/net/tcp6, the IPv6 addresses are judged by their
+    last 4 bytes, where IPv4-mapped addresses have the IPv4 one.
+    """
+    return PUBLIC_PREFIXES[ord(addr[-4]) << 8 | ord(addr[-3])]
 
 
 class Procnettcp(CollectorBase):
@@ -150,14 +185,28 @@ class Procnettcp(CollectorBase):
         except OSError:
             self.log_exception("warning: failed to self-renice:")
 
-        # resolve the list of users to match on into UIDs
+        # resolve the list of users to match on into UIDs, and those into
+        # the index of the user in the counters
         self.uids = {}
-        for user in USERS:
+        for index, user in enumerate(USERS):
             try:
-                self.uids[str(pwd.getpwnam(user)[2])] = user
+                self.uids[pwd.getpwnam(user)[2]] = index
             except KeyError:
                 continue
+        self.user_names = USERS + ("other",)
 
+        self.tcp = self.tcp6 = None
+        self.diag = None
+        # netlink (sock_diag) unless it's unavailable, or procfs
+        if self.get_config("backend", "netlink") == "netlink":
+            try:
+                self.diag = sockdiag.SockDiag()
+            except socket.error as e:
+                self.log_info("no netlink sock_diag (%s), reading /proc/net/tcp", e)
+        if self.diag is None:
+            self.open_procfiles()
+
+    def open_procfiles(self):
         try:
             self.tcp = open("/proc/net/tcp")
             # if IPv6 is enabled, even IPv4 connections will also
@@ -177,61 +226,93 @@ class Procnettcp(CollectorBase):
             raise
 
     def cleanup(self):
+        if self.diag is not None:
+            self.diag.close()
         self.safe_close(self.tcp)
         self.safe_close(self.tcp6)
 
     def __call__(self):
         with utils.lower_privileges(self._logger):
-            counter = {}
-
-            for procfile in (self.tcp, self.tcp6):
-                if procfile is None:
-                    continue
-                procfile.seek(0)
-                ts = int(time.time())
-                for line in procfile:
-                    try:
-                        # pylint: disable=W0612
-                        (num, src, dst, state, queue, when, retrans,
-                         uid, timeout, inode) = line.split(None, 9)
-                    except ValueError:  # Malformed line
-                        continue
-
-                    if num == "sl":  # header
-                        continue
-
-                    srcport = src.split(":")[1]
-                    dstport = dst.split(":")[1]
-                    srcport = int(srcport, 16)
-                    dstport = int(dstport, 16)
-                    service = PORTS.get(srcport, "other")
-                    service = PORTS.get(dstport, service)
-
-                    if is_public_ip(dst) or is_public_ip(src):
-                        endpoint = "external"
-                    else:
-                        endpoint = "internal"
-
-                    user = self.uids.get(uid, "other")
-
-                    key = "state=" + TCPSTATES[state] + " endpoint=" + endpoint + \
-                          " service=" + service + " user=" + user
-                    if key in counter:
-                        counter[key] += 1
-                    else:
-                        counter[key] = 1
-
-            # output the counters
+            counter = [0] * (len(STATE_NAMES) * len(SERVICE_NAMES) * ENDPOINTS * len(self.user_names))
+
+            ts = int(time.time())
+            if self.diag is not None:
+                try:
+                    self.count_netlink(counter)
+                except (socket.error, sockdiag.SockDiagError) as e:
+                    self.log_error("netlink sock_diag failed (%s), reading /proc/net/tcp from now on", e)
+                    self.diag.close()
+                    self.diag = None
+                    self.open_procfiles()
+                    counter = [0] * len(counter)
+            if self.diag is None:
+                self.count_procfs(counter)
+
+            # output the counters, of every endpoint and user
+            per_state = len(SERVICE_NAMES) * ENDPOINTS * len(self.user_names)
+            per_service = ENDPOINTS * len(self.user_names)
             for state in TCPSTATES:
-                for service in SERVICES + ("other",):
+                offset = int(state, 16) * per_state
+                for service_index, service in enumerate(SERVICE_NAMES):
+                    start = offset + service_index * per_service
                     key = ("state=%s service=%s" % (TCPSTATES[state],service))
-                    if key in counter:
-                        self._readq.nput("proc.net.tcp {0} {1} {2}".format(ts, counter[key], key))
-                    else:
-                        self._readq.nput("proc.net.tcp {0} {1} {2}".format(ts, "0", key))
+                    self._readq.nput("proc.net.tcp {0} {1} {2}".format(
+                        ts, sum(counter[start:start + per_service]), key))
 
             self._readq.nput("procnettcp.state %s %s" % (int(time.time()), '0'))
 
+    def count_netlink(self, counter):
+        """Counts the sockets of a sock_diag dump."""
+        uids = self.uids
+        other_user = len(USERS)
+        users = len(self.user_names)
+        services = len(SERVICE_NAMES)
+        service_index = SERVICE_INDEX
+        for family in (socket.AF_INET, socket.AF_INET6):
+            for state, sport, dport, src, dst, uid in self.diag.dump(family):
+                service = service_index.get(dport)
+                if service is None:
+                    service = service_index.get(sport, OTHER_SERVICE)
+                endpoint = EXTERNAL if is_public_addr(dst) or is_public_addr(src) else INTERNAL
+                user = uids.get(uid, other_user)
+                counter[((state * services + service) * ENDPOINTS + endpoint) * users + user] += 1
+
+    def count_procfs(self, counter):
+        """Counts the sockets of /proc/net/tcp and tcp6."""
+        other_user = len(USERS)
+        users = len(self.user_names)
+        services = len(SERVICE_NAMES)
+        for procfile in (self.tcp, self.tcp6):
+            if procfile is None:
+                continue
+            procfile.seek(0)
+            for line in procfile:
+                try:
+                    # pylint: disable=W0612
+                    (num, src, dst, state, queue, when, retrans,
+                     uid, timeout, inode) = line.split(None, 9)
+                except ValueError:  # Malformed line
+                    continue
+
+                if num == "sl":  # header
+                    continue
+
+                srcport = src.split(":")[1]
+                dstport = dst.split(":")[1]
+                srcport = int(srcport, 16)
+                dstport = int(dstport, 16)
+                service = SERVICE_INDEX.get(srcport, OTHER_SERVICE)
+                service = SERVICE_INDEX.get(dstport, service)
+
+                if is_public_ip(dst) or is_public_ip(src):
+                    endpoint = EXTERNAL
+                else:
+                    endpoint = INTERNAL
+
+                user = self.uids.get(int(uid), other_user)
+
+                counter[((int(state, 16) * services + service) * ENDPOINTS + endpoint) * users + user] += 1
+
 
 if __name__ == "__main__":
     procnettcp_inst = Procnettcp(None, None, Queue())
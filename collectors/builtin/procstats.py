@@ -21,6 +21,7 @@ import time
 import glob
 from Queue import Queue
 
+from collectors.lib import procfs
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
@@ -52,19 +53,10 @@ class Procstats(CollectorBase):
     def __init__(self, config, logger, readq):
         super(Procstats, self).__init__(config, logger, readq)
         try:
-            self.f_uptime = open("/proc/uptime", "r")
-            self.f_meminfo = open("/proc/meminfo", "r")
-            self.f_vmstat = open("/proc/vmstat", "r")
-            self.f_stat = open("/proc/stat", "r")
-            self.f_loadavg = open("/proc/loadavg", "r")
-            self.f_entropy_avail = open("/proc/sys/kernel/random/entropy_avail", "r")
-            self.f_interrupts = open("/proc/interrupts", "r")
-
             self.f_scaling = "/sys/devices/system/cpu/cpu%s/cpufreq/%s_freq"
             self.f_scaling_min = dict([])
             self.f_scaling_max = dict([])
             self.f_scaling_cur = dict([])
-            self.f_softirqs = open("/proc/softirqs", "r")
             for cpu in glob.glob("/sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq"):
                 m = re.match("/sys/devices/system/cpu/cpu([0-9]*)/cpufreq/scaling_cur_freq", cpu)
                 if not m:
@@ -82,14 +74,6 @@ class Procstats(CollectorBase):
             raise
 
     def cleanup(self):
-        self.safe_close(self.f_uptime)
-        self.safe_close(self.f_meminfo)
-        self.safe_close(self.f_vmstat)
-        self.safe_close(self.f_stat)
-        self.safe_close(self.f_loadavg)
-        self.safe_close(self.f_entropy_avail)
-        self.safe_close(self.f_interrupts)
-        self.safe_close(self.f_softirqs)
         self._cleanup_dict(self.f_scaling_min)
         self._cleanup_dict(self.f_scaling_max)
         self._cleanup_dict(self.f_scaling_cur)
@@ -99,20 +83,22 @@ class Procstats(CollectorBase):
             self.safe_close(val)
 
     def __call__(self):
-        with utils.lower_privileges(self._logger):
+        # all the lines of a collection are queued at once
+        with utils.lower_privileges(self._logger), self.batch():
+            # the files of /proc other collectors of this tick read too
+            snap = procfs.snapshot(self._tick)
+
             # proc.uptime
-            self.f_uptime.seek(0)
-            ts = int(time.time())
-            for line in self.f_uptime:
+            ts = self.timestamp()
+            for line in snap.lines("/proc/uptime"):
                 m = re.match("(\S+)\s+(\S+)", line)
                 if m:
                     self._readq.nput("proc.uptime.total %d %s" % (ts, m.group(1)))
                     self._readq.nput("proc.uptime.now %d %s" % (ts, m.group(2)))
 
             # proc.meminfo
-            self.f_meminfo.seek(0)
-            ts = int(time.time())
-            for line in self.f_meminfo:
+            ts = self.timestamp()
+            for line in snap.lines("/proc/meminfo"):
                 m = re.match("(\w+):\s+(\d+)\s+(\w+)", line)
                 if m:
                     if m.group(3).lower() == 'kb':
@@ -123,20 +109,21 @@ class Procstats(CollectorBase):
                     self._readq.nput("proc.meminfo.%s %d %s" % (m.group(1).lower(), ts, value))
 
             # proc.vmstat
-            self.f_vmstat.seek(0)
-            ts = int(time.time())
-            for line in self.f_vmstat:
+            ts = self.timestamp()
+            counters = []
+            for line in snap.lines("/proc/vmstat"):
                 m = re.match("(\w+)\s+(\d+)", line)
                 if not m:
                     continue
                 if m.group(1) in ("pgpgin", "pgpgout", "pswpin",
                                   "pswpout", "pgfault", "pgmajfault"):
-                    self._readq.nput("proc.vmstat.%s %d %s" % (m.group(1), ts, m.group(2)))
+                    counters.append(("proc.vmstat.%s" % m.group(1), m.group(2), ""))
+            self.emit_counters(ts, counters)
 
             # proc.stat
-            self.f_stat.seek(0)
-            ts = int(time.time())
-            for line in self.f_stat:
+            ts = self.timestamp()
+            counters = []
+            for line in snap.lines("/proc/stat"):
                 m = re.match("(\w+)\s+(.*)", line)
                 if not m:
                     continue
@@ -153,19 +140,19 @@ class Procstats(CollectorBase):
 
                     # We use zip to ignore fields that don't exist.
                     for value, field_name in zip(fields, cpu_types):
-                        self._readq.nput("proc.stat.cpu%s %d %s type=%s%s" % (metric_percpu, ts, value, field_name, tags))
+                        counters.append(("proc.stat.cpu%s" % metric_percpu, value, "type=%s%s" % (field_name, tags)))
                 elif m.group(1) == "intr":
-                    self._readq.nput("proc.stat.intr %d %s" % (ts, m.group(2).split()[0]))
+                    counters.append(("proc.stat.intr", m.group(2).split()[0], ""))
                 elif m.group(1) == "ctxt":
-                    self._readq.nput("proc.stat.ctxt %d %s" % (ts, m.group(2)))
+                    counters.append(("proc.stat.ctxt", m.group(2), ""))
                 elif m.group(1) == "processes":
-                    self._readq.nput("proc.stat.processes %d %s" % (ts, m.group(2)))
+                    counters.append(("proc.stat.processes", m.group(2), ""))
                 elif m.group(1) == "procs_blocked":
                     self._readq.nput("proc.stat.procs_blocked %d %s" % (ts, m.group(2)))
+            self.emit_counters(ts, counters)
 
-            self.f_loadavg.seek(0)
-            ts = int(time.time())
-            for line in self.f_loadavg:
+            ts = self.timestamp()
+            for line in snap.lines("/proc/loadavg"):
                 m = re.match("(\S+)\s+(\S+)\s+(\S+)\s+(\d+)/(\d+)\s+", line)
                 if not m:
                     continue
@@ -175,16 +162,16 @@ class Procstats(CollectorBase):
                 self._readq.nput("proc.loadavg.runnable %d %s" % (ts, m.group(4)))
                 self._readq.nput("proc.loadavg.total_threads %d %s" % (ts, m.group(5)))
 
-            self.f_entropy_avail.seek(0)
-            ts = int(time.time())
-            for line in self.f_entropy_avail:
+            ts = self.timestamp()
+            for line in snap.lines("/proc/sys/kernel/random/entropy_avail"):
                 self._readq.nput("proc.kernel.entropy_avail %d %s" % (ts, line.strip()))
 
-            self.f_interrupts.seek(0)
-            ts = int(time.time())
+            ts = self.timestamp()
+            counters = []
+            lines = snap.lines("/proc/interrupts")
             # Get number of CPUs from description line.
-            num_cpus = len(self.f_interrupts.readline().split())
-            for line in self.f_interrupts:
+            num_cpus = len(lines[0].split()) if lines else 0
+            for line in lines[1:]:
                 cols = line.split()
 
                 irq_type = cols[0].rstrip(":")
@@ -203,13 +190,15 @@ class Procstats(CollectorBase):
                             # something is weird, there should only be digit values
                             self.log_error("Unexpected interrupts value %r in %r: ", val, cols)
                             break
-                        self._readq.nput("proc.interrupts %s %s type=%s cpu=%s" % (ts, val, irq_type, i))
+                        counters.append(("proc.interrupts", val, "type=%s cpu=%s" % (irq_type, i)))
+            self.emit_counters(ts, counters)
 
-            self.f_softirqs.seek(0)
-            ts = int(time.time())
+            ts = self.timestamp()
+            counters = []
+            lines = snap.lines("/proc/softirqs")
             # Get number of CPUs from description line.
-            num_cpus = len(self.f_softirqs.readline().split())
-            for line in self.f_softirqs:
+            num_cpus = len(lines[0].split()) if lines else 0
+            for line in lines[1:]:
                 cols = line.split()
 
                 irq_type = cols[0].rstrip(":")
@@ -222,24 +211,25 @@ class Procstats(CollectorBase):
                         # something is weird, there should only be digit values
                         self.log_error("Unexpected softirq value %r in %r: ", val, cols)
                         break
-                    self._readq.nput("proc.softirqs %s %s type=%s cpu=%s" % (ts, val, irq_type, i))
+                    counters.append(("proc.softirqs", val, "type=%s cpu=%s" % (irq_type, i)))
+            self.emit_counters(ts, counters)
 
             self._print_numa_stats(self.numastats)
 
             # Print scaling stats
-            ts = int(time.time())
+            ts = self.timestamp()
             for cpu_no in self.f_scaling_min.keys():
                 f = self.f_scaling_min[cpu_no]
                 f.seek(0)
                 for line in f:
                     self._readq.nput("proc.scaling.min %d %s cpu=%s" % (ts, line.rstrip('\n'), cpu_no))
-            ts = int(time.time())
+            ts = self.timestamp()
             for cpu_no in self.f_scaling_max.keys():
                 f = self.f_scaling_max[cpu_no]
                 f.seek(0)
                 for line in f:
                     self._readq.nput("proc.scaling.max %d %s cpu=%s" % (ts, line.rstrip('\n'), cpu_no))
-            ts = int(time.time())
+            ts = self.timestamp()
             for cpu_no in self.f_scaling_cur.keys():
                 f = self.f_scaling_cur[cpu_no]
                 f.seek(0)
@@ -253,7 +243,7 @@ class Procstats(CollectorBase):
         for numafilename in numafiles:
             with open(numafilename) as numafile:
                 node_id = int(numafile.name[numafile.name.find("/node/node") + 10:-9])
-                ts = int(time.time())
+                ts = self.timestamp()
                 stats = dict(line.split() for line in numafile.read().splitlines())
                 for stat, tag in (  # hit: process wanted memory from this node and got it
                                   ("numa_hit", "hit"),
@@ -16,15 +16,14 @@
 
 import time
 import ast
-from subprocess import Popen, PIPE, CalledProcessError, STDOUT
-
 
+from collectors.lib import procfs
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
-# We collect service startup time (in sec) by calling "ps -eo pid,lstart,cmd".
+# We collect service startup time (in sec) from the walk of /proc shared with the other collectors of the tick.
 # We need to add to services_startup.conf list of processes to be monitored.
-# The command "ps -eo pid,lstart,cmd" returns pid, start time, and command of all long
+# The walk has the pid, start time, and command of all long
 # running services in current host. We will grep list of services in the config.
 # Then we will send metric="startAtSec", tags:(service=<name>), ts=startTimeInSec.
 # Note that ts=startTimeInSec instead of current time. Thus, we will have single data point
@@ -48,35 +47,20 @@ class ServicesStartup(CollectorBase):
             self.services = self.get_config('services', 'alertd, datanode').split(',')
 
     def __call__(self):
-        try:
-            p = Popen('ps -eo pid,lstart,cmd', shell=True, stdout=PIPE, stderr=STDOUT)
-            for line in p.stdout.readlines():
-                self.process(line)
+        for proc in procfs.snapshot(self._tick).processes():
+            self.process(proc)
+
+        self.initialize = False
+        self.swap()
 
-            self.initialize = False
-            retval = p.wait()
-            if retval:
-                raise CalledProcessError(ret, "ps -eo pid,lstart,cmd", "ps returned code %i" % retval)
-            self.swap()
-        except OSError as e1:
-            self.log_exception("ps -eo pid,lstart,cmd fails. [%s]", e1)
-            return
-                                                      
-        except CalledProcessError as e:
-            self.log_exception("Error run ps in subprocess. [%s]", e)                            
-            return
-       
-    def process(self, line):
+    def process(self, proc):
         for service in self.services:
             service = service.strip()
-            if service in line:
+            if service in proc.cmdline:
                 self.curr_started_services.append(service)
-                tokens = line.split()
-                time_str="%s %s %s %s"%(tokens[2], tokens[3], tokens[4], tokens[5])
-                d = time.strptime(time_str, "%b %d %H:%M:%S %Y")
-                startup_sec = int(time.mktime(d))
+                startup_sec = proc.start_time
 
-                service_tag = "service=%s.%s"%(tokens[0], utils.remove_invalid_characters(service))
+                service_tag = "service=%s.%s"%(proc.pid, utils.remove_invalid_characters(service))
                 self.print_metric(startup_sec, startup_sec, service_tag)
 
     def swap(self):
@@ -2,6 +2,7 @@ import time
 import requests
 from HTMLParser import HTMLParser
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib.httpengine import get_engine
 
 SPARK_STANDALONE_MODE = 'spark_standalone_mode'
 SPARK_YARN_MODE = 'spark_yarn_mode'
@@ -152,6 +153,14 @@ RDD_METRCIS = [
     'diskUsed'
 ]
 
+# what we get of each application: REST path, metric prefix, metrics and the field identifying the item
+APP_RESOURCES = [
+    ('jobs', 'job', JOB_METRICS, 'jobId'),
+    ('stages', 'stage', STAGE_METRICS, 'stageId'),
+    ('executors', 'executor', EXECUTOR_METRICS, 'id'),
+    ('storage/rdd', 'rdd', RDD_METRCIS, 'id')
+]
+
 
 class Spark(CollectorBase):
     def __init__(self, config, logger, readq):
@@ -165,10 +174,7 @@ class Spark(CollectorBase):
     def __call__(self):
         try:
             spark_apps = self._get_running_apps()
-            self._spark_job_metrics(spark_apps)
-            self._spark_stage_metrics(spark_apps)
-            self._spark_executor_metrics(spark_apps)
-            self._spark_rdd_metrics(spark_apps)
+            self._spark_app_metrics(spark_apps)
             self._readq.nput("spark.state %s %s" % (int(time.time()), '0'))
         except Exception as e:
             self._readq.nput("spark.state %s %s" % (int(time.time()), '1'))
@@ -195,70 +201,28 @@ class Spark(CollectorBase):
             self._readq.nput("spark.state %s %s" % (int(time.time()), '1'))
             raise Exception('Invalid setting for spark_cluster_mode. Received %s.' % (self.spark_cluster_mode))
 
-    def _spark_job_metrics(self, running_apps):
-        try:
-            for app_id, (app_name, tracking_url) in running_apps.iteritems():
-                i = 0
-                ts = time.time()
-
-                for job in self.request(url_join_4(tracking_url, REST_API["SPARK_APPS_PATH"], app_name, 'jobs')):
-                    i = i + 1
-                    for metric in JOB_METRICS:
-                        self._readq.nput('spark.job.%s %d %d host=%s name=%s id=%s' % (metric, ts, job[metric], self.host, app_name, job['jobId']))
-
-                self._readq.nput('spark.job.count %d %d host=%s' % (ts, i, self.host))
-        except Exception as e:
-            self._readq.nput("spark.state %s %s" % (int(time.time()), '1'))
-            self.log_exception('exception collecting spark job metrics %s' % e)
-
-
-    def _spark_stage_metrics(self, running_apps):
-        try:
-            for app_id, (app_name, tracking_url) in running_apps.iteritems():
+    def _spark_app_metrics(self, running_apps):
+        # all the requests about all the applications at once, rather than one after the other
+        fetches = [((path, kind, metrics, id_field), app_name,
+                    url_join_4(tracking_url, REST_API["SPARK_APPS_PATH"], app_name, path))
+                   for (path, kind, metrics, id_field) in APP_RESOURCES
+                   for app_id, (app_name, tracking_url) in running_apps.iteritems()]
+        results = get_engine().get_json([url for _, _, url in fetches], {'Content-Type': 'application/json'})
+        ts = time.time()
+        for ((path, kind, metrics, id_field), app_name, url), items in zip(fetches, results):
+            try:
+                if isinstance(items, Exception):
+                    raise items
                 i = 0
-                ts = time.time()
-
-                for stage in self.request(url_join_4(tracking_url, REST_API["SPARK_APPS_PATH"], app_name, 'stages')):
+                for item in items:
                     i = i + 1
-                    for metric in STAGE_METRICS:
-                        self._readq.nput('spark.stage.%s %d %d host=%s name=%s id=%s' % (metric, ts, stage[metric], self.host, app_name, stage['stageId']))
-
-                self._readq.nput('spark.stage.count %d %d host=%s' % (ts, i, self.host))
-        except Exception as e:
-            self._readq.nput("spark.state %s %s" % (int(time.time()), '1'))
-            self.log_exception('exception collecting spark stage metrics %s' % e)
+                    for metric in metrics:
+                        self._readq.nput('spark.%s.%s %d %d host=%s name=%s id=%s' % (kind, metric, ts, item[metric], self.host, app_name, item[id_field]))
 
-    def _spark_executor_metrics(self, running_apps):
-        try:
-            for app_id, (app_name, tracking_url) in running_apps.iteritems():
-                i = 0
-                ts = time.time()
-
-                for executor in self.request(url_join_4(tracking_url, REST_API["SPARK_APPS_PATH"], app_name, 'executors')):
-                    i = i + 1
-                    for metric in EXECUTOR_METRICS:
-                        self._readq.nput('spark.executor.%s %d %d host=%s name=%s id=%s' % (metric, ts, executor[metric], self.host, app_name, executor['id']))
-
-                self._readq.nput('spark.executor.count %d %d host=%s' % (ts, i, self.host))
-        except Exception as e:
-            self._readq.nput("spark.state %s %s" % (int(time.time()), '1'))
-            self.log_exception('exception collecting spark stage metrics %s' % e)
-
-    def _spark_rdd_metrics(self, running_apps):
-        try:
-            for app_id, (app_name, tracking_url) in running_apps.iteritems():
-                i = 0
-                ts = time.time()
-
-                for rdd in self.request(url_join_4(tracking_url, REST_API["SPARK_APPS_PATH"], app_name, 'storage/rdd')):
-                    i = i + 1
-                    for metric in RDD_METRCIS:
-                        self._readq.nput('spark.rdd.%s %d %d host=%s name=%s id=%s' % (metric, ts, rdd[metric], self.host, app_name, rdd['id']))
-
-                self._readq.nput('spark.rdd.count %d %d host=%s' % (ts, i, self.host))
-        except Exception as e:
-            self._readq.nput("spark.state %s %s" % (int(time.time()), '1'))
-            self.log_exception('exception collecting spark stage metrics %s' % e)
+                self._readq.nput('spark.%s.count %d %d host=%s' % (kind, ts, i, self.host))
+            except Exception as e:
+                self._readq.nput("spark.state %s %s" % (int(time.time()), '1'))
+                self.log_exception('exception collecting spark %s metrics %s' % (kind, e))
 
     def _standalone_init(self):
         # Return a dictionary of {app_id: (app_name, tracking_url)} for the running Spark applications
@@ -344,8 +308,12 @@ class Spark(CollectorBase):
         Return a dictionary of {app_id: (app_name, tracking_url)} for Spark applications
         '''
         spark_apps = {}
-        for app_id, (app_name, tracking_url) in running_apps.iteritems():
-            response = self.request(url_join_2(tracking_url,REST_API["SPARK_APPS_PATH"]))
+        tracking_urls = [tracking_url for app_name, tracking_url in running_apps.itervalues()]
+        responses = get_engine().get_json([url_join_2(tracking_url, REST_API["SPARK_APPS_PATH"])
+                                           for tracking_url in tracking_urls], {'Content-Type': 'application/json'})
+        for tracking_url, response in zip(tracking_urls, responses):
+            if isinstance(response, Exception):
+                raise response
 
             for app in response:
                 app_id = app.get('id')
@@ -359,12 +327,12 @@ class Spark(CollectorBase):
 
     def request(self, url):
         headers = {'Content-Type': 'application/json'}
-        resp = requests.get(url, headers=headers)
-        if resp.status_code != 200:
+        resp = get_engine().get_json([url], headers)[0]
+        if isinstance(resp, Exception):
             self.log_exception("spark collector can not access url : %s" % url)
             raise HTTPError(url)
 
-        return resp.json()
+        return resp
 
 
 # Get Url and Parse form Spark standalone page
@@ -2,6 +2,7 @@ import time
 import requests
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
+from collectors.lib.httpengine import get_engine
 
 # reference: http://storm.apache.org/releases/1.0.2/STORM-UI-REST-API.html
 REST_API = {"cluster": "/api/v1/cluster/summary",
@@ -241,9 +242,13 @@ class Storm(CollectorBase):
 
     def _topology_deatails_loader(self,ids):
         try:
-            for id in ids:
-                jdata = self.request('%s%s?%s' % (REST_API["topology_details"], id, "window=600"))
-                ts = time.time()
+            # the details of all the topologies at once, the requests run concurrently on the shared http engine
+            responses = get_engine().get_json(['%s%s%s?%s' % (self.http_prefix, REST_API["topology_details"], id, "window=600")
+                                               for id in ids])
+            ts = time.time()
+            for id, jdata in zip(ids, responses):
+                if isinstance(jdata, Exception):
+                    raise HTTPError(jdata.url)
                 if jdata:
                     for topology in jdata['topologyStats']:
                         for metric in TOPOLOGY_DETAILS['topologyStats']:
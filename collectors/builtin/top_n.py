@@ -14,13 +14,15 @@
 #
 """TopN cpu and memory stats"""
 
+import heapq
 import time
-from subprocess import Popen, PIPE, CalledProcessError, STDOUT
+from operator import attrgetter
 
+from collectors.lib import procfs
 from collectors.lib import utils
 from collectors.lib.collectorbase import CollectorBase
 
-# We collect top N usages of CPU,MEM,IO processes by calling "ps -Ao xxx".
+# We collect top N usages of CPU,MEM processes from one walk of /proc shared with the other collectors of the tick.
 # Then we will send metric="cpu.topn", tags:(proc=<pid>_<cmd>), ts=currTimeInSec.
 
 class TopN(CollectorBase):
@@ -30,39 +32,20 @@ class TopN(CollectorBase):
 
     def __init__(self, config, logger, readq):
         super(TopN, self).__init__(config, logger, readq)
-        self.N = self.get_config("N", 10);
+        self.N = int(self.get_config("N", 10))
 
     def __call__(self):
-        self.get_top_N("cpu.topN", "pcpu", "pcpu")
-        self.get_top_N("mem.topN", "pmem", "rss")
-
-    def get_top_N(self, metric, ps_field, ps_sort_by):
-        try:
-            p = Popen("ps -Ao comm,pid,%s,cmd --sort=-%s | head -n %s"%(ps_field, ps_sort_by,self.N), shell=True, stdout=PIPE, stderr=STDOUT)
-            for line in p.stdout.readlines():
-                self.process(line, metric)
-
-            retval = p.wait()
-            if retval:
-                raise CalledProcessError(ret, "ps -Ao comm,pid,%s,cmd --sort=-%s | head -n %s"%(ps_field, ps_sort_by,self.N), "ps returned code %i" % retval)
-        except OSError as e1:
-            self.log_exception("ps -Ao comm,pid,%s,cmd --sort=-%s | head -n %s. [%s]"%(ps_field, ps_sort_by,self.N, e1))
-            return
-
-        except CalledProcessError as e:
-            self.log_exception("Error run ps in subprocess. [%s]", e)
-            return
-
-    def process(self, line, metric):
-        if not ("COMMAND" in line and "PID" in line):
-            tokens = line.split()
-            #cmd = utils.remove_invalid_characters(tokens[0])
-            pid = tokens[1]
-            #print cmd, pid, tokens[2]
-            value = float(tokens[2]) # cpu or mem
-            full_command = ''.join(tokens[3:len(tokens)]) # full command
-            tag = "pid_cmd=%s_%s"%(pid,utils.remove_invalid_characters(full_command))
-            self.print_metric(metric, (int(time.time())), value, tag)
+        # the CPU usage is since the previous walk, rather than since the processes started like ps has it
+        processes = procfs.snapshot(self._tick).processes()
+        self.get_top_N(processes, "cpu.topN", "pcpu", "pcpu")
+        self.get_top_N(processes, "mem.topN", "pmem", "rss")
+
+    def get_top_N(self, processes, metric, field, sort_by):
+        ts = int(time.time())
+        for proc in heapq.nlargest(self.N, processes, key=attrgetter(sort_by)):
+            full_command = ''.join(proc.cmdline.split())  # full command
+            tag = "pid_cmd=%s_%s" % (proc.pid, utils.remove_invalid_characters(full_command))
+            self.print_metric(metric, ts, "%.1f" % getattr(proc, field), tag)
 
 
 if __name__ == "__main__":
@@ -71,7 +71,20 @@ def get_defaults():
         'ssl': False,
         'stdin': False,
         'daemonize': False,
-        'hosts': False
+        'hosts': False,
+        'reader_mode': 'epoll',
+        'spool_dir': False,
+        'spool_max_bytes': 128 * 1024 * 1024,
+        'spool_replay_rate': 2000,
+        'connections': 1,
+        'max_batch_bytes': 1024 * 1024,
+        'max_batch_points': 10000,
+        'max_linger_ms': 1000,
+        'http_compression': 'none',
+        'stats_interval': 60,
+        'cpu_budget': 0,
+        'profile_dir': False,
+        'profile_seconds': 30
     }
 
     return defaults
\ No newline at end of file
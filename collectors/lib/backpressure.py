@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Backpressure for the queue between the collectors and the sender.
+
+   When the sender can't keep up, e.g. while the server is slow or out of
+   reach, the queue fills up.  Rather than dropping whatever comes next, a
+   PressureQueue:
+   - keeps two classes of lines: the health of the agent and its
+     collectors (the "<name>.state" lines and our own metrics), always
+     sent first and given room at the expense of the bulk metrics;
+   - caps how many lines a single collector may hold in the queue, so one
+     flood doesn't crowd out every other collector;
+   - once mostly full, optionally downsamples the bulk metrics, keeping one
+     point per series every so many seconds;
+   - moves the lines that don't fit to a spool on disk, from which the
+     queue is refilled once it has drained."""
+
+import logging
+import threading
+import time
+from collections import deque
+
+from collectors.lib.batching import BulkQueue
+from collectors.lib.selfmetrics import MetricsRegistry
+
+HEALTH, BULK = 0, 1
+PRIORITIES = {HEALTH: 'health', BULK: 'bulk'}
+# Past that fraction of the queue, the bulk metrics are downsampled.
+LOSSY_THRESHOLD = 0.8
+# Below that fraction, downsampling stops and the spool is replayed.
+REFILL_THRESHOLD = 0.5
+# How many lines we spool or replay at once.
+SPOOL_BATCH = 1000
+# One dropped line of every that many is logged.
+LOG_DROPPED_EVERY = 50
+
+
+def is_health(line):
+    """Whether a "<metric> <timestamp> <value> [tags]" line is about the
+       health of a collector."""
+    if '.state ' not in line:  # most lines, without splitting them
+        return False
+    parts = line.split(None, 1)
+    return bool(parts) and parts[0].endswith('.state')
+
+
+def series_key(line):
+    """Returns the series of a line and its timestamp in seconds, or None
+       if it can't be parsed."""
+    parts = line.split(None, 3)
+    if len(parts) < 3:
+        return None
+    try:
+        timestamp = int(parts[1])
+    except ValueError:
+        return None
+    if timestamp > 9999999999:  # milliseconds
+        timestamp /= 1000
+    return (parts[0], parts[3] if len(parts) > 3 else ''), timestamp
+
+
+class PressureQueue(BulkQueue):
+    """A queue of lines that degrades gracefully when it fills up.
+
+       The lines put with nput() and nput_many() are health lines, the
+       collectors are given a CollectorQueue which sorts theirs out."""
+
+    def __init__(self, maxsize, spool=None, lossy_interval=0, quota=0,
+                 logger=None, stats=None):
+        """Constructor.
+
+        Args:
+          maxsize: How many lines the queue holds in memory.
+          spool: A Spool to move the lines that don't fit to, or None to
+            drop them.
+          lossy_interval: When the queue is mostly full, keep only one
+            point per series every that many seconds, 0 to keep them all.
+          quota: How many lines a collector may hold in the queue, unless
+            its CollectorQueue says otherwise, 0 for no limit.
+          logger: Where to log the lines we drop.
+          stats: The MetricsRegistry to record our metrics in.
+        """
+        BulkQueue.__init__(self, maxsize)
+        self.spool = spool
+        self.lossy_interval = lossy_interval
+        self.quota = quota
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats = stats if stats is not None else MetricsRegistry()
+        self.held = {}  # collector -> how many of its lines we hold
+        self.lossy = False
+        self.lossy_lock = threading.Lock()
+        self.last_kept = {}  # series -> timestamp of the last point kept
+        self.spool_lock = threading.Lock()
+        self.spill_buffer = []
+        self.dropped = self.stats.counter('readq.dropped')
+        self.downsampled = self.stats.counter('readq.downsampled')
+        self.spilled = self.stats.counter('readq.spilled')
+        self.replayed = self.stats.counter('readq.replayed')
+        self.stats.add_source(self.report_stats)
+
+    # The Queue hooks, called with the mutex held.  The items are (line,
+    # priority, collector) tuples, queued as (line, priority, collector,
+    # when queued) ones, get() returns the line.
+
+    def _init(self, maxsize):
+        self.queues = (deque(), deque())
+        self.last_enqueued = None
+
+    def _qsize(self, len=len):
+        return len(self.queues[HEALTH]) + len(self.queues[BULK])
+
+    def _put(self, item):
+        line, priority, owner = item
+        self.queues[priority].append((line, priority, owner, time.time()))
+        if owner is not None:
+            self.held[owner] = self.held.get(owner, 0) + 1
+
+    def _get(self):
+        line, _, owner, self.last_enqueued = (self.queues[HEALTH]
+                                              or self.queues[BULK]).popleft()
+        if owner is not None:
+            self.held[owner] -= 1
+        return line
+
+    def nput(self, value):
+        return self.offer([value], HEALTH)
+
+    def nput_many(self, values):
+        return self.offer(values, HEALTH)
+
+    def offer(self, lines, priority=BULK, owner=None, quota=None):
+        """Queues lines without blocking.
+
+        Args:
+          lines: The lines to queue.
+          priority: HEALTH or BULK.
+          owner: The name of the collector they come from, if any.
+          quota: How many lines owner may hold in the queue, defaults to
+            our quota.
+
+        Returns:
+          False if some of the lines had to be spooled, downsampled or
+          dropped.
+        """
+        if priority == BULK and self.lossy:
+            kept = self.downsample(lines)
+            lossless = len(kept) == len(lines)
+            lines = kept
+        else:
+            lossless = True
+        if quota is None:
+            quota = self.quota
+        evicted = []
+        with self.not_full:
+            count = len(lines)
+            if self.maxsize > 0:
+                room = self.maxsize - self._qsize()
+                if priority == HEALTH:
+                    # the oldest bulk lines make way for the health ones
+                    bulk = self.queues[BULK]
+                    while room < count and bulk:
+                        line, _, line_owner, _ = bulk.popleft()
+                        if line_owner is not None:
+                            self.held[line_owner] -= 1
+                        evicted.append(line)
+                        room += 1
+                count = min(count, room)
+            over_quota = False
+            if owner is not None and quota > 0:
+                allowed = quota - self.held.get(owner, 0)
+                if allowed < count:
+                    count = allowed
+                    over_quota = True
+            count = max(count, 0)
+            if count:
+                now = time.time()
+                self.queues[priority].extend(
+                    [(queued, priority, owner, now) for queued in
+                     (lines if count == len(lines) else lines[:count])])
+                if owner is not None:
+                    self.held[owner] = self.held.get(owner, 0) + count
+                self.unfinished_tasks += count
+                self.not_empty.notify_all()
+            self.update_lossy()
+        overflow = lines[count:]
+        if evicted:
+            self.overflow(evicted, 'evicted')
+        if overflow:
+            self.overflow(overflow, 'quota' if over_quota else 'full', owner)
+        return lossless and not overflow
+
+    def requeue(self, lines):
+        """Puts back lines we got but failed to send, ahead of the others."""
+        with self.not_full:
+            count = len(lines)
+            if self.maxsize > 0:
+                count = max(min(count, self.maxsize - self._qsize()), 0)
+            bulk = self.queues[BULK]
+            # they were queued before, how long ago we don't know
+            now = time.time()
+            for i in xrange(count - 1, -1, -1):
+                bulk.appendleft((lines[i], BULK, None, now))
+            if count:
+                self.unfinished_tasks += count
+                self.not_empty.notify_all()
+        if count < len(lines):
+            self.overflow(lines[count:], 'full')
+
+    def update_lossy(self):
+        """Switches downsampling on or off as the queue fills or drains,
+           with the mutex held."""
+        if not self.lossy_interval or self.maxsize <= 0:
+            return
+        fill = float(self._qsize()) / self.maxsize
+        if not self.lossy and fill >= LOSSY_THRESHOLD:
+            self.lossy = True
+            self.logger.warning('readq is %d%% full, downsampling the metrics '
+                                'to one point every %ds per series',
+                                100 * fill, self.lossy_interval)
+        elif self.lossy and fill < REFILL_THRESHOLD:
+            self.lossy = False
+            self.last_kept = {}
+            self.logger.info('readq drained, not downsampling anymore')
+
+    def downsample(self, lines):
+        """Returns the lines of a series no closer than lossy_interval to
+           the previous point we kept for it."""
+        kept = []
+        with self.lossy_lock:
+            last_kept = self.last_kept
+            for line in lines:
+                parsed = series_key(line)
+                if parsed is not None:
+                    series, timestamp = parsed
+                    last = last_kept.get(series)
+                    if last is not None and 0 <= timestamp - last < self.lossy_interval:
+                        continue
+                    last_kept[series] = timestamp
+                kept.append(line)
+        self.downsampled.inc(len(lines) - len(kept))
+        return kept
+
+    def overflow(self, lines, reason, owner=None):
+        """Spools the lines that didn't fit, or drops them."""
+        if self.spool is not None:
+            with self.spool_lock:
+                self.spill_buffer.extend(lines)
+                if len(self.spill_buffer) >= SPOOL_BATCH:
+                    self.flush_spill()
+            return
+        self.drop(lines, reason, owner)
+
+    def drop(self, lines, reason, owner=None):
+        before = self.dropped.value
+        self.dropped.inc(len(lines))
+        self.stats.counter('readq.dropped_lines', reason=reason,
+                           collector=owner or 'agent').inc(len(lines))
+        if before / LOG_DROPPED_EVERY != self.dropped.value / LOG_DROPPED_EVERY:
+            self.logger.error('readq %s, dropped %d lines so far, e.g. %s',
+                              reason, self.dropped.value, lines[-1])
+
+    def flush_spill(self):
+        """Writes the lines waiting to be spooled, with spool_lock held."""
+        lines, self.spill_buffer = self.spill_buffer, []
+        if not lines:
+            return
+        try:
+            self.spool.append(lines)
+            self.spilled.inc(len(lines))
+        except EnvironmentError:
+            self.logger.exception('failed to spool %d lines', len(lines))
+            self.drop(lines, 'spool')
+
+    def refill(self):
+        """Moves spooled lines back into the queue while it has room.
+
+           Called by the sender between batches.  Returns how many lines
+           were replayed."""
+        if self.spool is None:
+            return 0
+        replayed = 0
+        with self.spool_lock:
+            self.flush_spill()
+            while True:
+                room = int(self.maxsize * REFILL_THRESHOLD) - self.qsize()
+                if room <= 0 or self.spool.is_empty():
+                    break
+                try:
+                    lines = self.spool.peek(min(room, SPOOL_BATCH))
+                except EnvironmentError:
+                    self.logger.exception('failed to read the spool')
+                    break
+                count = self.put_many([(line, BULK, None) for line in lines])
+                self.spool.consume(count)
+                replayed += count
+                if count < len(lines):
+                    break
+        self.replayed.inc(replayed)
+        return replayed
+
+    def close(self):
+        """Spools what we still hold, so that it's sent after a restart."""
+        if self.spool is None:
+            return
+        lines = self.get_many(self.qsize())
+        with self.spool_lock:
+            self.spill_buffer.extend(lines)
+            self.flush_spill()
+            self.spool.close()
+
+    def report_stats(self):
+        """Returns (metric, tags, value) tuples about our state."""
+        with self.mutex:
+            depths = [len(queue) for queue in self.queues]
+            held = sorted(self.held.items())
+        result = [('readq.depth', ('priority=%s' % PRIORITIES[priority],), depth)
+                  for priority, depth in enumerate(depths)]
+        result.append(('readq.lossy', (), int(self.lossy)))
+        result.extend(('readq.held', ('collector=%s' % owner,), count)
+                      for owner, count in held)
+        if self.spool is not None:
+            result.append(('readq.spool_bytes', (), self.spool.size()))
+        return result
+
+
+class CollectorQueue(object):
+    """What a collector gets as its readq: queues its lines in a
+       PressureQueue on its behalf, sorting out the health lines."""
+
+    def __init__(self, queue, name, quota=None):
+        self.queue = queue
+        self.name = name
+        self.quota = quota
+
+    def nput(self, value):
+        priority = HEALTH if is_health(value) else BULK
+        return self.queue.offer([value], priority, self.name, self.quota)
+
+    def nput_many(self, values):
+        health = [value for value in values if is_health(value)]
+        if not health:
+            return self.queue.offer(values, BULK, self.name, self.quota)
+        ok = self.queue.offer(health, HEALTH, self.name, self.quota)
+        bulk = [value for value in values if not is_health(value)]
+        return self.queue.offer(bulk, BULK, self.name, self.quota) and ok
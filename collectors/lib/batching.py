@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Flush policy for the senders of tcollector and of the runner.
+
+   A Batcher moves data points from a queue into a batch until one of its
+   limits is hit: the number of points, their size in bytes, or how long
+   the oldest point of the batch has been waiting.  The sizes of the
+   batches, how long they lingered before being flushed, and how long
+   their oldest point waited since it was queued are recorded in
+   histograms.
+
+   With a BulkQueue, points are queued and taken off the queue many at a
+   time, at the cost of a single lock each time, and the queue tells when
+   they were queued."""
+
+import bisect
+import time
+from collections import deque
+from Queue import Empty
+from Queue import Queue
+
+# Bucket upper bounds of the histograms kept by a Batcher.
+BATCH_POINTS_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+BATCH_BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+BATCH_LINGER_MS_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+QUEUE_WAIT_MS_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+                         60000)
+
+# When the caller has work to do while we wait for data points, we hand it
+# control for at most this long before checking the queue again.
+IDLE_POLL_INTERVAL = 0.05  # seconds
+
+
+class BulkQueue(Queue):
+    """A Queue that can also put and get many items at once, without
+       blocking.
+
+       The items are stamped with the time they were put, and
+       last_enqueued is the stamp of the last item taken off, for the one
+       thread consuming the queue.  Subclasses overriding _put() and
+       _get() keep them up to date too."""
+
+    def _init(self, maxsize):
+        Queue._init(self, maxsize)
+        self.enqueued = deque()  # When each item of self.queue was put.
+        self.last_enqueued = None
+
+    def _put(self, item):
+        self.queue.append(item)
+        self.enqueued.append(time.time())
+
+    def _get(self):
+        self.last_enqueued = self.enqueued.popleft()
+        return self.queue.popleft()
+
+    def put_many(self, items):
+        """Appends as many of items as there's room for, returns how many."""
+        with self.not_full:
+            count = len(items)
+            if self.maxsize > 0:
+                count = max(min(count, self.maxsize - self._qsize()), 0)
+            if count == 0:
+                return 0
+            for item in (items if count == len(items) else items[:count]):
+                self._put(item)
+            self.unfinished_tasks += count
+            self.not_empty.notify_all()
+        return count
+
+    def get_many(self, max_items):
+        """Removes and returns up to max_items items, maybe none."""
+        with self.not_empty:
+            count = min(max_items, self._qsize())
+            if count <= 0:
+                return []
+            items = [self._get() for _ in xrange(count)]
+            self.not_full.notify_all()
+        return items
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        # one more bucket for the values above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def buckets(self):
+        """Returns (upper bound, cumulative count) pairs, the last upper
+           bound being 'inf'."""
+        result = []
+        total = 0
+        for bound, count in zip(self.bounds + ('inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def percentile(self, pct):
+        """Returns the upper bound of the bucket holding the given
+           percentile of the observed values."""
+        rank = self.count * pct / 100.0
+        for bound, total in self.buckets():
+            if total >= rank:
+                return bound
+        return 'inf'
+
+    def metrics(self, name):
+        """Returns (metric, tags, value) tuples to report this histogram,
+           tags being a tuple of "tagk=tagv" strings."""
+        result = [('%s.bucket' % name, ('le=%s' % bound,), total)
+                  for bound, total in self.buckets()]
+        result.append(('%s.count' % name, (), self.count))
+        result.append(('%s.sum' % name, (), self.sum))
+        return result
+
+
+class Batcher(object):
+    """Fills batches from a queue, and tells when to flush them.
+
+       A batch is flushed as soon as it holds max_batch_points points, or
+       max_batch_bytes bytes of them, or max_linger_ms after its first
+       point was taken off the queue, whichever comes first."""
+
+    def __init__(self, max_batch_bytes, max_batch_points, max_linger_ms,
+                 sizeof=len):
+        """Constructor.
+
+        Args:
+          max_batch_bytes: Flush once the points of the batch add up to
+            this many bytes.
+          max_batch_points: Flush once the batch holds this many points.
+          max_linger_ms: Flush once the first point of the batch has been
+            waiting for this many milliseconds.
+          sizeof: A function returning the size in bytes of a point.
+        """
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_points = max_batch_points
+        self.max_linger = max_linger_ms / 1000.0
+        self.sizeof = sizeof
+        self.batch_points = Histogram(BATCH_POINTS_BUCKETS)
+        self.batch_bytes = Histogram(BATCH_BYTES_BUCKETS)
+        self.batch_linger_ms = Histogram(BATCH_LINGER_MS_BUCKETS)
+        self.queue_wait_ms = Histogram(QUEUE_WAIT_MS_BUCKETS)
+        # When the first point of the batch was queued, if the queue says.
+        self.enqueued = None
+
+    def fill(self, queue, batch, timeout, idle=None):
+        """Moves points from queue to batch until it's time to flush it.
+
+        Args:
+          queue: The Queue to take points from.
+          batch: The list to append the points to.  It may already hold
+            points we failed to send the last time, they count towards
+            the limits.
+          timeout: How many seconds to wait for the first point.
+          idle: If given, it's called with a number of seconds instead of
+            blocking on the queue, so the caller can do some work while
+            it waits.  It returns False when we should stop waiting.
+
+        Returns:
+          Why the batch should be flushed: 'points', 'bytes' or 'linger',
+          or None if the batch is still empty.
+        """
+        sizeof = self.sizeof
+        size = sum(sizeof(point) for point in batch)
+        if not batch:
+            point = self.get(queue, timeout, idle)
+            if point is None:
+                return None
+            batch.append(point)
+            size += sizeof(point)
+            self.enqueued = getattr(queue, 'last_enqueued', None)
+        start = time.time()
+        deadline = start + self.max_linger
+        get_many = getattr(queue, 'get_many', None)
+        while True:
+            if len(batch) >= self.max_batch_points:
+                reason = 'points'
+                break
+            if size >= self.max_batch_bytes:
+                reason = 'bytes'
+                break
+            if get_many is not None:
+                # as many points as should fit, judging by the average size
+                # of those we have
+                count = min(self.max_batch_points - len(batch),
+                            (self.max_batch_bytes - size) * len(batch) / size
+                            if size else 1)
+                points = get_many(max(count, 1))
+                if points:
+                    batch.extend(points)
+                    size += sum(sizeof(point) for point in points)
+                    continue
+            point = self.get(queue, deadline - time.time(), idle)
+            if point is None:
+                reason = 'linger'
+                break
+            batch.append(point)
+            size += sizeof(point)
+        self.batch_points.observe(len(batch))
+        self.batch_bytes.observe(size)
+        now = time.time()
+        self.batch_linger_ms.observe(int(1000 * (now - start)))
+        if self.enqueued is not None:
+            self.queue_wait_ms.observe(int(1000 * (now - self.enqueued)))
+        return reason
+
+    def get(self, queue, timeout, idle=None):
+        """Returns the next point of the queue, or None if none came
+           within timeout seconds."""
+        try:
+            return queue.get(False)
+        except Empty:
+            pass
+        if timeout <= 0:
+            return None
+        if idle is None:
+            try:
+                return queue.get(True, timeout)
+            except Empty:
+                return None
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if idle(min(remaining, IDLE_POLL_INTERVAL)) is False:
+                return None
+            try:
+                return queue.get(False)
+            except Empty:
+                pass
+
+    def metrics(self, prefix):
+        """Returns (metric, tags, value) tuples reporting our histograms."""
+        return (self.batch_points.metrics(prefix + '.batch_points')
+                + self.batch_bytes.metrics(prefix + '.batch_bytes')
+                + self.batch_linger_ms.metrics(prefix + '.batch_linger_ms')
+                + self.queue_wait_ms.metrics(prefix + '.queue_wait_ms'))
@@ -4,10 +4,21 @@ import sys
 import signal
 import os
 import time
+from contextlib import contextmanager
 from threading import Thread
 
+from collectors.lib.rates import RateEngine
+
+# seconds, how often a counter that doesn't change is sent anyway with skip_unchanged
+DEFAULT_RESEND = 600
+
 
 class CollectorBase(object):
+    _tick = None
+    _rate_engine = None
+    _emit_rates = False
+    _resend = None
+
     def __init__(self, config, logger, readq):
         self._config = config
         self._logger = logger
@@ -40,6 +51,66 @@ class CollectorBase(object):
         """
         self._exit = True
 
+    def set_tick(self, tick):
+        """
+        called by the runner before each collection with the time the collection was due, see timestamp()
+        """
+        self._tick = tick
+
+    def timestamp(self):
+        """
+        the timestamp to give the points of a collection: the tick it was due at when the runner gave us one, so that
+        the points of a cycle all share it, whatever the collector spends on each of them, or the current time.
+        Returns: int
+
+        """
+        if self._tick is not None:
+            return int(self._tick)
+        return int(time.time())
+
+    def emit_batch(self, lines):
+        """
+        queue a list of lines at once, e.g. all the lines of a collection, rather than calling nput for each of them
+        Returns: False if some lines were dropped
+
+        """
+        return nput_many(self._readq, lines)
+
+    def batch(self):
+        """
+        within this with block, the nput calls of the collector are queued at once when the block ends
+        """
+        return batched(self)
+
+    def emit_counters(self, ts, counters):
+        """
+        queue the points of cumulative counters, e.g. from /proc, as a list of (metric, value, tags) with the value as
+        read. with "rates: true" in the config, also queue a "<metric>.rate" point per second since the previous
+        collection, and with "skip_unchanged: true", leave out the counters that didn't change, but every
+        skip_unchanged_max seconds
+        Returns: False if some lines were dropped
+
+        """
+        if self._rate_engine is None:
+            self._emit_rates = self.get_config('rates', 'false').lower() == 'true'
+            if self.get_config('skip_unchanged', 'false').lower() == 'true':
+                self._resend = int(self.get_config('skip_unchanged_max', DEFAULT_RESEND))
+            # without either, there's nothing to keep
+            self._rate_engine = RateEngine() if self._emit_rates or self._resend is not None else False
+        if self._rate_engine is False:
+            return nput_many(self._readq, ["%s %d %s %s" % (metric, ts, value, tags) if tags else
+                                           "%s %d %s" % (metric, ts, value) for metric, value, tags in counters])
+        results = self._rate_engine.update(ts, [(metric, tags) for metric, _, tags in counters],
+                                           [value for _, value, _ in counters], self._resend)
+        lines = []
+        for (metric, value, tags), (delta, rate, send) in zip(counters, results):
+            space = " " if tags else ""
+            if send:
+                lines.append("%s %d %s%s%s" % (metric, ts, value, space, tags))
+            if self._emit_rates and rate is not None:
+                lines.append("%s.rate %d %.3f%s%s" % (metric, ts, rate, space, tags))
+        return nput_many(self._readq, lines)
+
     # below are convenient methods available to all collectors
     def log_info(self, msg, *args, **kwargs):
         if self._logger:
@@ -107,6 +178,48 @@ class CollectorBase(object):
         self._readq.nput("%s %d %s %s metric_type=%s" % (metric_name, self.ts, value, " ".join(tags), MetricType.COUNTER))
 
 
+class LineBatch(object):
+    """ stands for the readq of a collector within a batched block, keeps the lines it's given """
+
+    def __init__(self):
+        self.lines = []
+
+    def nput(self, value):
+        self.lines.append(value)
+        return True
+
+    def nput_many(self, values):
+        self.lines.extend(values)
+        return True
+
+
+def nput_many(readq, lines):
+    """ queue lines at once if readq knows how to, one by one otherwise. Returns False if some were dropped """
+    if hasattr(readq, 'nput_many'):
+        return readq.nput_many(lines)
+    ok = True
+    for line in lines:
+        if readq.nput(line) is False:
+            ok = False
+    return ok
+
+
+@contextmanager
+def batched(collector):
+    """
+    swap the _readq of collector with a LineBatch for the with block, queue what it collected once the block ends,
+    even if it raised
+    """
+    readq = collector._readq
+    batch = collector._readq = LineBatch()
+    try:
+        yield batch
+    finally:
+        collector._readq = readq
+        if batch.lines:
+            nput_many(readq, batch.lines)
+
+
 class MetricType(object):
     COUNTER = 'counter'
     INC = 'increment'
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Tells which files of the collector and config directories changed.
+
+   Rather than listing and stat'ing every file of those directories every
+   so often, the main loops wait on a watcher, which returns the paths
+   that changed as soon as they do.  On Linux the watcher uses inotify,
+   through ctypes since we can't count on pyinotify being installed.
+   Elsewhere it falls back to polling: it sleeps, then tells the caller to
+   rescan everything, like before.  So does the inotify watcher while a
+   directory can't be watched, e.g. it doesn't exist yet."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, then the name
+
+# Once something changed, how long we wait for the rest of the writes.
+SETTLE_TIME = 0.1  # seconds
+# How often we rescan everything anyway, in case we missed an event.
+RESCAN_INTERVAL = 600  # seconds
+
+
+class PollingWatcher(object):
+    """Can't tell what changed: sleeps, then asks for a full rescan."""
+
+    def watch(self, path):
+        pass
+
+    def wait(self, timeout):
+        """Returns the set of paths changed within timeout seconds, or None
+           if the caller should rescan everything."""
+        time.sleep(timeout)
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Watches directories with inotify."""
+
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True)
+        # raises AttributeError where there's no inotify
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}  # watch descriptor -> directory
+        self.wds = {}  # directory -> watch descriptor
+        self.unwatched = set()  # the directories we failed to watch
+        self.last_rescan = time.time()
+
+    def watch(self, path):
+        """Watches the files of a directory, if we don't already."""
+        if path in self.wds:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            if path not in self.unwatched:
+                self.logger.warning('cannot watch %s: %s, rescanning it every '
+                                    'time around', path,
+                                    os.strerror(ctypes.get_errno()))
+                self.unwatched.add(path)
+            return
+        self.unwatched.discard(path)
+        self.dirs[wd] = path
+        self.wds[path] = wd
+
+    def wait(self, timeout):
+        """Returns the set of paths changed within timeout seconds, or None
+           if the caller should rescan everything.  Returns as soon as
+           something changed, once the writes settled."""
+        now = time.time()
+        if self.unwatched:
+            time.sleep(timeout)
+            return None
+        if now - self.last_rescan >= RESCAN_INTERVAL:
+            self.last_rescan = now
+            return None
+        changed = set()
+        end = now + timeout
+        while True:
+            wait = end - time.time()
+            if wait <= 0:
+                break
+            try:
+                readable, _, _ = select.select([self.fd], [], [], wait)
+            except select.error, (err, msg):
+                if err == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                break
+            if not self.read_events(changed):
+                self.last_rescan = time.time()
+                return None
+            end = min(end, time.time() + SETTLE_TIME)
+        return changed
+
+    def read_events(self, changed):
+        """Adds the paths of the pending events to changed.  Returns False
+           if the kernel dropped some of them."""
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError, (err, msg):
+            if err == errno.EAGAIN:
+                return True
+            raise
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip('\0')
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning('inotify queue overflowed, rescanning')
+                return False
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory is gone, it's watched again if it comes back
+                del self.dirs[wd]
+                del self.wds[directory]
+                changed.add(directory)
+            elif name:
+                changed.add(os.path.join(directory, name))
+            else:
+                changed.add(directory)
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(logger=None):
+    """Returns an InotifyWatcher if we can, a PollingWatcher otherwise."""
+    logger = logger or logging.getLogger(__name__)
+    try:
+        return InotifyWatcher(logger)
+    except (AttributeError, OSError), e:
+        logger.info('no inotify (%s), polling the config directories', e)
+        return PollingWatcher()
+
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Parser for the data points collectors print out, in the line format
+   of the TSD telnet interface:
+
+     <metric> <timestamp> <value> [<tagk>=<tagv> ...]
+
+   The timestamp is an integer of at least 2 digits, in milliseconds
+   past MAX_SECONDS_TIMESTAMP; whether it's a reasonable one is up to the
+   reader.  Lines are parsed once by the reader into DataPoint records,
+   which the dedup cache and the senders consume without splitting the
+   line again."""
+
+import re
+from collections import namedtuple
+
+# Limit in net.opentsdb.tsd.PipelineFactory
+MAX_LINE_LENGTH = 1024
+# Timestamps with more digits than this have millisecond precision.
+MAX_SECONDS_TIMESTAMP = 99999999999
+
+_match_line = re.compile(r'([-_./a-zA-Z0-9]+)\s+'  # Metric name.
+                         r'(\d\d+)\s+'             # Timestamp, s or ms.
+                         r'(\S+)'                  # Value (int or float).
+                         r'((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$'  # Tags
+                         ).match
+
+
+_new_tuple = tuple.__new__
+
+
+class DataPoint(namedtuple('DataPoint', 'metric timestamp value tags line')):
+    """A parsed data point.
+
+       metric: The metric name.
+       timestamp: The timestamp, as an int.
+       value: The value, as the string the collector printed.
+       tags: A tuple of "tagk=tagv" strings, in the order they were printed.
+       line: The line the data point was parsed from, or None if it was
+         built by tcollector itself.
+    """
+    __slots__ = ()
+
+    def has_tag(self, tagk):
+        prefix = tagk + '='
+        for tag in self.tags:
+            if tag.startswith(prefix):
+                return True
+        return False
+
+    def tag_dict(self):
+        """Returns the tags as a dict of tagk -> tagv."""
+        return dict(tag.split('=', 1) for tag in self.tags)
+
+    def to_line(self, extra_tags=()):
+        """Returns this data point as a line.
+
+        Args:
+          extra_tags: "tagk=tagv" strings to append, unless this data point
+            already has a tag with the same key.
+        """
+        metric, timestamp, value, tags, line = self
+        if line is None:
+            if tags:
+                line = '%s %d %s %s' % (metric, timestamp, value, ' '.join(tags))
+            else:
+                line = '%s %d %s' % (metric, timestamp, value)
+        for tag in extra_tags:
+            prefix = tag[:tag.index('=') + 1]
+            for own in tags:
+                if own.startswith(prefix):
+                    break
+            else:
+                line += ' ' + tag
+        return line
+
+    def is_millis(self):
+        """Whether the timestamp has millisecond precision."""
+        return self.timestamp > MAX_SECONDS_TIMESTAMP
+
+
+def parse_line(line):
+    """Parses a line printed by a collector.
+
+    Returns: A DataPoint, or None if the line isn't valid.
+    """
+    parsed = _match_line(line)
+    if parsed is None:
+        return None
+    metric, timestamp, value, tags = parsed.groups()
+    # skip the namedtuple constructor, this is called for every single line
+    return _new_tuple(DataPoint, (metric, int(timestamp), value,
+                                  tuple(tags.split()), line))
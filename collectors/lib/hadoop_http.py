@@ -23,6 +23,7 @@ try:
     from collections import OrderedDict  # New in Python 2.7
 except ImportError:
     from ordereddict import OrderedDict  # Can be easy_install'ed for <= 2.6
+from collectors.lib.collectorbase import batched
 from collectors.lib.utils import is_numeric
 
 EXCLUDED_KEYS = (
@@ -158,8 +159,10 @@ class HadoopNode(HadoopHttp):
     def emit(self):
         current_time = int(time.time())
         metrics = self.poll()
-        for context, metric_name, value in metrics:
-            for k, v in self.replacements.iteritems():
-                if any(c.startswith(k) for c in context):
-                    context = v
-            self.emit_metric(context, current_time, metric_name, value)
+        # the hundreds of metrics of the jmx page are queued at once
+        with batched(self):
+            for context, metric_name, value in metrics:
+                for k, v in self.replacements.iteritems():
+                    if any(c.startswith(k) for c in context):
+                        context = v
+                self.emit_metric(context, current_time, metric_name, value)
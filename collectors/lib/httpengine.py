@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Shared engine for the collectors polling REST endpoints.
+
+   A collector hands the engine the whole batch of requests of a
+   collection, e.g. the jobs, stages and executors of every Spark
+   application, and gets their parsed responses back once they're all
+   done.  The requests run concurrently on a pool of threads shared by
+   all the collectors, with at most a few of them at a time against any
+   one endpoint, and every one of them has a timeout, so a slow endpoint
+   costs a collection its timeout rather than that times its number of
+   requests.
+
+   We're on Python 2, without asyncio, hence the threads; they spend
+   their time blocked on sockets, out of the GIL's way.  The connections
+   are kept alive with requests when it's installed, urllib2 opens a new
+   one every time otherwise."""
+
+import json
+import logging
+import threading
+import time
+import urllib2
+import urlparse
+from collections import deque
+from Queue import Queue
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+DEFAULT_WORKERS = 16
+# How many requests may run at the same time against one host:port.
+DEFAULT_PER_ENDPOINT = 4
+DEFAULT_TIMEOUT = 10  # seconds
+
+_PENDING = object()
+
+
+class HTTPEngineError(RuntimeError):
+    """A request failed: error response, timeout, invalid JSON..."""
+
+    def __init__(self, url, msg, status=None):
+        RuntimeError.__init__(self, '%s: %s' % (url, msg))
+        self.url = url
+        self.status = status
+
+
+class Request(object):
+    """A GET request for the engine."""
+
+    def __init__(self, url, headers=None, parse='json', timeout=None):
+        """Constructor.
+
+        Args:
+          url: What to get.
+          headers: A dict of extra headers.
+          parse: 'json' to return the parsed JSON of the response, 'text'
+            to return its body as is.
+          timeout: Seconds to connect, and to wait for data, defaults to
+            the engine's.
+        """
+        self.url = url
+        self.headers = headers
+        self.parse = parse
+        self.timeout = timeout
+        self.endpoint = urlparse.urlparse(url).netloc
+
+
+class Batch(object):
+    """The results of a fetch, filled in by the workers."""
+
+    def __init__(self, count):
+        self.results = [_PENDING] * count
+        self.remaining = count
+        self.cond = threading.Condition()
+
+    def set(self, index, result):
+        with self.cond:
+            self.results[index] = result
+            self.remaining -= 1
+            if not self.remaining:
+                self.cond.notify_all()
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.remaining:
+                if deadline is None:
+                    self.cond.wait()
+                    continue
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+            return list(self.results)
+
+
+class HTTPEngine(object):
+    """Runs batches of requests on a shared pool of threads."""
+
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 per_endpoint=DEFAULT_PER_ENDPOINT, timeout=DEFAULT_TIMEOUT,
+                 logger=None):
+        self.workers = workers
+        self.per_endpoint = per_endpoint
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.active = {}  # endpoint -> how many of its requests are running
+        self.waiting = {}  # endpoint -> deque of (Request, Batch, index)
+        self.runq = Queue()
+        self.local = threading.local()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for i in xrange(self.workers):
+            worker = threading.Thread(target=self.work,
+                                      name='http-engine-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def fetch(self, reqs, deadline=None):
+        """Runs requests concurrently.
+
+        Args:
+          reqs: A list of Requests.
+          deadline: If given, how many seconds we wait for the whole
+            batch, the requests still running then count as failed.
+
+        Returns:
+          The result of each request, in order: the parsed JSON or body of
+          the response, or the HTTPEngineError it failed with.
+        """
+        self.start()
+        batch = Batch(len(reqs))
+        with self.lock:
+            for index, request in enumerate(reqs):
+                self.submit((request, batch, index))
+        results = batch.wait(deadline)
+        for index, result in enumerate(results):
+            if result is _PENDING:
+                results[index] = HTTPEngineError(reqs[index].url,
+                                                 'no response in time')
+        return results
+
+    def get_json(self, urls, headers=None, timeout=None, deadline=None):
+        """fetch() for a list of URLs returning JSON."""
+        return self.fetch([Request(url, headers, 'json', timeout)
+                           for url in urls], deadline)
+
+    def submit(self, item):
+        """Runs item now, or once its endpoint has room, with lock held."""
+        endpoint = item[0].endpoint
+        if self.active.get(endpoint, 0) < self.per_endpoint:
+            self.active[endpoint] = self.active.get(endpoint, 0) + 1
+            self.runq.put(item)
+        else:
+            self.waiting.setdefault(endpoint, deque()).append(item)
+
+    def done(self, endpoint):
+        """Starts the next request waiting for endpoint, if any."""
+        with self.lock:
+            waiting = self.waiting.get(endpoint)
+            if waiting:
+                self.runq.put(waiting.popleft())
+                if not waiting:
+                    del self.waiting[endpoint]
+            else:
+                self.active[endpoint] -= 1
+                if not self.active[endpoint]:
+                    del self.active[endpoint]
+
+    def work(self):
+        """Main loop of the worker threads."""
+        while True:
+            request, batch, index = self.runq.get()
+            try:
+                result = self.perform(request)
+            except HTTPEngineError, e:
+                result = e
+            except Exception, e:
+                result = HTTPEngineError(request.url, e)
+            self.done(request.endpoint)
+            batch.set(index, result)
+
+    def perform(self, request):
+        """Runs a request, returns its result, raises HTTPEngineError."""
+        timeout = request.timeout or self.timeout
+        if requests is not None:
+            session = getattr(self.local, 'session', None)
+            if session is None:
+                session = self.local.session = requests.Session()
+            resp = session.get(request.url, headers=request.headers,
+                               timeout=timeout)
+            status, body = resp.status_code, resp.content
+        else:
+            try:
+                resp = urllib2.urlopen(urllib2.Request(request.url,
+                                                       headers=request.headers or {}),
+                                       timeout=timeout)
+                status, body = resp.getcode(), resp.read()
+            except urllib2.HTTPError, e:
+                status, body = e.code, None
+        if status != 200:
+            raise HTTPEngineError(request.url, 'HTTP status %d' % status,
+                                  status)
+        if request.parse == 'json':
+            try:
+                return json.loads(body)
+            except ValueError, e:
+                raise HTTPEngineError(request.url, 'invalid JSON: %s' % e,
+                                      status)
+        return body
+
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine():
+    """Returns the engine shared by all the collectors."""
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = HTTPEngine()
+        return _ENGINE
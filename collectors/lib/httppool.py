@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Keep-alive HTTP connections to the TSDs, for the /api/put senders.
+
+   urllib2 opens a new connection, and does a new TLS handshake, for every
+   single request.  HTTPConnectionPool keeps the connections to each TSD
+   open between requests instead, with a single SSL context for all of
+   them, and can compress the request bodies.
+
+   Errors are reported the way urllib2 reports them, as HTTPError for
+   error responses and URLError for everything else, so the senders handle
+   them as they always did."""
+
+import errno
+import httplib
+import socket
+import ssl
+import threading
+import urllib2
+import zlib
+from StringIO import StringIO
+
+COMPRESSIONS = ('none', 'gzip', 'deflate')
+# Window bits making zlib write the gzip wrapper instead of the zlib one.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def compress(body, compression, level=6):
+    """Returns body compressed with the given Content-Encoding."""
+    if compression == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if compression == 'deflate':
+        # HTTP's deflate is the zlib format, not raw deflate.
+        return zlib.compress(body, level)
+    return body
+
+
+def stale_connection(error):
+    """Whether a request on a kept-alive connection failed because the
+       server closed it meanwhile, rather than because of the server."""
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return (isinstance(error, socket.error)
+            and error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+def unverified_ssl_context():
+    """Returns an SSL context that doesn't check the TSD certificates."""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class HTTPConnectionPool(object):
+    """Keep-alive connections to HTTP servers, by (host, port)."""
+
+    def __init__(self, use_ssl=False, timeout=15, maxsize=2,
+                 compression='none', ssl_context=None):
+        """Constructor.
+
+        Args:
+          use_ssl: Whether to talk HTTPS.
+          timeout: Socket timeout of the connections, in seconds.
+          maxsize: How many idle connections to keep per server.
+          compression: The Content-Encoding of the request bodies, one of
+            COMPRESSIONS.
+          ssl_context: The SSL context to use for every connection,
+            defaults to one checking the server certificates.
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError('unknown compression %r' % compression)
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.compression = compression
+        if use_ssl and ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        self.ssl_context = ssl_context
+        self.idle = {}  # (host, port) -> idle connections, last used last.
+        self.lock = threading.Lock()
+        # Counters for our own stats.
+        self.requests = 0
+        self.connections_opened = 0
+        self.bytes_sent = 0  # Request bodies, after compression.
+        self.bytes_uncompressed = 0
+
+    def url(self, host, port, path):
+        return '%s://%s:%d%s' % ('https' if self.use_ssl else 'http',
+                                 host, port, path)
+
+    def new_connection(self, host, port):
+        self.connections_opened += 1
+        if self.use_ssl:
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout,
+                                           context=self.ssl_context)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def get_connection(self, host, port):
+        """Returns (connection, whether it was used before)."""
+        with self.lock:
+            idle = self.idle.get((host, port))
+            if idle:
+                return idle.pop(), True
+        return self.new_connection(host, port), False
+
+    def put_connection(self, host, port, conn):
+        with self.lock:
+            idle = self.idle.setdefault((host, port), [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def post(self, host, port, path, body, headers=None):
+        """POSTs body to the server, returns the body of its response.
+
+        Raises:
+          urllib2.HTTPError: The server answered with an error status.
+          urllib2.URLError: We couldn't get an answer from the server.
+        """
+        headers = dict(headers or {})
+        self.bytes_uncompressed += len(body)
+        if self.compression != 'none':
+            body = compress(body, self.compression)
+            headers['Content-Encoding'] = self.compression
+        self.bytes_sent += len(body)
+        self.requests += 1
+
+        while True:
+            conn, reused = self.get_connection(host, port)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    # don't let Nagle hold back the last bit of a request
+                    # while the server delays its ACKs
+                    conn.sock.setsockopt(socket.IPPROTO_TCP,
+                                         socket.TCP_NODELAY, 1)
+                conn.request('POST', path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                # The server may have closed a connection we kept idle for
+                # a while, retry once with a new one.  Anything else, like a
+                # timeout, the server may well have got the request: leave
+                # it to the caller rather than POST it twice.
+                if reused and stale_connection(e):
+                    continue
+                raise urllib2.URLError(e)
+        if response.will_close:
+            conn.close()
+        else:
+            self.put_connection(host, port, conn)
+        if response.status >= 400:
+            raise urllib2.HTTPError(self.url(host, port, path),
+                                    response.status, response.reason,
+                                    response.msg, StringIO(data))
+        return data
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
@@ -6,6 +6,9 @@ from inc_processor import IncPorcessor
 from collectorbase import CollectorBase
 from collectorbase import MetricType
 
+# seconds, so that a hung JVM doesn't stall the collector
+DEFAULT_TIMEOUT = 10
+
 
 class JolokiaParserBase(object):
     def __init__(self, logger):
@@ -118,12 +121,13 @@ class JolokiaCollector(CollectorBase):
         self.port = port
         self.request_str = request_str
         self.parser_map = parser_map
+        self.timeout = float(self.get_config('timeout', DEFAULT_TIMEOUT))
 
     def __call__(self):
         conn = None
         try:
             req = urllib2.Request(self.url, self.request_str, {'Content-Type': 'application/json'})
-            conn = urllib2.urlopen(req)
+            conn = urllib2.urlopen(req, timeout=self.timeout)
             status_code = conn.getcode()
             if status_code != 200:
                 self.log_error("failed to query jolokia endpoint of tomcat. return code %d", status_code)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Runs a collector of the runner in a process of its own.
+
+   The collectors of the runner share its interpreter, so the CPU-heavy
+   ones hold the GIL against everything else, the sender included.  A
+   ProcessCollector stands for such a collector in the runner: it keeps the
+   collector in a child process, asks it to collect over a pipe, and puts
+   the lines it sends back, in batches, into the runner's queue.  Unlike a
+   collector running on a thread, one stuck in its process can be
+   interrupted, by killing the process."""
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import traceback
+
+from collectors.lib.collectorbase import nput_many
+
+# How many lines the child sends back at once.
+BATCH_SIZE = 1000
+# How long the child has to clean up and exit once asked to.
+EXIT_TIMEOUT = 10  # seconds
+
+
+class PipeQueue(object):
+    """What the collector gets as its readq in the child process."""
+
+    def __init__(self, conn, batch_size=BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.batch = []
+
+    def nput(self, value):
+        self.batch.append(value)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return True
+
+    def nput_many(self, values):
+        self.batch.extend(values)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+        return True
+
+    def flush(self):
+        if self.batch:
+            self.conn.send(('lines', self.batch))
+            self.batch = []
+
+
+def reset_logging_locks():
+    """Replaces the locks of the logging module and of its handlers.
+
+       We are forked from the runner while its other threads log, and the
+       locks one of them held at the time stay held forever in the child:
+       logging doesn't reinitialize them after a fork in Python 2."""
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler is not None:
+            handler.createLock()
+
+
+def child_main(conn, collector_class, config, logger):
+    """Main loop of the child process: collects each time it's asked to,
+       until it's asked to exit."""
+    reset_logging_locks()
+    # we inherited the handlers of the runner, which handles ^C by itself
+    # and tells us to stop with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    readq = PipeQueue(conn)
+    instance = collector_class(config, logger, readq)
+    signal.signal(signal.SIGTERM, lambda signum, frame: instance.signal_exit())
+    while True:
+        try:
+            command = conn.recv()
+        except EOFError:  # the runner is gone
+            command = 'exit'
+        if command == 'exit':
+            instance.signal_exit()
+            instance.cleanup()
+            return
+        _, tick = command
+        if tick is not None and hasattr(instance, 'set_tick'):
+            instance.set_tick(tick)
+        error = None
+        start = os.times()
+        try:
+            instance()
+        except:
+            error = traceback.format_exc()
+        readq.flush()
+        end = os.times()
+        cpu = (end[0] - start[0]) + (end[1] - start[1])
+        conn.send(('done', (error, cpu)))
+
+
+class ProcessCollector(object):
+    """A collector running in a child process, called like the collector
+       itself by the runner.
+
+       The child is started right away and restarted if it dies.
+       signal_exit() and cleanup() are forwarded to the collector in the
+       child.  After a collection, child_cpu is how many CPU seconds it
+       took the child."""
+
+    def __init__(self, name, collector_class, config, logger, readq):
+        self.name = name
+        self.collector_class = collector_class
+        self.config = config
+        self.logger = logger or logging.getLogger(__name__)
+        self.readq = readq
+        self.process = None
+        self.conn = None
+        self.tick = None
+        self.child_cpu = None
+        self.lost = False
+        self._exit = False
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=child_main, name='collector-%s' % self.name,
+            args=(child_conn, self.collector_class, self.config, self.logger))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.logger.info('started process %d for collector %s',
+                         self.process.pid, self.name)
+
+    def __call__(self):
+        if self.lost or not self.process.is_alive():
+            self.logger.error('process of collector %s died with status %s, '
+                              'restarting it', self.name,
+                              self.process.exitcode)
+            self.stop()
+            self.start()
+            self.lost = False
+        self.child_cpu = None
+        try:
+            self.conn.send(('collect', self.tick))
+            while True:
+                kind, payload = self.conn.recv()
+                if kind == 'lines':
+                    nput_many(self.readq, payload)
+                    continue
+                error, self.child_cpu = payload
+                if error is not None:
+                    self.logger.error('collector %s failed in process %d:\n%s',
+                                      self.name, self.process.pid, error)
+                return
+        except (EOFError, IOError), e:
+            # we restart it the next time around, it may not look dead yet
+            self.lost = True
+            self.logger.error('lost the process of collector %s: %s',
+                              self.name, e)
+
+    def interrupt(self):
+        """Kills the child in the middle of a collection, which is lost.
+           It's restarted the next time around."""
+        process = self.process
+        if process is not None and process.is_alive():
+            self.logger.warning('killing process %d of collector %s',
+                                process.pid, self.name)
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def set_tick(self, tick):
+        self.tick = tick
+
+    def signal_exit(self):
+        self._exit = True
+        if self.process is not None and self.process.is_alive():
+            try:
+                os.kill(self.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def cleanup(self):
+        self.stop()
+
+    def stop(self):
+        """Asks the child to clean up and exit, kills it if it doesn't."""
+        if self.process is None:
+            return
+        try:
+            self.conn.send('exit')
+        except (EOFError, IOError):
+            pass
+        self.process.join(EXIT_TIMEOUT)
+        if self.process.is_alive():
+            self.logger.error('process %d of collector %s did not exit, '
+                              'killing it', self.process.pid, self.name)
+            # SIGTERM only sets the exit flag of the collector
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.join()
+        self.conn.close()
+        self.process = None
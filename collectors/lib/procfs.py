@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Snapshots of /proc shared by the system collectors of the runner.
+
+   Several collectors read the same procfs files, /proc/stat, /proc/uptime
+   or the stat file of a process, every time around.  Rather than each of
+   them opening and parsing those, they ask for the snapshot of their tick,
+   snapshot(self._tick), which reads a file the first time one of them asks
+   for it and parses it the first time one of them asks for a given view of
+   it.  The others get the same content and the same views, which are
+   immutable: tuples, namedtuples and FrozenDicts.
+
+   The files of the system are kept open and read again into a buffer of
+   their own, without allocating a file object or a buffer every time.
+   The files of the processes come and go with them, they're opened every
+   time.
+
+   The snapshot also walks the processes for the collectors watching them,
+   once per tick, in place of each of them forking ps or pgrep: processes()
+   has their command line, memory, start time and CPU usage since the
+   previous walk."""
+
+import errno
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+
+# How many snapshots we keep, the collectors of a tick may run a while.
+MAX_SNAPSHOTS = 4
+# What we start reading a file into, it grows as needed.
+INITIAL_SIZE = 4096
+HZ = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# /proc/stat, the times in clock ticks
+ProcStat = namedtuple('ProcStat', 'cpu cpus intr ctxt btime processes '
+                                  'procs_running procs_blocked')
+# /proc/uptime, in seconds
+Uptime = namedtuple('Uptime', 'total idle')
+# /proc/loadavg
+LoadAvg = namedtuple('LoadAvg', 'avg1 avg5 avg15 runnable threads last_pid')
+# /proc/<pid>/stat, the times in clock ticks, vsize in bytes, rss in pages
+PidStat = namedtuple('PidStat', 'pid comm state ppid utime stime cutime '
+                                'cstime starttime vsize rss guest_time '
+                                'cguest_time')
+# a line of /proc/diskstats
+DiskStats = namedtuple('DiskStats', 'major minor device stats')
+# a process as processes() sees it: pcpu is the percentage of a CPU it used
+# since the previous walk, rss and vsize are in bytes, pmem is the
+# percentage of the memory it uses, start_time is in seconds since the epoch
+Process = namedtuple('Process', 'pid comm cmdline state ppid pcpu rss pmem '
+                                'vsize start_time')
+
+
+class FrozenDict(dict):
+    """A dict that can't be changed once built."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % type(self).__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _immutable
+
+
+class ProcFile(object):
+    """A procfs file read with readinto() into a buffer we keep."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = io.FileIO(path, 'r')  # raises IOError
+        self.buf = bytearray(INITIAL_SIZE)
+        self.lock = threading.Lock()
+
+    def read(self):
+        """Returns the current content of the file."""
+        with self.lock:
+            self.file.seek(0)
+            size = 0
+            while True:
+                if size == len(self.buf):
+                    self.buf.extend(bytearray(len(self.buf)))
+                view = memoryview(self.buf)[size:]
+                count = self.file.readinto(view)
+                del view  # else the buffer can't grow
+                if not count:
+                    break
+                size += count
+            return str(self.buf[:size])
+
+    def close(self):
+        self.file.close()
+
+
+_FILES = {}  # path -> ProcFile, for the files of the system
+_FILES_LOCK = threading.Lock()
+
+
+def is_pid_path(path):
+    """Whether path is a file of a process, which we don't keep open."""
+    parts = path.split('/', 3)
+    return len(parts) > 2 and parts[1] == 'proc' and parts[2].isdigit()
+
+
+def read_once(path):
+    """Returns the content of a file we don't keep open, raises OSError."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, INITIAL_SIZE)
+            if not chunk:
+                return ''.join(chunks)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+
+def read_file(path):
+    """Returns the content of a procfs file, raises EnvironmentError."""
+    if is_pid_path(path):
+        return read_once(path)
+    with _FILES_LOCK:
+        procfile = _FILES.get(path)
+        if procfile is None:
+            procfile = _FILES[path] = ProcFile(path)
+    return procfile.read()
+
+
+def parse_lines(content):
+    return tuple(content.splitlines())
+
+
+def parse_stat(content):
+    cpu, cpus, values = (), [], {}
+    for line in content.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'cpu':
+            cpu = tuple(int(field) for field in fields[1:])
+        elif fields[0].startswith('cpu'):
+            cpus.append((int(fields[0][3:]),
+                         tuple(int(field) for field in fields[1:])))
+        elif fields[0] == 'intr':
+            values['intr'] = int(fields[1])
+        elif fields[0] in ('ctxt', 'btime', 'processes', 'procs_running',
+                           'procs_blocked'):
+            values[fields[0]] = int(fields[1])
+    return ProcStat(cpu, tuple(cpus), values.get('intr'), values.get('ctxt'),
+                    values.get('btime'), values.get('processes'),
+                    values.get('procs_running'), values.get('procs_blocked'))
+
+
+def parse_uptime(content):
+    total, idle = content.split()[:2]
+    return Uptime(float(total), float(idle))
+
+
+def parse_loadavg(content):
+    avg1, avg5, avg15, threads, last_pid = content.split()[:5]
+    runnable, total = threads.split('/')
+    return LoadAvg(float(avg1), float(avg5), float(avg15), int(runnable),
+                   int(total), int(last_pid))
+
+
+def parse_key_values(content):
+    """For "key: value [unit]" files like /proc/meminfo or /proc/<pid>/io,
+       the values in their unit."""
+    values = {}
+    for line in content.splitlines():
+        key, sep, value = line.partition(':')
+        if not sep:
+            continue
+        fields = value.split()
+        if fields and fields[0].isdigit():
+            values[key.strip()] = int(fields[0])
+    return FrozenDict(values)
+
+
+def parse_diskstats(content):
+    disks = []
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        disks.append(DiskStats(int(fields[0]), int(fields[1]), fields[2],
+                               tuple(map(int, fields[3:]))))
+    return tuple(disks)
+
+
+def parse_pid_stat(content):
+    # the name of the command may hold spaces and parentheses
+    start, end = content.index('('), content.rindex(')')
+    pid, comm, rest = int(content[:start]), content[start + 1:end], \
+        content[end + 2:].split()
+    # rest starts at the 3rd field of proc(5)
+    guest = (int(rest[40]), int(rest[41])) if len(rest) > 41 else (0, 0)
+    return PidStat(pid, comm, rest[0], int(rest[1]), int(rest[11]),
+                   int(rest[12]), int(rest[13]), int(rest[14]), int(rest[19]),
+                   int(rest[20]), int(rest[21]), guest[0], guest[1])
+
+
+def parse_cmdline(content):
+    """The arguments of a process, separated by spaces like ps does."""
+    return content.rstrip('\0').replace('\0', ' ')
+
+
+def parse_dirty(content):
+    """The dirty pages of /proc/<pid>/smaps or smaps_rollup, in kB."""
+    dirty = 0
+    for line in content.splitlines():
+        if line.startswith(('Shared_Dirty:', 'Private_Dirty:')):
+            dirty += int(line.split()[1])
+    return dirty
+
+
+_LAST_WALK = (0.0, {})  # uptime of the last walk, pid -> (start, CPU ticks)
+_WALK_LOCK = threading.Lock()
+
+
+def walk_processes(snap):
+    """Walks /proc for the Process of every process.  Their CPU usage is
+       since the previous walk, or since they started for the processes we
+       didn't see then."""
+    global _LAST_WALK
+    uptime, stat = snap.uptime(), snap.stat()
+    if uptime is None or stat is None:
+        return ()
+    mem_total = (snap.meminfo() or {}).get('MemTotal', 0) * 1024
+    with _WALK_LOCK:
+        last_uptime, last_ticks = _LAST_WALK
+    interval = (uptime.total - last_uptime) * HZ
+    ticks = {}
+    processes = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            pstat = parse_pid_stat(read_once('/proc/%s/stat' % name))
+            cmdline = parse_cmdline(read_once('/proc/%s/cmdline' % name))
+        except (EnvironmentError, ValueError, IndexError):
+            continue  # gone meanwhile
+        used = pstat.utime + pstat.stime
+        ticks[pstat.pid] = (pstat.starttime, used)
+        last = last_ticks.get(pstat.pid)
+        if last is not None and last[0] == pstat.starttime and interval > 0:
+            pcpu = 100.0 * (used - last[1]) / interval
+        else:
+            lifetime = uptime.total * HZ - pstat.starttime
+            pcpu = 100.0 * used / lifetime if lifetime > 0 else 0.0
+        rss = pstat.rss * PAGE_SIZE
+        processes.append(Process(
+            pstat.pid, pstat.comm, cmdline or '[%s]' % pstat.comm, pstat.state,
+            pstat.ppid, pcpu, rss, 100.0 * rss / mem_total if mem_total else 0.0,
+            pstat.vsize, (stat.btime or 0) + pstat.starttime / HZ))
+    with _WALK_LOCK:
+        if uptime.total > _LAST_WALK[0]:
+            _LAST_WALK = (uptime.total, ticks)
+    return tuple(processes)
+
+
+class Snapshot(object):
+    """What /proc says at a tick, read and parsed once, on demand."""
+
+    def __init__(self, tick):
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.contents = {}  # path -> content, None if it can't be read
+        self.views = {}  # (path, parser) -> view, None if it can't be read
+        self.walk_lock = threading.Lock()
+        self.walk = None  # what processes() returns
+
+    def read(self, path):
+        """Returns the content of a procfs file, or None if it can't be
+           read, e.g. its process is gone."""
+        with self.lock:
+            if path in self.contents:
+                return self.contents[path]
+            try:
+                content = read_file(path)
+            except EnvironmentError, e:
+                if e.errno not in (errno.ENOENT, errno.ESRCH, errno.EACCES):
+                    raise
+                content = None
+            self.contents[path] = content
+            return content
+
+    def view(self, path, parser):
+        """Returns parser(content of path), or None if it can't be read or
+           parsed."""
+        key = (path, parser)
+        with self.lock:
+            if key in self.views:
+                return self.views[key]
+        content = self.read(path)
+        try:
+            view = parser(content) if content is not None else None
+        except (ValueError, IndexError):
+            view = None
+        with self.lock:
+            return self.views.setdefault(key, view)
+
+    def lines(self, path):
+        """Returns the lines of a procfs file, () if it can't be read."""
+        return self.view(path, parse_lines) or ()
+
+    def stat(self):
+        return self.view('/proc/stat', parse_stat)
+
+    def uptime(self):
+        return self.view('/proc/uptime', parse_uptime)
+
+    def loadavg(self):
+        return self.view('/proc/loadavg', parse_loadavg)
+
+    def meminfo(self):
+        """The sizes of /proc/meminfo, in kB for most of them."""
+        return self.view('/proc/meminfo', parse_key_values)
+
+    def diskstats(self):
+        return self.view('/proc/diskstats', parse_diskstats)
+
+    def pid_stat(self, pid):
+        return self.view('/proc/%d/stat' % pid, parse_pid_stat)
+
+    def pid_io(self, pid):
+        return self.view('/proc/%d/io' % pid, parse_key_values)
+
+    def pid_dirty(self, pid):
+        """The dirty pages of a process in kB, like pmap -x."""
+        dirty = self.view('/proc/%d/smaps_rollup' % pid, parse_dirty)
+        if dirty is None:  # before Linux 4.14
+            dirty = self.view('/proc/%d/smaps' % pid, parse_dirty)
+        return dirty
+
+    def processes(self):
+        """Returns a tuple of the Process of every process."""
+        with self.walk_lock:
+            if self.walk is None:
+                self.walk = walk_processes(self)
+            return self.walk
+
+
+_SNAPSHOTS = {}  # tick -> Snapshot
+_SNAPSHOTS_LOCK = threading.Lock()
+
+
+def snapshot(tick=None):
+    """Returns the snapshot of a tick, the current second by default.  The
+       collectors due at the same second share it."""
+    tick = int(tick if tick is not None else time.time())
+    with _SNAPSHOTS_LOCK:
+        snap = _SNAPSHOTS.get(tick)
+        if snap is None:
+            snap = _SNAPSHOTS[tick] = Snapshot(tick)
+            if len(_SNAPSHOTS) > MAX_SNAPSHOTS:
+                del _SNAPSHOTS[min(_SNAPSHOTS)]
+        return snap
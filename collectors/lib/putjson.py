@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Streaming JSON encoder for the body of /api/put requests.
+
+   Rather than building a dict per data point and running json.dumps over
+   the whole list, PutEncoder writes the JSON of each data point straight
+   from its fields into a buffer reused from one batch to the next.  The
+   tags added to every data point are encoded once and for all."""
+
+import json
+import logging
+
+_encode_string = json.encoder.encode_basestring_ascii
+_INF = float('inf')
+
+# The encoded names and tags we remember, beyond that the cache is reset.
+MAX_CACHED_STRINGS = 100000
+
+
+def is_json_integer(value):
+    """Whether a string of digits is already a valid JSON integer."""
+    return value.isdigit() and (value[0] != '0' or len(value) == 1)
+
+
+def encode_value(value):
+    """Returns the JSON of a value printed by a collector: an integer if it
+       is one, a float otherwise.  Raises ValueError if it's neither."""
+    if is_json_integer(value):
+        return value
+    try:
+        return '%d' % long(value)
+    except ValueError:
+        pass
+    value = float(value)
+    if value != value or value in (_INF, -_INF):
+        # NaN and Infinity, which json.dumps writes in its own way
+        return json.dumps(value)
+    return repr(value)
+
+
+class PutEncoder(object):
+    """Encodes data points into the JSON array /api/put expects."""
+
+    def __init__(self, tags, maxtags=8, logger=None):
+        """Constructor.
+
+        Args:
+          tags: A dict of tags to add to every data point.  The tags of a
+            data point win over them.
+          maxtags: The maximum number of tags of a data point, extra tags
+            of the data point itself are removed.
+          logger: Where to log the data points we have to fix or skip.
+        """
+        self.tags = dict(tags)
+        self.maxtags = maxtags
+        self.logger = logger or logging.getLogger(__name__)
+        # "tagk":"tagv" of each of our tags, and all of them joined.
+        self.tag_fragments = [(tagk, '%s:%s' % (_encode_string(tagk),
+                                                _encode_string(tagv)))
+                              for tagk, tagv in sorted(self.tags.iteritems())]
+        self.all_tags = ','.join(fragment for _, fragment in self.tag_fragments)
+        self.strings = {}  # name -> its JSON string
+        self.tag_cache = {}  # "tagk=tagv" -> '"tagk":"tagv"'
+        self.buf = []
+        self.invalid = 0
+
+    def string(self, value):
+        """Returns the JSON of a metric name or tag, cached."""
+        encoded = self.strings.get(value)
+        if encoded is None:
+            if len(self.strings) >= MAX_CACHED_STRINGS:
+                self.strings.clear()
+            encoded = self.strings[value] = _encode_string(value)
+        return encoded
+
+    def encode_point(self, metric, timestamp, value, tags):
+        """Returns the JSON object of a data point.
+
+        Args:
+          metric: The metric name.
+          timestamp: The timestamp, an int or a string of digits.
+          value: The value, as printed by the collector.
+          tags: A sequence of "tagk=tagv" strings.
+
+        Raises:
+          ValueError: The data point can't be encoded.
+        """
+        tag_cache = self.tag_cache
+        if len(tags) + len(self.tags) > self.maxtags:
+            kept = tags[:max(self.maxtags - len(self.tags), 0)]
+            self.logger.error('Exceeding maximum permitted metric tags - '
+                              'removing %s for metric %s',
+                              str(tags[len(kept):]), metric)
+            tags = kept
+        own = []
+        overridden = None
+        for tag in tags:
+            encoded = tag_cache.get(tag)
+            if encoded is None:
+                tagk, tagv = tag.split('=', 1)
+                if len(tag_cache) >= MAX_CACHED_STRINGS:
+                    tag_cache.clear()
+                encoded = '%s:%s' % (self.string(tagk), self.string(tagv))
+                tag_cache[tag] = encoded
+            else:
+                tagk = tag[:tag.index('=')]
+            if tagk in self.tags:
+                if overridden is None:
+                    overridden = set()
+                overridden.add(tagk)
+            own.append(encoded)
+        if overridden is None:
+            common = self.all_tags
+        else:
+            common = ','.join(fragment for tagk, fragment in self.tag_fragments
+                              if tagk not in overridden)
+        if common and own:
+            own.append(common)
+            encoded_tags = ','.join(own)
+        else:
+            encoded_tags = common or ','.join(own)
+        if not (isinstance(timestamp, str) and is_json_integer(timestamp)):
+            timestamp = '%d' % long(timestamp)
+        metric = self.strings.get(metric) or self.string(metric)
+        return ('{"metric":%s,"timestamp":%s,"value":%s,"tags":{%s}}'
+                % (metric, timestamp, encode_value(value), encoded_tags))
+
+    def encode_lines(self, lines, prefix='[', suffix=']'):
+        """Returns the JSON of a batch of "<metric> <timestamp> <value>
+           [tags]" lines, between prefix and suffix.  Invalid lines are
+           logged and skipped."""
+        buf = self.buf
+        del buf[:]
+        buf.append(prefix)
+        encode_point = self.encode_point
+        for line in lines:
+            parts = line.split()
+            try:
+                buf.append(encode_point(parts[0], parts[1], parts[2],
+                                        parts[3:]))
+            except (IndexError, ValueError):
+                self.invalid += 1
+                self.logger.error('skipping badly formatted data point: %s',
+                                  line)
+                continue
+            buf.append(',')
+        return self.finish(suffix)
+
+    def encode_datapoints(self, datapoints, prefix='[', suffix=']'):
+        """Same as encode_lines, for DataPoints."""
+        buf = self.buf
+        del buf[:]
+        buf.append(prefix)
+        encode_point = self.encode_point
+        for dp in datapoints:
+            try:
+                buf.append(encode_point(dp.metric, dp.timestamp, dp.value,
+                                        dp.tags))
+            except ValueError:
+                self.invalid += 1
+                self.logger.error('skipping badly formatted data point: %s',
+                                  dp.to_line())
+                continue
+            buf.append(',')
+        return self.finish(suffix)
+
+    def finish(self, suffix):
+        buf = self.buf
+        if buf[-1] == ',':
+            buf[-1] = suffix
+        else:
+            buf.append(suffix)
+        result = ''.join(buf)
+        del buf[:]
+        return result
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Turns cumulative counters into deltas and rates.
+
+   Most of what the system collectors read from /proc only ever goes up:
+   bytes sent, pages swapped in, interrupts served...  A RateEngine keeps
+   the previous sample of every series of a collector, and turns the
+   samples of a whole collection into deltas and rates at once.
+
+   The series are given a stable index the first time they're seen, and
+   their previous value and timestamp are held in array('d') columns at
+   that index, rather than in an object or dict entry per series.  When a
+   counter goes down, it either wrapped around, if it was close to the
+   top of its 32 or 64 bits and is now close to 0, or it was reset, e.g.
+   the interface was recreated, in which case there's no delta until the
+   next sample.  The values are doubles: exact up to 2**53."""
+
+from array import array
+
+# The widths of the counters we know of, in bits, narrowest first.
+WIDTHS = (32, 64)
+# A counter that went down wrapped if it was within that fraction of its
+# width from the top, and is now within it from 0.
+WRAP_MARGIN = 0.25
+# How often we forget about the series we haven't seen for that long.
+EXPIRE_AGE = 3600  # seconds
+
+NAN = float('nan')
+
+
+class RateEngine(object):
+    """The previous samples of the counters of a collector."""
+
+    def __init__(self):
+        self.index = {}  # series -> index in the columns
+        self.values = array('d')  # the previous value of each series
+        self.times = array('d')  # when it was sampled
+        self.sent = array('d')  # when the series was last sent
+        self.expired = None  # when we last forgot about the old series
+
+    def update(self, ts, keys, values, resend=None):
+        """Records the samples of a collection.
+
+        Args:
+          ts: When they were sampled, in seconds.
+          keys: The series of each sample, any hashable.
+          values: Their values, numbers or strings of numbers.
+          resend: If given, a series that didn't change is sent only if
+            it wasn't within that many seconds.
+
+        Returns:
+          A (delta, rate, send) tuple for each sample, in order.  delta
+          and rate are None for the first sample of a series, after a
+          reset, or if no time went by.  send is False for the samples
+          not worth sending, see resend.
+        """
+        index, prev_values, prev_times, sent = (self.index, self.values,
+                                                self.times, self.sent)
+        results = []
+        for key, value in zip(keys, values):
+            value = float(value)
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(prev_values)
+                prev_values.append(NAN)
+                prev_times.append(NAN)
+                sent.append(NAN)
+            prev = prev_values[i]
+            elapsed = ts - prev_times[i]
+            if prev != prev:  # NaN: first sample
+                delta = None
+            elif value >= prev:
+                delta = value - prev
+            else:
+                delta = wrapped(prev, value)
+            rate = delta / elapsed if delta is not None and elapsed > 0 else None
+            send = (resend is None or delta != 0 or not ts - sent[i] < resend)
+            if send:
+                sent[i] = ts
+            prev_values[i] = value
+            prev_times[i] = ts
+            results.append((delta, rate, send))
+        if self.expired is None:
+            self.expired = ts
+        elif ts - self.expired >= EXPIRE_AGE:
+            self.expire(ts - EXPIRE_AGE)
+        return results
+
+    def expire(self, before):
+        """Forgets about the series last sampled before then."""
+        self.expired = before + EXPIRE_AGE
+        kept = [(key, i) for key, i in self.index.iteritems()
+                if self.times[i] >= before]
+        if len(kept) == len(self.index):
+            return
+        kept.sort(key=lambda item: item[1])
+        self.index = dict((key, new) for new, (key, _) in enumerate(kept))
+        self.values = array('d', [self.values[i] for _, i in kept])
+        self.times = array('d', [self.times[i] for _, i in kept])
+        self.sent = array('d', [self.sent[i] for _, i in kept])
+
+    def __len__(self):
+        return len(self.index)
+
+
+def wrapped(prev, value):
+    """The delta of a counter that went down from prev to value: how much
+       it went up if it wrapped around, None if it was reset."""
+    for width in WIDTHS:
+        top = 2.0 ** width
+        if prev < top:
+            break
+    if prev >= top * (1 - WRAP_MARGIN) and value < top * WRAP_MARGIN:
+        return top - prev + value
+    return None
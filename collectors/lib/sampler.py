@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""On-demand sampling profiler for the agent.
+
+   Sent SIGUSR2, the runner and tcollector sample the stacks of all their
+   threads for a while, then write what they saw as collapsed stacks: one
+   "frame;frame;... count" line per distinct stack, from the outermost
+   frame, which flamegraph.pl and speedscope read as is.  Every stack
+   starts with the name of its thread, preceded on the workers of the
+   runner by the collector the thread was running, so that the flame
+   graph splits by collector.
+
+   The sampler is a thread of ours looking at sys._current_frames() every
+   few milliseconds, which costs a little CPU while it runs and nothing
+   otherwise: no tracing hook, no restart under a profiler."""
+
+import collections
+import logging
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_DURATION = 30  # seconds
+DEFAULT_INTERVAL = 0.01  # seconds between samples
+
+
+def frame_name(code):
+    """How a frame of code shows in the stacks."""
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+def collapse(frame):
+    """Returns the names of the frames of a stack, outermost first."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of the other threads, then writes them out."""
+
+    def __init__(self, path, duration=DEFAULT_DURATION,
+                 interval=DEFAULT_INTERVAL, labels=None, logger=None):
+        """Constructor.
+
+        Args:
+          path: Where to write the collapsed stacks.
+          duration: For how many seconds we sample.
+          interval: How many seconds between samples.
+          labels: A function returning a dict of thread ident -> what
+            that thread is busy with, e.g. the collector it runs.
+          logger: Where to log what we're up to.
+        """
+        threading.Thread.__init__(self, name='stack-sampler')
+        self.daemon = True
+        self.path = path
+        self.duration = duration
+        self.interval = interval
+        self.labels = labels
+        self.logger = logger or logging.getLogger(__name__)
+        self.counts = collections.defaultdict(int)  # stack -> samples
+        self.samples = 0
+
+    def sample(self):
+        """Records the current stack of every thread but ours."""
+        names = dict((thread.ident, thread.name)
+                     for thread in threading.enumerate())
+        labels = self.labels() if self.labels is not None else {}
+        own = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = [names.get(ident, 'thread-%d' % ident)]
+            label = labels.get(ident)
+            if label is not None:
+                stack.insert(0, 'collector:%s' % label)
+            stack.extend(collapse(frame))
+            self.counts[';'.join(name.replace(';', ':') for name in stack)] += 1
+        self.samples += 1
+
+    def run(self):
+        end = time.time() + self.duration
+        try:
+            while time.time() < end:
+                self.sample()
+                time.sleep(self.interval)
+            self.write()
+        except:
+            self.logger.exception('failed to profile into %s', self.path)
+            return
+        self.logger.info('wrote %d samples of %d stacks to %s', self.samples,
+                         len(self.counts), self.path)
+
+    def write(self):
+        """Writes the collapsed stacks, busiest first."""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for stack, count in sorted(self.counts.iteritems(),
+                                       key=lambda item: -item[1]):
+                f.write('%s %d\n' % (stack, count))
+        os.rename(tmp, self.path)
+
+
+class Profiler(object):
+    """Starts a StackSampler on demand, one at a time."""
+
+    def __init__(self, name, directory=None, duration=DEFAULT_DURATION,
+                 labels=None, logger=None):
+        """Constructor.
+
+        Args:
+          name: What the files are named after, e.g. 'runner'.
+          directory: Where to write them, defaults to the temp directory.
+          duration: For how many seconds we sample each time.
+          labels: See StackSampler.
+          logger: Where to log what we're up to.
+        """
+        self.name = name
+        self.directory = directory or tempfile.gettempdir()
+        self.duration = duration
+        self.labels = labels
+        self.logger = logger or logging.getLogger(__name__)
+        self.sampler = None
+
+    def start(self):
+        """Starts sampling, unless we already are.  Returns the path the
+           stacks are written to, or None."""
+        if self.sampler is not None and self.sampler.is_alive():
+            self.logger.warning('already profiling into %s', self.sampler.path)
+            return None
+        path = os.path.join(self.directory, '%s-%d-%s.collapsed' % (
+            self.name, os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        self.logger.info('profiling for %ds into %s', self.duration, path)
+        self.sampler = StackSampler(path, self.duration, labels=self.labels,
+                                    logger=self.logger)
+        self.sampler.start()
+        return path
+
+    def install(self, signum=signal.SIGUSR2):
+        """Starts sampling whenever we get signum."""
+        signal.signal(signum, lambda signum, frame: self.start())
+        # the blocking calls of our other threads carry on when it comes
+        signal.siginterrupt(signum, False)
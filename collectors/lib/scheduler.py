@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Runs the collectors of the runner on a shared pool of worker threads.
+
+   Rather than one thread per collector, each sleeping until its next
+   collection, a single thread keeps the collectors in a heap ordered by
+   when they are due next and hands the due ones over to a fixed number of
+   workers.  A collector still running when it's due again is skipped that
+   time around, and one running for longer than its timeout gets its worker
+   replaced, so that it can't starve the other collectors.
+
+   The collectors may also be aligned on the wall clock: every one of them
+   is then due at the multiples of its interval, shifted by an offset
+   common to all of them, e.g. at :00 and :30 for every collector running
+   every 30 seconds.
+
+   The wall and CPU time of every run are recorded.  A job may be given a
+   CPU budget per run: a run going over it makes the job skip as many of
+   its next runs as it used budgets, so that it averages out to about its
+   budget.  A run past its timeout may also be interrupted, if the job
+   knows how, e.g. by killing the process it runs in."""
+
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import logging
+import threading
+import time
+from Queue import Queue
+
+from collectors.lib.selfmetrics import MetricsRegistry
+
+DEFAULT_WORKERS = 8
+# The scheduler looks for runs past their timeout at least this often.
+CHECK_INTERVAL = 1.0  # seconds
+# At most how many runs in a row a job over its CPU budget skips.
+MAX_BUDGET_SKIPS = 10
+CLOCK_THREAD_CPUTIME_ID = 3  # clock_gettime(2), Linux
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _thread_clock():
+    """Returns a function returning the CPU seconds used by the calling
+       thread, or None where there's no such clock."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    ts = Timespec()
+    if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) != 0:
+        return None
+
+    def thread_cpu_time():
+        ts = Timespec()
+        clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return thread_cpu_time
+
+# Python 2 has no time.thread_time()
+thread_cpu_time = _thread_clock()
+
+
+def budget_skips(cpu, budget):
+    """How many runs to skip after a run used cpu seconds of a budget."""
+    if not budget or cpu <= budget:
+        return 0
+    return min(int(cpu / budget), MAX_BUDGET_SKIPS)
+
+
+class Job(object):
+    """A function a Scheduler calls every interval seconds."""
+
+    def __init__(self, name, func, interval, timeout, cleanup, stats,
+                 budget=0, interrupt=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout or interval
+        self.cleanup = cleanup
+        self.budget = budget
+        self.interrupt = interrupt
+        self.skip = 0  # How many of the next runs to skip, over budget.
+        self.tick = None  # When the current or last run was due.
+        self.lock = threading.Lock()
+        self.pending = False  # Handed over to the workers, not started yet.
+        self.started = None  # When the current run started.
+        self.worker = None  # The ident of the thread of the current run.
+        self.timed_out = False  # Whether the current run lost its worker.
+        self.cancelled = False
+        self.done = threading.Event()  # Set once cancelled and cleaned up.
+        self.duration = stats.timer('scheduler.duration', collector=name)
+        self.cpu = stats.timer('scheduler.cpu', collector=name)
+        self.budget_overruns = stats.counter('scheduler.budget_overruns',
+                                             collector=name)
+        self.skips = stats.counter('scheduler.skips', collector=name)
+        self.overruns = stats.counter('scheduler.overruns', collector=name)
+        self.timeouts = stats.counter('scheduler.timeouts', collector=name)
+
+    def is_busy(self):
+        return self.pending or self.started is not None
+
+    def cancel(self, logger):
+        """Stops scheduling the job.  It's cleaned up right away if it's
+           idle, else once its current run returns."""
+        with self.lock:
+            self.cancelled = True
+            busy = self.is_busy()
+        if not busy:
+            self.finish(logger)
+
+    def finish(self, logger):
+        try:
+            if self.cleanup is not None:
+                self.cleanup()
+        except:
+            logger.exception('failed to clean up collector %s', self.name)
+        finally:
+            self.done.set()
+
+
+class Scheduler(object):
+    """Calls the functions of its jobs on time, from a pool of workers."""
+
+    def __init__(self, workers=DEFAULT_WORKERS, logger=None, stats=None,
+                 align=False, offset=0, budget=0):
+        """Constructor.
+
+        Args:
+          workers: How many jobs may run at the same time, not counting
+            the runs past their timeout.
+          logger: Where to log the failures and timeouts of the jobs.
+          stats: The MetricsRegistry to record our metrics in.
+          align: Whether the jobs are due at the multiples of their
+            interval, rather than every interval from when they're added.
+          offset: When aligned, how many seconds after those multiples
+            the jobs are due.
+          budget: How many CPU seconds a run of a job may use, unless the
+            job says otherwise, 0 for no limit.
+        """
+        self.workers = workers
+        self.align = align
+        self.offset = offset
+        self.budget = budget
+        self.logger = logger or logging.getLogger(__name__)
+        self.stats = stats if stats is not None else MetricsRegistry()
+        self.jobs = {}  # name -> Job
+        self.heap = []  # (when due, sequence number, Job)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.runq = Queue()  # (Job, when due) for the workers.
+        self.threads = 0  # Our worker threads.
+        self.exit = False
+        self.thread = None
+        self.lag = self.stats.timer('scheduler.lag')
+        self.stats.add_source(self.report_stats)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='scheduler')
+        self.thread.daemon = True
+        self.thread.start()
+        for _ in xrange(self.workers):
+            self.start_worker()
+
+    def start_worker(self):
+        with self.cond:
+            self.threads += 1
+            name = 'scheduler-worker-%d' % next(self.seq)
+        worker = threading.Thread(target=self.work, name=name)
+        worker.daemon = True
+        worker.start()
+
+    def shutdown(self):
+        """Stops dispatching jobs and lets the idle workers go."""
+        with self.cond:
+            self.exit = True
+            self.cond.notify()
+            threads = self.threads
+        for _ in xrange(threads):
+            self.runq.put(None)
+
+    def add(self, name, func, interval, timeout=None, cleanup=None,
+            budget=None, interrupt=None):
+        """Calls func every interval seconds, starting right away or, when
+           aligned, at the next multiple of interval.
+
+        Args:
+          name: The name of the job, unique among our jobs.
+          func: What to call.  It may return how many CPU seconds it
+            used outside of the calling thread, e.g. in a child process.
+          interval: How many seconds from the start of one call to the
+            start of the next.
+          timeout: How many seconds a call may run before we consider it
+            stuck, defaults to interval.
+          cleanup: What to call once the job is removed and its last call
+            returned.
+          budget: How many CPU seconds a call may use, defaults to ours.
+          interrupt: What to call to interrupt a call past its timeout.
+
+        Returns:
+          The Job, to give to remove().
+        """
+        if budget is None:
+            budget = self.budget
+        job = Job(name, func, interval, timeout, cleanup, self.stats, budget,
+                  interrupt)
+        with self.cond:
+            if name in self.jobs:
+                raise ValueError('job %s already scheduled' % name)
+            self.jobs[name] = job
+            heapq.heappush(self.heap, (self.first_run(interval, time.time()),
+                                       next(self.seq), job))
+            self.cond.notify()
+        return job
+
+    def remove(self, job):
+        """Unschedules a job, see Job.cancel."""
+        with self.cond:
+            if self.jobs.get(job.name) is job:
+                del self.jobs[job.name]
+        job.cancel(self.logger)
+
+    def run(self):
+        """Main loop of the scheduler thread."""
+        last_check = time.time()
+        while True:
+            with self.cond:
+                while not self.exit:
+                    now = time.time()
+                    if self.heap and self.heap[0][0] <= now:
+                        break
+                    if now - last_check >= CHECK_INTERVAL:
+                        break
+                    wait = last_check + CHECK_INTERVAL - now
+                    if self.heap:
+                        wait = min(wait, self.heap[0][0] - now)
+                    self.cond.wait(wait)
+                if self.exit:
+                    return
+                due = []
+                while self.heap and self.heap[0][0] <= now:
+                    when, _, job = heapq.heappop(self.heap)
+                    if job.cancelled:
+                        continue
+                    due.append((job, when))
+                    heapq.heappush(self.heap, (self.next_run(job, when, now),
+                                               next(self.seq), job))
+            for job, when in due:
+                self.dispatch(job, when)
+            if now - last_check >= CHECK_INTERVAL:
+                last_check = now
+                self.check_timeouts(now)
+
+    def first_run(self, interval, now):
+        """Returns when a job added now is due for the first time."""
+        if not self.align:
+            return now
+        return now + (self.offset - now) % interval
+
+    def next_run(self, job, when, now):
+        """Returns when a job due at when is due next, skipping the runs
+           we're already too late for."""
+        when += job.interval
+        if when <= now:
+            when += job.interval * (int((now - when) / job.interval) + 1)
+        return when
+
+    def dispatch(self, job, when):
+        """Hands a due job over to the workers, unless it's still busy or
+           over its budget."""
+        with job.lock:
+            busy = job.is_busy()
+            over_budget = not busy and job.skip > 0
+            if over_budget:
+                job.skip -= 1
+            elif not busy:
+                job.pending = True
+        if busy:
+            job.skips.inc()
+            self.logger.warning('collector %s is still running, skipping '
+                                'this collection', job.name)
+            return
+        if over_budget:
+            job.skips.inc()
+            self.logger.info('collector %s is over its CPU budget, skipping '
+                             'this collection', job.name)
+            return
+        self.runq.put((job, when))
+
+    def work(self):
+        """Main loop of the worker threads."""
+        ident = threading.current_thread().ident
+        while True:
+            item = self.runq.get()
+            if item is None:
+                with self.cond:
+                    self.threads -= 1
+                return
+            job, when = item
+            start = time.time()
+            with job.lock:
+                job.pending = False
+                job.started = start
+                job.worker = ident
+                job.tick = when
+            self.lag.observe(1000 * (start - when))
+            cpu_start = thread_cpu_time() if thread_cpu_time else None
+            other_cpu = None
+            try:
+                self.logger.info('start one collection for collector %s',
+                                 job.name)
+                other_cpu = job.func()
+                self.logger.info('finish one collection for collector %s',
+                                 job.name)
+            except:
+                self.logger.exception('failed to execute collector %s',
+                                      job.name)
+            elapsed = time.time() - start
+            job.duration.observe(1000 * elapsed)
+            if elapsed > job.interval:
+                job.overruns.inc()
+            if cpu_start is not None:
+                cpu = thread_cpu_time() - cpu_start
+                if isinstance(other_cpu, float):
+                    cpu += other_cpu
+                self.account_cpu(job, cpu)
+            with job.lock:
+                job.started = None
+                job.worker = None
+                timed_out, job.timed_out = job.timed_out, False
+                cancelled = job.cancelled
+            if cancelled:
+                job.finish(self.logger)
+            if timed_out:
+                # we were replaced when the job timed out
+                self.logger.info('collector %s returned after %.1fs',
+                                 job.name, elapsed)
+                with self.cond:
+                    self.threads -= 1
+                return
+
+    def account_cpu(self, job, cpu):
+        """Records the CPU seconds of a run, skips the next runs of the job
+           if it went over its budget."""
+        job.cpu.observe(1000 * cpu)
+        skip = budget_skips(cpu, job.budget)
+        if not skip:
+            return
+        job.budget_overruns.inc()
+        with job.lock:
+            job.skip = skip
+        self.logger.warning('collector %s used %.2fs of CPU, over its budget '
+                            'of %.2fs, skipping its next %d collections',
+                            job.name, cpu, job.budget, skip)
+
+    def check_timeouts(self, now):
+        """Gives the workers of the jobs running past their timeout a
+           replacement, and interrupts their calls if the jobs know how.
+           Most calls can't be interrupted."""
+        with self.cond:
+            jobs = self.jobs.values()
+        for job in jobs:
+            with job.lock:
+                if (job.started is None or job.timed_out
+                        or now - job.started <= job.timeout):
+                    continue
+                job.timed_out = True
+            job.timeouts.inc()
+            self.logger.warning('collector %s still running after %ds, '
+                                'starting another worker', job.name,
+                                job.timeout)
+            if job.interrupt is not None:
+                try:
+                    job.interrupt()
+                except:
+                    self.logger.exception('failed to interrupt collector %s',
+                                          job.name)
+            self.start_worker()
+
+    def running(self):
+        """Returns a dict of thread ident -> name of the job it runs."""
+        with self.cond:
+            jobs = self.jobs.values()
+        return dict((job.worker, job.name) for job in jobs
+                    if job.worker is not None)
+
+    def report_stats(self):
+        """Returns (metric, tags, value) tuples about our pool."""
+        with self.cond:
+            threads = self.threads
+            jobs = self.jobs.values()
+        busy = sum(1 for job in jobs if job.started is not None)
+        return [('scheduler.jobs', (), len(jobs)),
+                ('scheduler.workers', (), threads),
+                ('scheduler.busy_workers', (), busy),
+                ('scheduler.queued', (), self.runq.qsize())]
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Registry of the metrics tcollector reports about itself.
+
+   Hot paths update plain instruments (counters, gauges, high-water marks
+   and timers) that cost an attribute update each.  Numbers that already
+   live elsewhere, like the line counts of the collectors, are pulled from
+   sources when the registry is collected, once per reporting interval."""
+
+import threading
+
+
+def tag_tuple(tags):
+    """Returns a dict of tags as a sorted tuple of "tagk=tagv" strings."""
+    return tuple(sorted('%s=%s' % tag for tag in tags.iteritems()))
+
+
+class Counter(object):
+    """A monotonically increasing count."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, count=1):
+        self.value += count
+
+    def report(self):
+        return [('', self.value)]
+
+
+class Gauge(object):
+    """The last value set."""
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def report(self):
+        return [('', self.value)]
+
+
+class HighWaterMark(object):
+    """The highest value observed since the last report."""
+
+    def __init__(self):
+        self.value = 0
+
+    def observe(self, value):
+        if value > self.value:
+            self.value = value
+
+    def report(self):
+        value, self.value = self.value, 0
+        return [('', value)]
+
+
+class Timer(object):
+    """Durations in milliseconds: how many of them and their total, both
+       cumulative, and the longest one since the last report."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def report(self):
+        max_ms, self.max = self.max, 0.0
+        return [('.count', self.count), ('.total_ms', self.total),
+                ('.max_ms', max_ms)]
+
+
+class MetricsRegistry(object):
+    """The instruments and sources of the metrics to report."""
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.instruments = {}  # (name, tags) -> instrument
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, tags):
+        """Returns the instrument of the given class for name and tags,
+           creating it the first time around."""
+        key = (name, tag_tuple(tags))
+        with self.lock:
+            instrument = self.instruments.get(key)
+            if instrument is None:
+                instrument = self.instruments[key] = cls()
+        assert isinstance(instrument, cls), (key, instrument)
+        return instrument
+
+    def counter(self, name, **tags):
+        return self.get(Counter, name, tags)
+
+    def gauge(self, name, **tags):
+        return self.get(Gauge, name, tags)
+
+    def high_water_mark(self, name, **tags):
+        return self.get(HighWaterMark, name, tags)
+
+    def timer(self, name, **tags):
+        return self.get(Timer, name, tags)
+
+    def add_source(self, source):
+        """Registers a function returning (name, tags, value) tuples, tags
+           being a tuple of "tagk=tagv" strings, called on every collect."""
+        with self.lock:
+            self.sources.append(source)
+
+    def remove_source(self, source):
+        with self.lock:
+            if source in self.sources:
+                self.sources.remove(source)
+
+    def collect(self):
+        """Returns (metric, tags, value) tuples for everything we track."""
+        with self.lock:
+            instruments = sorted(self.instruments.items())
+            sources = list(self.sources)
+        result = []
+        for (name, tags), instrument in instruments:
+            for suffix, value in instrument.report():
+                result.append((self.prefix + name + suffix, tags, value))
+        for source in sources:
+            for name, tags, value in source():
+                result.append((self.prefix + name, tags, value))
+        return result
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# This file is part of tcollector.
+# Copyright (C) 2010  The tcollector Authors.
+#
+# This program is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.  This program is distributed in the hope that it
+# will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser
+# General Public License for more details.  You should have received a copy
+# of the GNU Lesser General Public License along with this program.  If not,
+# see <http://www.gnu.org/licenses/>.
+
+"""Append-only disk spool for data points we couldn't send to the TSD.
+
+   The spool is a directory of numbered segment files.  Lines are appended
+   to the newest segment in records of:
+
+     <length:uint32> <crc32:uint32> <lines joined by newlines>
+
+   Segments are replayed oldest first, each one sorted by timestamp, and
+   deleted once fully consumed.  When the spool grows over its size limit
+   the oldest segments are dropped."""
+
+import errno
+import os
+import struct
+import zlib
+from collections import deque
+
+HEADER = struct.Struct('!II')
+SEGMENT_SUFFIX = '.spool'
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+
+
+def line_timestamp(line):
+    """Sort key for a "<metric> <timestamp> <value> [tags]" line."""
+    try:
+        return int(line.split(None, 2)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+class Spool(object):
+    """A size bounded, append-only spool of lines on disk."""
+
+    def __init__(self, directory, max_bytes, logger,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES):
+        self.directory = directory
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.segment_bytes = min(segment_bytes, max_bytes)
+        self.dropped_lines = 0
+        # Sequence numbers of the segments on disk, oldest first.
+        self.segments = deque()
+        self.sizes = {}
+        # The segment being appended to, and its file.
+        self.writer = None
+        self.writer_seq = None
+        # Lines of the oldest segment, loaded for replay.
+        self.replay = deque()
+        self.replay_seq = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                seq = int(name[:-len(SEGMENT_SUFFIX)])
+                self.segments.append(seq)
+                self.sizes[seq] = os.path.getsize(self.path(seq))
+        if self.segments:
+            self.logger.info('found %d bytes in %d spooled segments in %s',
+                             self.size(), len(self.segments), directory)
+
+    def path(self, seq):
+        return os.path.join(self.directory, '%012d%s' % (seq, SEGMENT_SUFFIX))
+
+    def size(self):
+        """Returns the number of bytes spooled on disk."""
+        return sum(self.sizes.itervalues())
+
+    def __len__(self):
+        """Returns the number of lines ready to be replayed right away."""
+        return len(self.replay)
+
+    def is_empty(self):
+        return not self.replay and not self.segments
+
+    def append(self, lines):
+        """Appends the given lines to the spool in a single record."""
+        if not lines:
+            return
+        payload = '\n'.join(lines)
+        record = HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        if self.writer is None or self.sizes[self.writer_seq] + len(record) > self.segment_bytes:
+            self.rotate()
+        self.make_room(len(record))
+        self.writer.write(record)
+        self.writer.flush()
+        self.sizes[self.writer_seq] += len(record)
+
+    def rotate(self):
+        """Closes the segment being written and starts a new one."""
+        self.close_writer()
+        seq = self.segments[-1] + 1 if self.segments else 0
+        self.writer = open(self.path(seq), 'ab')
+        self.writer_seq = seq
+        self.segments.append(seq)
+        self.sizes[seq] = 0
+
+    def close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.writer_seq = None
+
+    def make_room(self, size):
+        """Drops the oldest segments until size more bytes fit in the spool."""
+        while self.size() + size > self.max_bytes and len(self.segments) > 1:
+            seq = self.segments.popleft()
+            if seq == self.replay_seq:
+                self.dropped_lines += len(self.replay)
+                self.replay.clear()
+                self.replay_seq = None
+            self.logger.warning('spool is full (%d bytes), dropping %s',
+                                self.max_bytes, self.path(seq))
+            self.remove(seq)
+
+    def remove(self, seq):
+        del self.sizes[seq]
+        try:
+            os.unlink(self.path(seq))
+        except OSError, (err, msg):
+            if err != errno.ENOENT:
+                raise
+
+    def peek(self, count):
+        """Returns up to count lines to replay, in timestamp order.
+
+           The lines stay in the spool until consume() is called, so they
+           are replayed again if sending them fails."""
+        if not self.replay:
+            self.load_next()
+        return [self.replay[i] for i in xrange(min(count, len(self.replay)))]
+
+    def consume(self, count):
+        """Removes the first count lines returned by peek()."""
+        for _ in xrange(min(count, len(self.replay))):
+            self.replay.popleft()
+        if not self.replay and self.replay_seq is not None:
+            self.segments.remove(self.replay_seq)
+            self.remove(self.replay_seq)
+            self.replay_seq = None
+
+    def load_next(self):
+        """Loads the oldest segment into the replay buffer."""
+        while self.segments and not self.replay:
+            seq = self.segments[0]
+            if seq == self.writer_seq:
+                # don't replay a segment we are still appending to
+                self.close_writer()
+            self.replay_seq = seq
+            lines = self.read_segment(seq)
+            lines.sort(key=line_timestamp)
+            self.replay.extend(lines)
+            if not self.replay:
+                self.consume(0)
+
+    def read_segment(self, seq):
+        """Returns the lines of every valid record of a segment."""
+        lines = []
+        path = self.path(seq)
+        try:
+            f = open(path, 'rb')
+        except IOError, (err, msg):
+            if err != errno.ENOENT:
+                raise
+            return lines
+        try:
+            while True:
+                header = f.read(HEADER.size)
+                if not header:
+                    break
+                if len(header) < HEADER.size:
+                    self.logger.error('truncated record header in %s, skipping '
+                                      'the rest of the segment', path)
+                    break
+                length, crc = HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    self.logger.error('corrupted record in %s, skipping the '
+                                      'rest of the segment', path)
+                    break
+                lines.extend(payload.split('\n'))
+        finally:
+            f.close()
+        return lines
+
+    def close(self):
+        self.close_writer()
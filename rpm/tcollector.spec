@@ -60,6 +60,21 @@ mkdir -p %{buildroot}/%{py2_sitelib}/
 %dir %{tcollectordir}/collectors/lib/
 %{tcollectordir}/collectors/lib/__init__.py
 %{tcollectordir}/collectors/lib/utils.py
+%{tcollectordir}/collectors/lib/batching.py
+%{tcollectordir}/collectors/lib/datapoint.py
+%{tcollectordir}/collectors/lib/spool.py
+%{tcollectordir}/collectors/lib/httppool.py
+%{tcollectordir}/collectors/lib/putjson.py
+%{tcollectordir}/collectors/lib/selfmetrics.py
+%{tcollectordir}/collectors/lib/scheduler.py
+%{tcollectordir}/collectors/lib/procexec.py
+%{tcollectordir}/collectors/lib/backpressure.py
+%{tcollectordir}/collectors/lib/confwatch.py
+%{tcollectordir}/collectors/lib/httpengine.py
+%{tcollectordir}/collectors/lib/sampler.py
+%{tcollectordir}/collectors/lib/procfs.py
+%{tcollectordir}/collectors/lib/sockdiag.py
+%{tcollectordir}/collectors/lib/rates.py
 %{tcollectordir}/collectors/lib/hadoop_http.py
 %dir %{tcollectordir}/collectors/etc/
 %{tcollectordir}/collectors/etc/__init__.py
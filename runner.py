@@ -13,13 +13,26 @@ import json
 import urllib2
 import random
 import base64
+import functools
 import threading
+import zlib
 from optparse import OptionParser
-from Queue import Queue
-from Queue import Full
-from Queue import Empty
-import ssl
 import common_utils
+from collectors.lib.backpressure import CollectorQueue
+from collectors.lib.backpressure import PressureQueue
+from collectors.lib.batching import Batcher
+from collectors.lib.confwatch import watcher
+from collectors.lib.httppool import COMPRESSIONS
+from collectors.lib.httppool import HTTPConnectionPool
+from collectors.lib.httppool import unverified_ssl_context
+from collectors.lib.procexec import ProcessCollector
+from collectors.lib.putjson import PutEncoder
+from collectors.lib.sampler import DEFAULT_DURATION
+from collectors.lib.sampler import Profiler
+from collectors.lib.scheduler import DEFAULT_WORKERS
+from collectors.lib.scheduler import Scheduler
+from collectors.lib.selfmetrics import MetricsRegistry
+from collectors.lib.spool import Spool
 
 # global variables._
 COLLECTORS = {}
@@ -31,13 +44,28 @@ ALLOWED_INACTIVITY_TIME = 600  # seconds
 MAX_UNCAUGHT_EXCEPTIONS = 50000000
 MAX_SENDQ_SIZE = 20000      # this should match tsd.http.request.max_chunk, usually 1/3. json adds considerable overhead
 MAX_READQ_SIZE = 100000
-MAX_READQ_SIZE_TO_START = MAX_READQ_SIZE / 10
-MAX_DROPPED_LINES_TO_START = MAX_READQ_SIZE / 10
+# how often the sender reports its batching histograms and STATS
+SENDER_STATS_INTERVAL = 60  # seconds
+# our own metrics, reported by the sender
+STATS = MetricsRegistry('collector.')
+# runs the collectors, see main()
+SCHEDULER = None
+# the queue between the collectors and the sender, see main()
+READQ = None
+# when main() started, for the time to the first data point
+START_TIME = time.time()
+# path of a collector module -> (its mtime, the module), so that a collector whose conf changed isn't imported again
+MODULES = {}
 # config constants
 SECTION_BASE = 'base'
 CONFIG_ENABLED = 'enabled'
 CONFIG_COLLECTOR_CLASS = 'collectorclass'
 CONFIG_INTERVAL = 'interval'
+CONFIG_TIMEOUT = 'collectiontimeout'  # 'timeout' is taken by some collectors
+CONFIG_EXECUTION = 'execution'
+CONFIG_QUOTA = 'queuequota'  # 0 for --collector-quota
+CONFIG_BUDGET = 'cpubudget'  # CPU seconds per collection, 0 for --cpu-budget
+EXECUTION_MODES = ('thread', 'process')
 
 # metric entry constant
 METRIC_NAME = 'metric'
@@ -47,6 +75,8 @@ METRIC_TAGS = 'tags'
 
 
 def main(argv):
+    global START_TIME
+    START_TIME = time.time()
     try:
         options, args = parse_cmdline(argv)
     except:
@@ -113,31 +143,49 @@ def main(argv):
     runner_config = load_runner_conf()
     token = runner_config.get('base', 'token')
 
-    readq = NonBlockingQueue(MAX_READQ_SIZE)
+    # when the sender falls behind, what doesn't fit in memory goes to the spool, if any
+    spool = Spool(options.spool_dir, options.spool_max_bytes, LOG) if options.spool_dir else None
+    global READQ
+    READQ = readq = PressureQueue(MAX_READQ_SIZE, spool, options.lossy_interval, options.collector_quota, LOG, STATS)
     global SENDER
     SENDER = Sender(token, readq, options, tags)
     SENDER.start()
 
+    # all the collectors run on the worker threads of the scheduler
+    global SCHEDULER
+    # when aligned, the collectors of this host are due a few seconds after those of the others
+    tick_offset = zlib.crc32(tags.get('host', '')) % options.tick_jitter if options.tick_jitter else 0
+    SCHEDULER = Scheduler(options.workers, LOG, STATS, options.align_ticks, tick_offset, options.cpu_budget)
+    SCHEDULER.start()
+
+    # kill -USR2 samples our stacks for a while, per collector, to find out what eats our CPU
+    Profiler('runner', options.profile_dir, options.profile_seconds, SCHEDULER.running, LOG).install()
+
     LOG.info('agent finish initializing, enter main loop.')
     main_loop(readq, options, {}, COLLECTORS)
 
 
 def main_loop(readq, options, configs, collectors):
     loop_interval = options.update_interval
+    # tells us which conf files changed as soon as they do, rather than us stat'ing all of them every loop
+    conf_watcher = watcher(LOG)
+    changed_paths = None  # everything
     while True:
         start = time.time()
         try:
-            changed_configs, deleted_configs = reload_collector_confs(configs, options)
-            close_collecotors(deleted_configs, collectors)
-            load_collectors(options.cdir, changed_configs, collectors, readq)
+            if changed_paths is None:
+                conf_watcher.watch(os.path.join(options.cdir, 'conf'))
+            if changed_paths is None or changed_paths:
+                changed_configs, deleted_configs = reload_collector_confs(configs, options, changed_paths)
+                close_collecotors(deleted_configs, collectors)
+                load_collectors(options.cdir, changed_configs, collectors, readq)
             if options.verbose:
                 import datetime
                 sys.stdout.write('sent data at %s\n' % datetime.datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S'))
         except:
             LOG.exception('failed collector update loop.')
 
-        end = time.time()
-        sleep_reasonably(loop_interval, start, end)
+        changed_paths = conf_watcher.wait(max(loop_interval - (time.time() - start), 0))
 
 
 def load_runner_conf():
@@ -147,17 +195,20 @@ def load_runner_conf():
     return runner_config
 
 
-def reload_collector_confs(collector_confs, options):
+def reload_collector_confs(collector_confs, options, changed_paths=None):
     """
     load and reload collector conf file
     Args:
         collector_confs:
         options:
+        changed_paths: the paths the conf watcher saw change, None to look at every conf file
 
     Returns: changed collector confs and deleted collector confs
 
     """
     confdir = os.path.join(options.cdir, 'conf')
+    if changed_paths is not None and confdir not in changed_paths:
+        return reload_changed_confs(collector_confs, confdir, changed_paths)
     current_collector_confs = set(list_collector_confs(confdir))
     changed_collector_confs = {}
     deleted_collector_confs = {}
@@ -192,10 +243,37 @@ def reload_collector_confs(collector_confs, options):
     return changed_collector_confs, deleted_collector_confs
 
 
+def reload_changed_confs(collector_confs, confdir, changed_paths):
+    """ same as reload_collector_confs, only for the given paths """
+    changed_collector_confs = {}
+    deleted_collector_confs = {}
+    for path in changed_paths:
+        filename = os.path.basename(path)
+        if os.path.dirname(path) != confdir or not filename.endswith('.conf'):
+            continue
+        if os.path.isfile(path):
+            mtime = os.path.getmtime(path)
+            if filename in collector_confs and mtime <= collector_confs[filename][2]:
+                continue
+            LOG.info('reloading %s, file has changed', path)
+            config = ConfigParser.SafeConfigParser(default_config())
+            config.read(path)
+            collector_confs[filename] = (path, config, mtime)
+            changed_collector_confs[filename] = (path, config, mtime)
+        elif filename in collector_confs:
+            LOG.info('%s has been removed, agent should be restarted', filename)
+            deleted_collector_confs[filename] = collector_confs.pop(filename)
+    return changed_collector_confs, deleted_collector_confs
+
+
 def default_config():
     return {
         CONFIG_ENABLED: 'False',
         CONFIG_INTERVAL: '15',
+        CONFIG_TIMEOUT: '0',
+        CONFIG_EXECUTION: 'thread',
+        CONFIG_QUOTA: '0',
+        CONFIG_BUDGET: '0',
         CONFIG_COLLECTOR_CLASS: None
     }
 
@@ -232,15 +310,24 @@ def load_collectors(coldir, configs, collectors, readq):
             if conf.getboolean(SECTION_BASE, CONFIG_ENABLED):
                 if os.path.isfile(collector_path_name) and os.access(collector_path_name, os.X_OK):
                     collector_class_name = conf.get(SECTION_BASE, CONFIG_COLLECTOR_CLASS)
-                    collector_class = load_collector_module(name, collector_dir, collector_class_name)
-                    collector_instance = collector_class(conf, LOG, readq)
+                    execution = conf.get(SECTION_BASE, CONFIG_EXECUTION)
+                    if execution not in EXECUTION_MODES:
+                        raise ValueError('unknown execution mode %s' % execution)
+                    # the lines of the collector count towards its quota of the readq
+                    collector_readq = CollectorQueue(readq, name, conf.getint(SECTION_BASE, CONFIG_QUOTA) or None)
+                    factory = functools.partial(start_collector, name, collector_dir, collector_class_name, execution,
+                                                conf, collector_readq)
                     interval = conf.getint(SECTION_BASE, CONFIG_INTERVAL)
+                    # a collector running for longer than that loses its worker, defaults to the interval
+                    timeout = conf.getint(SECTION_BASE, CONFIG_TIMEOUT)
+                    # the collections going over it make the next ones be skipped
+                    budget = conf.getfloat(SECTION_BASE, CONFIG_BUDGET) or None
 
                     # shutdown and remove old collector
                     if name in collectors:
                         close_single_collector(collectors, name)
                     LOG.info('loading collector %s from %s', name, collector_path_name)
-                    collectors[name] = CollectorExec(name, collector_instance, interval)
+                    collectors[name] = CollectorExec(name, factory, interval, timeout, budget)
                 else:
                     LOG.warn('failed to access collector file: %s', collector_path_name)
             elif name in collectors:
@@ -250,10 +337,40 @@ def load_collectors(coldir, configs, collectors, readq):
             LOG.exception('failed to load collector %s, skipped.', collector_path_name if collector_path_name else config_filename)
 
 
+def start_collector(name, collector_dir, collector_class_name, execution, conf, readq):
+    """ import the module of a collector and build it. Returns the collector and how long the import and the
+        construction took, in milliseconds """
+    start = time.time()
+    collector_class = load_collector_module(name, collector_dir, collector_class_name)
+    imported = time.time()
+    if execution == 'process':
+        # CPU-heavy collectors run in a process of their own, out of our GIL's way
+        collector_instance = ProcessCollector(name, collector_class, conf, LOG, readq)
+    else:
+        collector_instance = collector_class(conf, LOG, readq)
+    return collector_instance, 1000 * (imported - start), 1000 * (time.time() - imported)
+
+
 # caller to handle exception
 def load_collector_module(module_name, module_path, collector_class_name=None):
-    (file_obj, filename, description) = imp.find_module(module_name, [module_path])
-    mod = imp.load_module(module_name, file_obj, filename, description)
+    path = os.path.join(module_path, module_name + '.py')
+    mtime = os.path.getmtime(path)
+    # the collectors are started in parallel, see CollectorExec
+    imp.acquire_lock()
+    try:
+        cached = MODULES.get(path)
+        if cached is not None and cached[0] == mtime:
+            mod = cached[1]
+        else:
+            (file_obj, filename, description) = imp.find_module(module_name, [module_path])
+            try:
+                mod = imp.load_module(module_name, file_obj, filename, description)
+            finally:
+                if file_obj:
+                    file_obj.close()
+            MODULES[path] = (mtime, mod)
+    finally:
+        imp.release_lock()
     if collector_class_name is None:
         collector_class_name = module_name.title().replace('_', '').replace('-', '')
     return getattr(mod, collector_class_name)
@@ -351,8 +468,45 @@ def parse_cmdline(argv):
                       help='Password to use for HTTP Basic Auth when sending the data via HTTP')
     parser.add_option('--ssl', dest='ssl', action='store_true', default=defaults['ssl'],
                       help='Enable SSL - used in conjunction with http')
+    parser.add_option('--http-compression', dest='http_compression', type='choice', choices=COMPRESSIONS,
+                      default=defaults['http_compression'],
+                      help='Compress the data sent to the server: "none", "gzip" or "deflate". default=%default')
     parser.add_option('--update-interval', dest='update_interval', type='int', default=defaults['update_interval'],
                       help='interval the update of collector is picked up')
+    parser.add_option('--max-batch-bytes', dest='max_batch_bytes', type='int', default=defaults['max_batch_bytes'],
+                      help='Send the data points once we have that many bytes of them. default=%default')
+    parser.add_option('--max-batch-points', dest='max_batch_points', type='int', default=defaults['max_batch_points'],
+                      help='Send the data points once we have that many of them. default=%default')
+    parser.add_option('--max-linger-ms', dest='max_linger_ms', type='int', default=defaults['max_linger_ms'],
+                      help='Send the data points once the oldest of them waited that many milliseconds. '
+                           'default=%default')
+    parser.add_option('--workers', dest='workers', type='int', default=defaults['workers'],
+                      help='Number of threads running the collectors. default=%default')
+    parser.add_option('--align-ticks', dest='align_ticks', action='store_true', default=defaults['align_ticks'],
+                      help='Run the collectors at the wall clock multiples of their interval, e.g. at :00 and :30 '
+                           'every 30 seconds, rather than every interval from when they were loaded.')
+    parser.add_option('--tick-jitter', dest='tick_jitter', type='int', default=defaults['tick_jitter'],
+                      help='With --align-ticks, shift the ticks of this host by up to that many seconds, derived '
+                           'from its host tag, to spread the load of a fleet. default=%default')
+    parser.add_option('--spool-dir', dest='spool_dir', metavar='DIR', default=defaults['spool_dir'],
+                      help='Directory to spool the data points that do not fit in memory to while the server is '
+                           'slow or unreachable. They are sent once it catches up. default: drop them')
+    parser.add_option('--spool-max-bytes', dest='spool_max_bytes', type='int', default=defaults['spool_max_bytes'],
+                      help='Size limit of the spool, the oldest data points are dropped beyond. default=%default')
+    parser.add_option('--collector-quota', dest='collector_quota', type='int', default=defaults['collector_quota'],
+                      help='How many data points a collector may have waiting to be sent, 0 for no limit. '
+                           'The queuequota of a collector conf overrides it. default=%default')
+    parser.add_option('--lossy-interval', dest='lossy_interval', type='int', default=defaults['lossy_interval'],
+                      help='When the queue of data points to send is mostly full, keep only one point per series '
+                           'every that many seconds, 0 to keep them all. default=%default')
+    parser.add_option('--cpu-budget', dest='cpu_budget', type='float', default=defaults['cpu_budget'],
+                      help='How many CPU seconds a collection may use, the collectors going over it skip their next '
+                           'collections, 0 for no limit. The cpubudget of a collector conf overrides it. '
+                           'default=%default')
+    parser.add_option('--profile-dir', dest='profile_dir', metavar='DIR', default=defaults['profile_dir'],
+                      help='Where to write the stacks sampled on SIGUSR2. default: the temp directory')
+    parser.add_option('--profile-seconds', dest='profile_seconds', type='int', default=defaults['profile_seconds'],
+                      help='For how many seconds the stacks are sampled on SIGUSR2. default=%default')
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
         parser.error('--dedup-interval must be at least 0 seconds')
@@ -361,6 +515,26 @@ def parse_cmdline(argv):
                      '--dedup-interval')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    if options.max_batch_bytes <= 0:
+        parser.error('--max-batch-bytes must be greater than 0')
+    if options.max_batch_points <= 0:
+        parser.error('--max-batch-points must be greater than 0')
+    if options.max_linger_ms < 0:
+        parser.error('--max-linger-ms must be at least 0')
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+    if options.tick_jitter < 0:
+        parser.error('--tick-jitter must be at least 0')
+    if options.spool_max_bytes <= 0:
+        parser.error('--spool-max-bytes must be greater than 0')
+    if options.collector_quota < 0:
+        parser.error('--collector-quota must be at least 0')
+    if options.lossy_interval < 0:
+        parser.error('--lossy-interval must be at least 0')
+    if options.cpu_budget < 0:
+        parser.error('--cpu-budget must be at least 0')
+    if options.profile_seconds <= 0:
+        parser.error('--profile-seconds must be greater than 0')
     # We cannot write to stdout when we're a daemon.
     if (options.daemonize or options.max_bytes) and not options.backup_count:
         options.backup_count = 1
@@ -395,7 +569,21 @@ def get_defaults():
         'stdin': False,
         'daemonize': False,
         'hosts': False,
-        'update_interval': 15
+        'update_interval': 15,
+        'max_batch_bytes': MAX_SENDQ_SIZE,
+        'max_batch_points': 5000,
+        'max_linger_ms': 1000,
+        'http_compression': 'none',
+        'workers': DEFAULT_WORKERS,
+        'align_ticks': False,
+        'tick_jitter': 0,
+        'spool_dir': False,
+        'spool_max_bytes': 128 * 1024 * 1024,
+        'collector_quota': MAX_READQ_SIZE / 4,
+        'lossy_interval': 0,
+        'cpu_budget': 0,
+        'profile_dir': False,
+        'profile_seconds': DEFAULT_DURATION
     }
 
     return defaults
@@ -467,6 +655,11 @@ def shutdown():
             LOG.exception('failed to wait shutdown collector %s. skip.', name)
 
     LOG.info('total %d collectors exited', len(COLLECTORS))
+    if SCHEDULER is not None:
+        SCHEDULER.shutdown()
+    if READQ is not None:
+        # what we couldn't send yet is sent after the restart
+        READQ.close()
     os._exit(1)
 
 
@@ -476,45 +669,101 @@ def shutdown_signal(signum, frame):
     shutdown()
 
 
-def sleep_reasonably(interval, start, end):
-    sleepsec = interval - (end - start) if interval > (end - start) else 0
-    time.sleep(sleepsec)
-
-
 class CollectorExec(object):
-    def __init__(self, name, collector_instance, interval):
+    def __init__(self, name, factory, interval, timeout=0, budget=None):
+        """ factory returns the collector instance, see start_collector. It's called on a thread of its own, so that
+            the collectors importing heavy libraries or doing some work at construction don't hold up the others """
         self._validate(name, 'name')
-        self._validate(collector_instance, 'collector_instance')
+        self._validate(factory, 'factory')
         self._validate(interval, 'interval')
 
         self._name = name
-        self._collector_instance = collector_instance
+        self._factory = factory
+        self._collector_instance = None
         self._interval = interval
-        self._thread = CollectorThread(name, collector_instance, interval)
-        self._thread.start()
+        self._lock = threading.Lock()
+        self._exit = False
+        self._closed = False
+        self._created = time.time()
+        self._collected = False
+        self._ready = threading.Event()
+        LOG.info('scheduling collector %s every %ds', name, interval)
+        self._job = SCHEDULER.add(name, self._collect, interval, timeout, self._cleanup, budget, self._interrupt)
+        # only now, the first collection may run as soon as we're started and needs the job
+        thread = threading.Thread(target=self._start, name='start-%s' % name)
+        thread.daemon = True
+        thread.start()
+
+    def _start(self):
+        try:
+            instance, import_ms, construct_ms = self._factory()
+        except:
+            LOG.exception('failed to start collector %s', self._name)
+            instance = None
+        else:
+            STATS.gauge('startup.import_ms', collector=self._name).set(import_ms)
+            STATS.gauge('startup.construct_ms', collector=self._name).set(construct_ms)
+            LOG.info('started collector %s in %dms (import %dms, construction %dms)', self._name,
+                     import_ms + construct_ms, import_ms, construct_ms)
+        with self._lock:
+            self._collector_instance = instance
+            exit, closed = self._exit, self._closed
+        if instance is not None:
+            # we were shut down in the meantime
+            if exit:
+                instance.signal_exit()
+            if closed:
+                instance.cleanup()
+        self._ready.set()
+
+    def _collect(self):
+        # the first collection waits for the collector to be started
+        self._ready.wait()
+        instance = self._collector_instance
+        if instance is None or self._exit:
+            return
+        # the points of a collection share the time it was due at
+        if hasattr(instance, 'set_tick'):
+            instance.set_tick(self._job.tick)
+        instance()
+        if not self._collected:
+            self._collected = True
+            STATS.gauge('startup.first_collection_ms', collector=self._name).set(1000 * (time.time() - self._created))
+        # the CPU time of the collectors running in a process of their own, for their budget
+        return getattr(instance, 'child_cpu', None)
+
+    def _interrupt(self):
+        """ called when a collection runs past its timeout, only the collectors running in a process can be """
+        instance = self._collector_instance
+        if instance is not None and hasattr(instance, 'interrupt'):
+            instance.interrupt()
+
+    def _cleanup(self):
+        with self._lock:
+            self._closed = True
+            instance = self._collector_instance
+        if instance is not None:
+            instance.cleanup()
 
     def shutdown(self, wait=True):
         LOG.info('starting to shut down %s', self._name)
-        if self._collector_instance:
-            self._collector_instance.signal_exit()
-        else:
-            LOG.error('no collector instance for %s', self._name)
+        with self._lock:
+            self._exit = True
+            instance = self._collector_instance
+        if instance is not None:
+            instance.signal_exit()
 
-        if self._thread:
-            self._thread.exit = True
-        else:
-            LOG.error('no thread instance for %s', self._name)
+        SCHEDULER.remove(self._job)
         if wait:
-            self._thread.join()
-            LOG.info('finish shutting down %s', self._name)
+            self.wait_shutdown()
 
     def signal_shutdown(self):
-        """ signal shutdown without waiting for the thread to exit, should used in pair with wait_shutdown"""
+        """ signal shutdown without waiting for the collection to finish, should used in pair with wait_shutdown"""
         self.shutdown(False)
 
     def wait_shutdown(self):
-        """ used in pair with signal_shutdown to wait for the thread to exit """
-        self._thread.join()
+        """ used in pair with signal_shutdown to wait for the running collection to finish and the cleanup """
+        self._job.done.wait()
         LOG.info('finish shutting down %s', self._name)
 
     def _validate(self, val, name):
@@ -522,59 +771,6 @@ class CollectorExec(object):
             raise ValueError('%s is not set' % name)
 
 
-class CollectorThread(threading.Thread):
-    def __init__(self, name, collector_instance, interval):
-        super(CollectorThread, self).__init__()
-        self.name = name
-        self.collector_instance = collector_instance
-        self.interval = interval
-        self.exit = False
-
-    def run(self):
-        LOG.info('started collector thread: %s', self.name)
-        while not self.exit:
-            start = time.time()
-            try:
-                LOG.info("start one collection for collector %s", self.name)
-                self.collector_instance()
-                LOG.info("finish one collection for collector %s", self.name)
-            except:
-                LOG.exception('failed to execute collector %s', self.name)
-            self.sleep_responsively(start)
-        self.collector_instance.cleanup()
-
-    def sleep_responsively(self, start):
-        max_sleepsec = 5
-        end = time.time()
-        sleepsec = self.interval - (end - start) if self.interval > (end - start) else 0
-        while not self.exit and sleepsec > 0:
-            sleepsec = sleepsec if sleepsec < max_sleepsec else max_sleepsec
-            time.sleep(sleepsec)
-            end = time.time()
-            sleepsec = self.interval - (end - start) if self.interval > (end - start) else 0
-
-
-class NonBlockingQueue(Queue):
-    dropped = 0
-
-    def nput(self, value):
-        """A nonblocking put, that simply logs and discards the value when the
-           queue is full, and returns false if we dropped."""
-        try:
-            self.put(value, False)
-        except Full:
-            NonBlockingQueue.dropped += 1
-            if NonBlockingQueue.dropped % 50 == 0:
-                LOG.error("DROPPED LINE: %s", value)
-
-            if NonBlockingQueue.dropped > MAX_DROPPED_LINES_TO_START:
-                LOG.error("Too many lines dropped. Let's exit")
-                os._exit(1)
-
-            return False
-        return True
-
-
 # noinspection PyDictCreation
 class Sender(threading.Thread):
     def __init__(self, token, readq, options, tags):
@@ -586,13 +782,22 @@ class Sender(threading.Thread):
         self.http_username = options.http_username
         self.http_password = options.http_password
         self.ssl = options.ssl
+        # one SSL context for all the connections, which are kept open between batches
+        self.http_pool = HTTPConnectionPool(self.ssl, compression=options.http_compression,
+                                            ssl_context=unverified_ssl_context() if self.ssl else None)
         self.tags = tags
         self.maxtags = options.maxtags
+        # the points are encoded straight into the payload, in between these
+        self.encoder = PutEncoder(tags, self.maxtags, LOG)
+        self.payload_prefix = '{"token":%s,"metrics":[' % json.dumps(token)
         self.dryrun = options.dryrun
         self.current_tsd = -1
         self.count = 0
         self.byteSize = 0
         self.blacklisted_hosts = set()
+        self.batcher = Batcher(options.max_batch_bytes, options.max_batch_points, options.max_linger_ms)
+        self.last_stats = time.time()
+        self.first_sent = False
         random.shuffle(self.hosts)
 
     def shutdown(self):
@@ -603,46 +808,39 @@ class Sender(threading.Thread):
         """Main loop.  A simple scheduler.  Loop waiting for 5
            seconds for data on the queue.  If there's no data, just
            loop and make sure our connection is still open.  If there
-           is data, wait 5 more seconds and grab all of the pending data and
-           send it.  A little better than sending every line as its
-           own packet."""
+           is data, keep batching it until the batcher tells us to flush
+           (enough points or bytes, or the first point waited long
+           enough), then send it.  A little better than sending every
+           line as its own packet."""
 
         errors = 0  # How many uncaught exceptions in a row we got.
         LOG.info('sender thread started')
         while not self.exit:
-            metrics = []
-            byte_count = 0
+            lines = []
             try:
-                try:
-                    line = self.readq.get(True, 5)
-                except Empty:
+                self.maybe_report_stats()
+                # the spooled data points go out once we caught up
+                self.readq.refill()
+                if not self.batcher.fill(self.readq, lines, 5):
                     time.sleep(5)  # Wait for more data
                     self.readq.nput("%s %d %d" % ("collector.byteSize", time.time(), self.byteSize))
                     self.count += 1
                     self.readq.nput("%s %d %d" % ("collector.batchCount", time.time(), self.count))
                     continue
-                metrics.append(self.process(line))
-                byte_count += len(line)
-                while byte_count < MAX_SENDQ_SIZE:
-                    # prevents self.sendq fast growing in case of sending fails
-                    # in send_data()
-                    try:
-                        line = self.readq.get(False)
-                    except Empty:
-                        break
-                    metrics.append(self.process(line))
-                    byte_count += len(line)
-
-                self.send_data_via_http(metrics)
+                byte_count = sum(len(line) for line in lines)
+
+                self.send_data_via_http(lines)
+                if not self.first_sent:
+                    self.first_sent = True
+                    STATS.gauge('startup.first_datapoint_ms').set(1000 * (time.time() - START_TIME))
+                    LOG.info('first data points sent %.1fs after start', time.time() - START_TIME)
                 self.byteSize = byte_count
                 LOG.info('send %d bytes, readq size %d', byte_count, self.readq.qsize())
                 errors = 0  # We managed to do a successful iteration.
             except urllib2.URLError:
-                if self.readq.qsize() > MAX_READQ_SIZE_TO_START:
-                    LOG.error("sender thread exceeds the max number of url errors (%d). exit", MAX_READQ_SIZE_TO_START)
-                    shutdown()
-                    raise
-                LOG.exception('url exception in Sender. readq size %d < threshold %d, ignoring', self.readq.qsize(), MAX_READQ_SIZE_TO_START)
+                # the readq spools or downsamples what doesn't fit while we wait for the server
+                LOG.exception('url exception in Sender. readq size %d, retrying later', self.readq.qsize())
+                self.readq.requeue(lines)
                 time.sleep(50)
                 continue
             except (ArithmeticError, EOFError, EnvironmentError, LookupError, ValueError):
@@ -660,86 +858,37 @@ class Sender(threading.Thread):
                 raise
         LOG.info('sender thread exited')
 
-    def process(self, line):
-        parts = line.split(None, 3)
-        # not all metrics have metric-specific tags
-        if len(parts) == 4:
-            (metric, timestamp, value, raw_tags) = parts
-        else:
-            (metric, timestamp, value) = parts
-            raw_tags = ""
-        # process the tags
-        metric_tags = {}
-        try:
-            for tag in raw_tags.strip().split():
-                (tag_key, tag_value) = tag.split("=", 1)
-                metric_tags[tag_key] = tag_value
-        except:
-            LOG.exception("bad tag string. original string: %s", line)
-            raise ValueError("bad formatted metric string")
-        metric_entry = {}
-        metric_entry["metric"] = metric
-        metric_entry["timestamp"] = long(timestamp)
-        try:
-            metric_entry["value"] = long(value)
-        except:
-            metric_entry["value"] = float(value)
-        metric_entry["tags"] = dict(self.tags).copy()
-        if len(metric_tags) + len(metric_entry["tags"]) > self.maxtags:
-            metric_tags_orig = set(metric_tags)
-            subset_metric_keys = frozenset(metric_tags[:len(metric_tags[:self.maxtags - len(metric_entry["tags"])])])
-            metric_tags = dict((k, v) for k, v in metric_tags.iteritems() if k in subset_metric_keys)
-            LOG.error("Exceeding maximum permitted metric tags - removing %s for metric %s",
-                      str(metric_tags_orig - set(metric_tags)), metric)
-        metric_entry["tags"].update(metric_tags)
-        return metric_entry
-
-    def send_data_via_http(self, metrics):
-        data = {'token': self.token, 'metrics': metrics}
+    def maybe_report_stats(self):
+        """Queues the batching histograms and STATS once every SENDER_STATS_INTERVAL."""
+        now = time.time()
+        if now - self.last_stats < SENDER_STATS_INTERVAL:
+            return
+        self.last_stats = now
+        for metric, tags, value in self.batcher.metrics('collector.sender') + STATS.collect():
+            if isinstance(value, float):
+                value = '%.3f' % value
+            self.readq.nput(" ".join(("%s %d %s" % (metric, now, value),) + tags))
+
+    def send_data_via_http(self, lines):
+        payload = self.encoder.encode_lines(lines, self.payload_prefix, ']}')
         if self.dryrun:
-            print "Would have sent:\n%s" % json.dumps(data,
+            print "Would have sent:\n%s" % json.dumps(json.loads(payload),
                                                       sort_keys=True,
                                                       indent=4)
             return
 
         if (self.current_tsd == -1) or (len(self.hosts) > 1):
             self.pick_connection()
-        # print "Using server: %s:%s" % (self.host, self.port)
-        # url = "http://%s:%s/api/put?details" % (self.host, self.port)
-        # print "Url is %s" % url
-        LOG.debug("Sending metrics to http://%s:%s/api/put?details",
-                  self.host, self.port)
-        if self.ssl:
-            protocol = "https"
-        else:
-            protocol = "http"
-        req = urllib2.Request("%s://%s:%s/api/put?details" % (
-            protocol, self.host, self.port))
+        LOG.debug("Sending metrics to %s", self.http_pool.url(self.host, self.port, "/api/put?details"))
+        headers = {"Content-Type": "application/json", "Cookie": "_token=" + self.token}
         if self.http_username and self.http_password:
-            req.add_header("Authorization", "Basic %s"
-                           % base64.b64encode("%s:%s" % (self.http_username, self.http_password)))
-        req.add_header("Content-Type", "application/json")
-        req.add_header("Cookie", "_token="+self.token)
+            headers["Authorization"] = "Basic %s" % base64.b64encode("%s:%s" % (self.http_username, self.http_password))
         try:
-            payload = json.dumps(data)
             LOG.info('put request payload %d', len(payload))
-            if self.ssl:
-                ctx = ssl.create_default_context()
-                ctx.check_hostname = False
-                ctx.verify_mode = ssl.CERT_NONE
-                response = urllib2.urlopen(req, payload, context=ctx)
-            else:
-                response = urllib2.urlopen(req, payload)
-            LOG.debug("Received response %s", response.getcode())
-            # print "Got response code: %s" % response.getcode()
-            # print "Content:"
-            # for line in response:
-            #     print line,
-            #     print
+            self.http_pool.post(self.host, self.port, "/api/put?details", payload, headers)
+            LOG.debug("Sent %d metrics", len(lines))
         except urllib2.HTTPError, e:
             LOG.exception("Got error when sending to server %s", self.host)
-            # for line in http_error:
-            #   print line,
         except:
             LOG.exception("unknown error when sending to server %s:%d", self.host, self.port)
             raise
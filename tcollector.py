@@ -27,6 +27,7 @@ import logging
 import os
 import random
 import re
+import select
 import signal
 import socket
 import subprocess
@@ -36,12 +37,28 @@ import time
 import json
 import urllib2
 import base64
+from collections import deque
 from logging.handlers import RotatingFileHandler
-from Queue import Queue
 from Queue import Empty
 from Queue import Full
 from optparse import OptionParser
 
+from collectors.lib.batching import Batcher
+from collectors.lib.batching import BulkQueue
+from collectors.lib.confwatch import watcher
+from collectors.lib.datapoint import DataPoint
+from collectors.lib.datapoint import MAX_LINE_LENGTH
+from collectors.lib.datapoint import MAX_SECONDS_TIMESTAMP
+from collectors.lib.datapoint import parse_line
+from collectors.lib.httppool import COMPRESSIONS
+from collectors.lib.httppool import HTTPConnectionPool
+from collectors.lib.putjson import PutEncoder
+from collectors.lib.sampler import DEFAULT_DURATION
+from collectors.lib.sampler import Profiler
+from collectors.lib.scheduler import budget_skips
+from collectors.lib.selfmetrics import MetricsRegistry
+from collectors.lib.spool import Spool
+
 
 # global variables.
 COLLECTORS = {}
@@ -59,7 +76,33 @@ MAX_REASONABLE_TIMESTAMP = 1600000000  # Good until September 2020 :)
 # a collector is dead and restarting it
 ALLOWED_INACTIVITY_TIME = 600  # seconds
 MAX_SENDQ_SIZE = 10000
+DEFAULT_MAX_BATCH_BYTES = 1024 * 1024
+DEFAULT_MAX_LINGER_MS = 1000
 MAX_READQ_SIZE = 100000
+DEFAULT_SPOOL_REPLAY_RATE = 2000  # data points per second
+# A TSD connection that doesn't take any of our data for this long is dropped.
+TSD_SEND_TIMEOUT = 15  # seconds
+# How long to wait before reopening the TSD connections we lost, as long as
+# we still have at least one.
+TSD_RECONNECT_DELAY = 30  # seconds
+# A TSD connection holding this much data not written yet isn't given any
+# more until it writes some of it out.
+TSD_MAX_BUFFERED_BYTES = 8 * 1024 * 1024
+# After failing to send to the TSDs, we wait a second before trying again,
+# then twice as long after each failure in a row, up to this long.
+MAX_SEND_BACKOFF = 64  # seconds
+# How long the event-driven ReaderThread blocks waiting for collector output
+# before waking up anyway to evict old dedup keys and check ALIVE.
+READER_POLL_TIMEOUT = 1.0  # seconds
+# The dedup caches are evicted one time bucket of this many seconds at a time.
+EVICT_BUCKET_WIDTH = 60
+# The CollectorPoller used by the ReaderThread, or None when the reader runs
+# in the legacy polling mode.
+POLLER = None
+# Our own metrics, sent every --stats-interval seconds unless
+# --no-tcollector-stats is given.
+STATS = MetricsRegistry('tcollector.')
+DEFAULT_STATS_INTERVAL = 60  # seconds
 
 
 def register_collector(collector):
@@ -78,9 +121,24 @@ def register_collector(collector):
     COLLECTORS[collector.name] = collector
 
 
-class ReaderQueue(Queue):
+class ReaderQueue(BulkQueue):
     """A Queue for the reader thread"""
 
+    def __init__(self, maxsize=0):
+        BulkQueue.__init__(self, maxsize)
+        self.high_water = 0  # The longest we've been since the last report.
+
+    def _put(self, item):
+        BulkQueue._put(self, item)
+        if len(self.queue) > self.high_water:
+            self.high_water = len(self.queue)
+
+    def report_high_water(self):
+        """Returns the high-water mark and starts a new one."""
+        with self.mutex:
+            high_water, self.high_water = self.high_water, len(self.queue)
+        return high_water
+
     def nput(self, value):
         """A nonblocking put, that simply logs and discards the value when the
            queue is full, and returns false if we dropped."""
@@ -92,6 +150,166 @@ class ReaderQueue(Queue):
         return True
 
 
+class CollectorPoller(object):
+    """Wraps an epoll object watching the stdout/stderr pipes of every
+       running collector, so that the ReaderThread only wakes up when one
+       of them has something for us to read."""
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.closed_events = select.EPOLLERR | select.EPOLLHUP
+        self.events = select.EPOLLIN | select.EPOLLPRI | self.closed_events
+        # Maps a file descriptor to the collector owning it.
+        self.fds = {}
+
+    def register(self, col):
+        """Starts watching the pipes of the given collector's process."""
+        for pipe in (col.proc.stdout, col.proc.stderr):
+            fd = pipe.fileno()
+            self.fds[fd] = col
+            try:
+                self.epoll.register(fd, self.events)
+            except IOError, (err, msg):
+                if err != errno.EEXIST:
+                    raise
+                self.epoll.modify(fd, self.events)
+
+    def unregister(self, col):
+        """Stops watching every pipe owned by the given collector."""
+        for fd, owner in self.fds.items():
+            if owner is col:
+                self.discard(fd)
+
+    def discard(self, fd):
+        """Stops watching a single file descriptor, if we still were."""
+        if self.fds.pop(fd, None) is None:
+            return
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            # the fd was already closed, which removes it from the epoll set
+            pass
+
+    def poll(self, timeout):
+        """Waits at most timeout seconds for collector output.
+
+        Returns: the set of collectors that have something to be read.
+        """
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, (err, msg):
+            if err != errno.EINTR:
+                raise
+            return set()
+        ready = set()
+        for fd, event in events:
+            col = self.fds.get(fd)
+            if col is None:
+                continue
+            ready.add(col)
+            if event & self.closed_events:
+                # a pipe that hung up stays readable forever, so we read
+                # what is left of it once and then stop watching it
+                self.discard(fd)
+                if not col.exited:
+                    col.exited = time.time()
+        return ready
+
+    def close(self):
+        self.fds.clear()
+        self.epoll.close()
+
+
+class DedupCache(object):
+    """Keeps track of the last value seen for each combination of
+       (metric, tags) of a collector, to suppress duplicate values.
+
+       Entries only hold the value and two timestamps, the line of the last
+       repeated value is rebuilt when it needs to be replayed.  Entries are
+       grouped in time buckets by the timestamp at which their value was
+       first seen, so eviction drops whole buckets instead of looking at
+       every entry."""
+
+    def __init__(self, bucket_width=EVICT_BUCKET_WIDTH):
+        self.bucket_width = bucket_width
+        # Maps (metric, tags) to (value, first_ts, last_ts) where:
+        #  value: Last value seen.
+        #  first_ts: Time at which we saw the value for the first time.
+        #  last_ts: Time at which we saw the value for the last time, the
+        #    value was repeated if it's different from first_ts.
+        self.entries = {}
+        # Maps first_ts // bucket_width to the set of keys in that bucket.
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns (value, first_ts, last_ts) for the given key, or None."""
+        return self.entries.get(key)
+
+    def bucket(self, timestamp):
+        """Returns the bucket of a timestamp, in seconds or milliseconds."""
+        if timestamp > MAX_SECONDS_TIMESTAMP:
+            timestamp //= 1000
+        return timestamp // self.bucket_width
+
+    def put(self, key, value, timestamp):
+        """Records a value that is going to be sent."""
+        bucket = self.bucket(timestamp)
+        entry = self.entries.get(key)
+        if entry is None:
+            # intern the key's strings, series of the same collector share
+            # most of their metric names and tags.
+            metric, tags = key
+            key = (intern(metric), tuple(intern(tag) for tag in tags))
+        else:
+            old_bucket = self.bucket(entry[1])
+            if old_bucket == bucket:
+                # already in the right bucket, only the value changed
+                self.entries[key] = (value, timestamp, timestamp)
+                return
+            keys = self.buckets[old_bucket]
+            keys.discard(key)
+            if not keys:
+                del self.buckets[old_bucket]
+        self.entries[key] = (value, timestamp, timestamp)
+        self.buckets.setdefault(bucket, set()).add(key)
+
+    def repeat(self, key, timestamp):
+        """Records that the last value was seen again at the given time."""
+        value, first_ts, _ = self.entries[key]
+        self.entries[key] = (value, first_ts, timestamp)
+
+    def evict(self, cut_off):
+        """Removes the entries whose value was first seen before cut_off.
+
+        Returns: the number of entries removed.
+        """
+        last_bucket = self.bucket(cut_off)
+        evicted = 0
+        for bucket in [b for b in self.buckets if b < last_bucket]:
+            for key in self.buckets.pop(bucket):
+                del self.entries[key]
+                evicted += 1
+        return evicted
+
+    def footprint(self):
+        """Returns an estimate of the memory used by this cache, in bytes.
+
+           Tags shared by several series are counted once per series, and
+           metric names are not counted at all, since they are interned."""
+        getsizeof = sys.getsizeof
+        size = getsizeof(self.entries) + getsizeof(self.buckets)
+        for keys in self.buckets.itervalues():
+            size += getsizeof(keys)
+        for key, entry in self.entries.iteritems():
+            size += getsizeof(key) + getsizeof(key[1]) + getsizeof(entry)
+            for tag in key[1]:
+                size += getsizeof(tag)
+        return size
+
+
 class Collector(object):
     """A Collector is a script that is run that gathers some data
        and prints it out in standard TSD format on STDOUT.  This
@@ -112,21 +330,44 @@ class Collector(object):
         self.mtime = mtime
         self.generation = GENERATION
         self.buffer = ""
-        self.datalines = []
-        # Maps (metric, tags) to (value, repeated, line, timestamp) where:
-        #  value: Last value seen.
-        #  repeated: boolean, whether the last value was seen more than once.
-        #  line: The last line that was read from that collector.
-        #  timestamp: Time at which we saw the value for the first time.
-        # This dict is used to keep track of and remove duplicate values.
+        self.datalines = deque()
+        # This cache is used to keep track of and remove duplicate values.
         # Since it might grow unbounded (in case we see many different
         # combinations of metrics and tags) someone needs to regularly call
         # evict_old_keys() to remove old entries.
-        self.values = {}
+        self.values = DedupCache()
         self.lines_sent = 0
         self.lines_received = 0
         self.lines_invalid = 0
         self.last_datapoint = int(time.time())
+        self.parse_timer = STATS.timer('collector.parse', collector=colname)
+        self.spawned = 0  # When our process was spawned, to the subsecond.
+        self.exited = 0  # When we saw the end of its output, likewise.
+        self.duration = STATS.timer('collector.duration', collector=colname)
+        self.cpu = STATS.timer('collector.cpu', collector=colname)
+        self.overruns = STATS.counter('collector.overruns', collector=colname)
+        self.budget_overruns = STATS.counter('collector.budget_overruns',
+                                             collector=colname)
+        self.skips = STATS.counter('collector.skips', collector=colname)
+
+    def record_run(self, rusage, budget=0):
+        """Records the wall and CPU time of a run of a periodic collector
+           that just exited, given its resource usage.  Returns how many of
+           its next runs to skip for going over the CPU budget."""
+        cpu = rusage.ru_utime + rusage.ru_stime
+        # we're only reaped every so often, its pipes were closed when it
+        # exited
+        self.duration.observe(1000 * ((self.exited or time.time())
+                                      - self.spawned))
+        self.cpu.observe(1000 * cpu)
+        skip = budget_skips(cpu, budget)
+        if skip:
+            self.budget_overruns.inc()
+            self.skips.inc(skip)
+            LOG.warning('collector %s used %.2fs of CPU, over its budget of '
+                        '%.2fs, skipping its next %d runs', self.name, cpu,
+                        budget, skip)
+        return skip
 
     def read(self):
         """Read bytes from our subprocess and store them in our temporary
@@ -155,33 +396,39 @@ class Collector(object):
         # out a bunch of data points at one time and we get some weird sized
         # chunk.  This read call is non-blocking.
         try:
-            self.buffer += self.proc.stdout.read()
-            if len(self.buffer):
-                LOG.debug('reading %s, buffer now %d bytes',
-                          self.name, len(self.buffer))
+            chunk = self.proc.stdout.read()
+            if chunk:
+                LOG.debug('reading %s, got %d bytes, %d buffered',
+                          self.name, len(chunk), len(self.buffer))
         except IOError, (err, msg):
             if err != errno.EAGAIN:
                 raise
+            return
         except AttributeError:
             # sometimes the process goes away in another thread and we don't
             # have it anymore, so log an error and bail
             LOG.exception('caught exception, collector process went away while reading stdout')
+            return
         except:
             LOG.exception('uncaught exception in stdout read')
             return
+        if not chunk:
+            # the end of its output, it exited
+            if not self.exited:
+                self.exited = time.time()
+            return
 
-        # iterate for each line we have
-        while self.buffer:
-            idx = self.buffer.find('\n')
-            if idx == -1:
-                break
-
-            # one full line is now found and we can pull it out of the buffer
-            line = self.buffer[0:idx].strip()
-            if line:
-                self.datalines.append(line)
-                self.last_datapoint = int(time.time())
-            self.buffer = self.buffer[idx+1:]
+        # split the whole chunk in one go, the last piece is the beginning
+        # of a line we haven't fully read yet (or '' if the chunk ended
+        # with a newline) and stays in the buffer.
+        if self.buffer:
+            chunk = self.buffer + chunk
+        lines = chunk.split('\n')
+        self.buffer = lines.pop()
+        count = len(self.datalines)
+        self.datalines.extend(line for line in map(str.strip, lines) if line)
+        if len(self.datalines) > count:
+            self.last_datapoint = int(time.time())
 
     def collect(self):
         """Reads input from the collector and returns the lines up to whomever
@@ -190,16 +437,19 @@ class Collector(object):
 
         while self.proc is not None:
             self.read()
-            if not len(self.datalines):
+            if not self.datalines:
                 return
-            while len(self.datalines):
-                yield self.datalines.pop(0)
+            popleft = self.datalines.popleft
+            while self.datalines:
+                yield popleft()
 
     def shutdown(self):
         """Cleanly shut down the collector"""
 
         if not self.proc:
             return
+        if POLLER is not None:
+            POLLER.unregister(self)
         try:
             if self.proc.poll() is None:
                 kill(self.proc)
@@ -221,11 +471,9 @@ class Collector(object):
         Args:
           cut_off: A UNIX timestamp.  Any value that's older than this will be
             removed from the cache.
+        Returns: the number of entries removed.
         """
-        for key in self.values.keys():
-            time = self.values[key][3]
-            if time < cut_off:
-                del self.values[key]
+        return self.values.evict(cut_off)
 
 
 class StdinCollector(Collector):
@@ -266,7 +514,7 @@ class ReaderThread(threading.Thread):
        All data read is put into the self.readerq Queue, which is
        consumed by the SenderThread."""
 
-    def __init__(self, dedupinterval, evictinterval):
+    def __init__(self, dedupinterval, evictinterval, poller=None):
         """Constructor.
             Args:
               dedupinterval: If a metric sends the same value over successive
@@ -278,6 +526,9 @@ class ReaderThread(threading.Thread):
                 combination of (metric, tags).  Values older than
                 evictinterval will be removed from the cache to save RAM.
                 Invariant: evictinterval > dedupinterval
+              poller: A CollectorPoller.  If given, the reader blocks until
+                a collector has some output instead of looping every second
+                over all the collectors.
         """
         assert evictinterval > dedupinterval, "%r <= %r" % (evictinterval,
                                                             dedupinterval)
@@ -288,6 +539,14 @@ class ReaderThread(threading.Thread):
         self.lines_dropped = 0
         self.dedupinterval = dedupinterval
         self.evictinterval = evictinterval
+        self.poller = poller
+        self.lastevict_time = 0
+        self.lastreport_time = 0
+        self.evicted = 0
+        self.dedup_checks = 0  # Lines looked up in the dedup caches.
+        self.dedup_hits = 0  # Lines suppressed as repeated values.
+        self.last_dedup = (0, 0)  # The above at the last report.
+        self.loop_timer = STATS.timer('reader.loop')
 
     def run(self):
         """Main loop for this thread.  Just reads from collectors,
@@ -296,55 +555,123 @@ class ReaderThread(threading.Thread):
 
         LOG.debug("ReaderThread up and running")
 
-        lastevict_time = 0
-        # we loop every second for now.  ideally we'll setup some
-        # select or other thing to wait for input on our children,
-        # while breaking out every once in a while to setup selects
-        # on new children.
+        if self.poller is not None:
+            return self.run_event_loop()
+
+        # we loop every second, see run_event_loop() for the version
+        # waiting on the collectors' pipes instead.
         while ALIVE:
+            start = time.time()
             for col in all_living_collectors():
-                for line in col.collect():
-                    self.process_line(col, line)
+                self.process_collector(col)
 
-            if self.dedupinterval != 0:  # if 0 we do not use dedup
-                now = int(time.time())
-                if now - lastevict_time > self.evictinterval:
-                    lastevict_time = now
-                    now -= self.evictinterval
-                    for col in all_collectors():
-                        col.evict_old_keys(now)
+            self.maybe_evict()
+            self.loop_timer.observe(1000 * (time.time() - start))
 
             # and here is the loop that we really should get rid of, this
             # just prevents us from spinning right now
             time.sleep(1)
 
+    def run_event_loop(self):
+        """Main loop when we have a poller.  Sleeps until one of the
+           collectors' pipes becomes readable, and only reads from those."""
+
+        while ALIVE:
+            ready = self.poller.poll(READER_POLL_TIMEOUT)
+            start = time.time()
+            for col in ready:
+                # the collector may have been reaped in the meantime
+                if col.proc is None:
+                    continue
+                self.process_collector(col)
+
+            self.maybe_evict()
+            self.loop_timer.observe(1000 * (time.time() - start))
+
+    def process_collector(self, col):
+        """Processes the lines a collector printed since the last time."""
+        start = time.time()
+        for line in col.collect():
+            self.process_line(col, line)
+        col.parse_timer.observe(1000 * (time.time() - start))
+
+    def maybe_evict(self):
+        """Evicts old entries from the dedup caches, one time bucket at a
+           time, and reports their memory footprint every evictinterval."""
+
+        if self.dedupinterval == 0:  # if 0 we do not use dedup
+            return
+        now = int(time.time())
+        if now - self.lastevict_time < EVICT_BUCKET_WIDTH:
+            return
+        for col in all_collectors():
+            self.evicted += col.evict_old_keys(now - self.evictinterval)
+        self.lastevict_time = now
+        if now - self.lastreport_time > self.evictinterval:
+            self.lastreport_time = now
+            self.report_dedup_footprint()
+            self.evicted = 0
+
+    def report_dedup_footprint(self):
+        """Logs the size and estimated memory use of the dedup caches."""
+
+        entries = 0
+        footprint = 0
+        for col in all_collectors():
+            entries += len(col.values)
+            footprint += col.values.footprint()
+        LOG.info('dedup caches: %d series, ~%d KB, %d series evicted since '
+                 'the last report', entries, footprint / 1024, self.evicted)
+
+    def report_stats(self):
+        """Returns (metric, tags, value) tuples for STATS: our line counts,
+           how well dedup works, how full the queue got, and the line counts
+           of each collector."""
+        checks, hits = self.dedup_checks, self.dedup_hits
+        last_checks, last_hits = self.last_dedup
+        self.last_dedup = (checks, hits)
+        hit_ratio = 0.0
+        if checks > last_checks:
+            hit_ratio = float(hits - last_hits) / (checks - last_checks)
+        stats = [
+            ('reader.lines_collected', (), self.lines_collected),
+            ('reader.lines_dropped', (), self.lines_dropped),
+            ('reader.dedup_checks', (), checks),
+            ('reader.dedup_hits', (), hits),
+            ('reader.dedup_hit_ratio', (), hit_ratio),
+            ('reader.queue_depth', (), self.readerq.qsize()),
+            ('reader.queue_high_water', (), self.readerq.report_high_water()),
+        ]
+        for col in all_living_collectors():
+            tags = ('collector=' + col.name,)
+            stats.append(('collector.lines_sent', tags, col.lines_sent))
+            stats.append(('collector.lines_received', tags,
+                          col.lines_received))
+            stats.append(('collector.lines_invalid', tags, col.lines_invalid))
+        return stats
+
     def process_line(self, col, line):
         """Parses the given line and appends the result to the reader queue."""
 
         self.lines_collected += 1
 
         col.lines_received += 1
-        if len(line) >= 1024:  # Limit in net.opentsdb.tsd.PipelineFactory
+        if len(line) >= MAX_LINE_LENGTH:
             LOG.warning('%s line too long: %s', col.name, line)
             col.lines_invalid += 1
             return
-        parsed = re.match('^([-_./a-zA-Z0-9]+)\s+' # Metric name.
-                          '(\d+\.?\d+)\s+'               # Timestamp.
-                          '(\S+?)'                 # Value (int or float).
-                          '((?:\s+[-_./a-zA-Z0-9]+=[-_./a-zA-Z0-9]+)*)$', # Tags
-                          line)
-        if parsed is None:
+        dp = parse_line(line)
+        if dp is None:
             LOG.warning('%s sent invalid data: %s', col.name, line)
             col.lines_invalid += 1
             return
-        metric, timestamp, value, tags = parsed.groups()
-        timestamp = int(timestamp)
+        metric, timestamp, value, tags, _ = dp
 
         # If there are more than 11 digits we're dealing with a timestamp
         # with millisecond precision
-        if len(str(timestamp)) > 11:
-            global MAX_REASONABLE_TIMESTAMP
-            MAX_REASONABLE_TIMESTAMP = MAX_REASONABLE_TIMESTAMP * 1000
+        max_timestamp = MAX_REASONABLE_TIMESTAMP
+        if dp.is_millis():
+            max_timestamp *= 1000
 
         # De-dupe detection...  To reduce the number of points we send to the
         # TSD, we suppress sending values of metrics that don't change to
@@ -357,20 +684,23 @@ class ReaderThread(threading.Thread):
         #
         if self.dedupinterval != 0:  # if 0 we do not use dedup
             key = (metric, tags)
-            if key in col.values:
+            entry = col.values.get(key)
+            self.dedup_checks += 1
+            if entry is not None:
+                last_value, first_ts, last_ts = entry
                 # if the timestamp isn't > than the previous one, ignore this value
-                if timestamp <= col.values[key][3]:
-                    LOG.error("Timestamp out of order: metric=%s%s,"
+                if timestamp <= first_ts:
+                    LOG.error("Timestamp out of order: metric=%s %s,"
                               " old_ts=%d >= new_ts=%d - ignoring data point"
-                              " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              " (value=%r, collector=%s)", metric, ' '.join(tags),
+                              first_ts, timestamp, value, col.name)
                     col.lines_invalid += 1
                     return
-                elif timestamp >= MAX_REASONABLE_TIMESTAMP:
-                    LOG.error("Timestamp is too far out in the future: metric=%s%s"
+                elif timestamp >= max_timestamp:
+                    LOG.error("Timestamp is too far out in the future: metric=%s %s"
                               " old_ts=%d, new_ts=%d - ignoring data point"
-                              " (value=%r, collector=%s)", metric, tags,
-                              col.values[key][3], timestamp, value, col.name)
+                              " (value=%r, collector=%s)", metric, ' '.join(tags),
+                              first_ts, timestamp, value, col.name)
                     return
 
                 # if this data point is repeated, store it but don't send.
@@ -378,46 +708,226 @@ class ReaderThread(threading.Thread):
                 # we send the timestamp when this metric first became the current
                 # value instead of the last.  Fall through if we reach
                 # the dedup interval so we can print the value.
-                if (col.values[key][0] == value and
-                    (timestamp - col.values[key][3] < self.dedupinterval)):
-                    col.values[key] = (value, True, line, col.values[key][3])
+                if (last_value == value and
+                    (timestamp - first_ts < self.dedupinterval)):
+                    col.values.repeat(key, timestamp)
+                    self.dedup_hits += 1
                     return
 
                 # we might have to append two lines if the value has been the same
                 # for a while and we've skipped one or more values.  we need to
                 # replay the last value we skipped (if changed) so the jumps in
                 # our graph are accurate,
-                if ((col.values[key][1] or
-                    (timestamp - col.values[key][3] >= self.dedupinterval))
-                    and col.values[key][0] != value):
+                if ((last_ts != first_ts or
+                    (timestamp - first_ts >= self.dedupinterval))
+                    and last_value != value):
                     col.lines_sent += 1
-                    if not self.readerq.nput(col.values[key][2]):
+                    if not self.readerq.nput(DataPoint(metric, last_ts,
+                                                       last_value, tags, None)):
                         self.lines_dropped += 1
 
             # now we can reset for the next pass and send the line we actually
-            # want to send
-            # col.values is a dict of tuples, with the key being the metric and
-            # tags (essentially the same as wthat TSD uses for the row key).
-            # The array consists of:
-            # [ the metric's value, if this value was repeated, the line of data,
-            #   the value's timestamp that it last changed ]
-            col.values[key] = (value, False, line, timestamp)
+            # want to send.  col.values is keyed by the metric and tags
+            # (essentially the same as wthat TSD uses for the row key).
+            col.values.put(key, value, timestamp)
 
         col.lines_sent += 1
-        if not self.readerq.nput(line):
+        if not self.readerq.nput(dp):
             self.lines_dropped += 1
 
 
+class TSDConnection(object):
+    """A persistent connection to the telnet interface of a TSD.
+
+       Data is written without ever blocking: whatever the socket doesn't
+       accept right away stays buffered here until the next flush(), so a
+       slow TSD only holds back the series sent through this connection,
+       up to TSD_MAX_BUFFERED_BYTES, see full().  The TSD only answers `version' commands and failed puts, drain()
+       reads and logs those as they come in."""
+
+    def __init__(self, host, port, sock=None):
+        self.host = host
+        self.port = port
+        self.sock = None
+        # (data, data points, when queued) not fully written yet.
+        self.chunks = deque()
+        self.offset = 0  # Bytes of self.chunks[0] already written.
+        self.buffered = 0  # Bytes of self.chunks not written yet.
+        self.inbuf = ''
+        self.connected_at = time.time()
+        self.last_write = time.time()  # Last time the socket took data.
+        self.verify_sent = 0  # When we sent a `version' still unanswered.
+        self.lines_sent = 0
+        self.bytes_sent = 0
+        self.put_errors = 0
+        self.last_error = None
+        self.last_report = (time.time(), 0, 0)
+        # Shared by all the connections to this TSD, across reconnects.
+        self.send_latency = STATS.timer('sender.send_latency', tsd=host,
+                                        port=port)
+        self.bytes_counter = STATS.counter('sender.bytes_sent', tsd=host,
+                                           port=port)
+        self.lines_counter = STATS.counter('sender.lines_sent', tsd=host,
+                                           port=port)
+        self.put_errors_counter = STATS.counter('sender.put_errors', tsd=host,
+                                                port=port)
+        if sock is not None:
+            self.attach(sock)
+
+    def __str__(self):
+        return '%s:%d' % (self.host, self.port)
+
+    def attach(self, sock):
+        sock.setblocking(0)
+        self.sock = sock
+        self.connected_at = self.last_write = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connect(self, timeout=TSD_SEND_TIMEOUT):
+        """Connects to the TSD, returns True if we succeeded."""
+        try:
+            addresses = socket.getaddrinfo(self.host, self.port,
+                                           socket.AF_UNSPEC,
+                                           socket.SOCK_STREAM, 0)
+        except socket.gaierror, e:
+            # Don't croak on transient DNS resolution issues.
+            if e[0] in (socket.EAI_AGAIN, socket.EAI_NONAME,
+                        socket.EAI_NODATA):
+                LOG.debug('DNS resolution failure: %s: %s', self.host, e)
+                return False
+            raise
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            sock = socket.socket(family, socktype, proto)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(sockaddr)
+            except socket.error, msg:
+                LOG.warning('Connection attempt failed to %s:%d: %s',
+                            self.host, self.port, msg)
+                sock.close()
+                continue
+            LOG.debug('Connection to %s was successful', sockaddr)
+            self.attach(sock)
+            return True
+        LOG.error('Failed to connect to %s:%d', self.host, self.port)
+        return False
+
+    def close(self):
+        """Closes the connection, returns the data points that were
+           queued on it but not fully written out."""
+        unsent = []
+        for data, datapoints, _ in self.chunks:
+            unsent.extend(datapoints)
+        self.chunks.clear()
+        self.offset = self.buffered = 0
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+        return unsent
+
+    def queue(self, data, datapoints=()):
+        """Queues data, the lines of the given data points, for writing."""
+        self.chunks.append((data, datapoints, time.time()))
+        self.buffered += len(data)
+
+    def full(self):
+        """Whether we buffered enough for the TSD, and should hold on to
+           its next data points instead of queueing them."""
+        return self.buffered >= TSD_MAX_BUFFERED_BYTES
+
+    def flush(self):
+        """Writes as much of the queued data as the socket takes without
+           blocking.  Raises socket.error if the connection is broken."""
+        while self.chunks:
+            data, datapoints, queued_at = self.chunks[0]
+            try:
+                sent = self.sock.send(buffer(data, self.offset))
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            self.last_write = time.time()
+            self.offset += sent
+            self.buffered -= sent
+            self.bytes_sent += sent
+            self.bytes_counter.inc(sent)
+            if self.offset < len(data):
+                return
+            self.chunks.popleft()
+            self.offset = 0
+            self.lines_sent += len(datapoints)
+            self.lines_counter.inc(len(datapoints))
+            self.send_latency.observe(1000 * (self.last_write - queued_at))
+
+    def drain(self):
+        """Reads whatever the TSD sent us, without blocking.  Raises
+           socket.error if the connection is broken."""
+        while True:
+            try:
+                buf = self.sock.recv(4096)
+            except socket.error, e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            if not buf:
+                raise socket.error(errno.ECONNRESET,
+                                   'connection closed by the TSD')
+            # Any answer proves the TSD is alive and reading from us.
+            self.verify_sent = 0
+            lines = (self.inbuf + buf).split('\n')
+            self.inbuf = lines.pop()[-MAX_LINE_LENGTH:]
+            for line in lines:
+                if line.startswith('put:'):
+                    self.put_errors += 1
+                    self.put_errors_counter.inc()
+                    self.last_error = line
+                elif line:
+                    LOG.debug('%s says: %s', self, line)
+
+    def verify(self):
+        """Sends a `version' command to the TSD, which drain() will read
+           the answer of.  Returns False if the previous one was never
+           answered."""
+        if self.verify_sent:
+            return False
+        self.verify_sent = time.time()
+        self.queue('version\n')
+        return True
+
+    def stalled(self, now):
+        """Whether the socket hasn't taken any of our data for too long."""
+        return self.chunks and now - self.last_write > TSD_SEND_TIMEOUT
+
+    def throughput(self, now):
+        """Returns the lines and bytes per second written since the last
+           call."""
+        then, lines, bytes = self.last_report
+        self.last_report = (now, self.lines_sent, self.bytes_sent)
+        elapsed = max(now - then, 0.001)
+        return ((self.lines_sent - lines) / elapsed,
+                (self.bytes_sent - bytes) / elapsed)
+
+
 class SenderThread(threading.Thread):
-    """The SenderThread is responsible for maintaining a connection
-       to the TSD and sending the data we're getting over to it.  This
+    """The SenderThread is responsible for maintaining connections
+       to the TSDs and sending the data we're getting over to them.  This
        thread is also responsible for doing any sort of emergency
        buffering we might need to do if we can't establish a connection
-       and we need to spool to disk.  That isn't implemented yet."""
+       and we need to spool to disk."""
 
     def __init__(self, reader, dryrun, hosts, self_report_stats, tags,
                  reconnectinterval=0, http=False, http_username=None,
-                 http_password=None, ssl=False, maxtags=8):
+                 http_password=None, ssl=False, maxtags=8, spool=None,
+                 spool_replay_rate=DEFAULT_SPOOL_REPLAY_RATE, connections=1,
+                 max_batch_bytes=DEFAULT_MAX_BATCH_BYTES,
+                 max_batch_points=MAX_SENDQ_SIZE,
+                 max_linger_ms=DEFAULT_MAX_LINGER_MS, http_compression='none',
+                 stats_interval=DEFAULT_STATS_INTERVAL):
         """Constructor.
 
         Args:
@@ -431,16 +941,33 @@ class SenderThread(threading.Thread):
           http: A boolean that controls whether or not the http endpoint is used.
           ssl: A boolean that controls whether or not the http endpoint uses ssl.
           tags: A dictionary of tags to append for every data point.
+          spool: A Spool where data points are written while the TSDs are
+            unreachable, or None to keep them in memory.
+          spool_replay_rate: How many spooled data points per second are
+            sent back once the TSDs accept our data again.
+          connections: How many connections to keep open to the TSDs, series
+            are spread across them.  Only used by the telnet interface.
+          max_batch_bytes, max_batch_points, max_linger_ms: The data points
+            are sent as soon as we have that many bytes of them, that many
+            of them, or the first of them waited that many milliseconds.
+          http_compression: The Content-Encoding of the bodies we send to
+            the http endpoint: 'none', 'gzip' or 'deflate'.
+          stats_interval: How often, in seconds, we send our own metrics
+            when self_report_stats is true.
         """
         super(SenderThread, self).__init__()
 
         self.dryrun = dryrun
         self.reader = reader
         self.tags = sorted(tags.items()) # dictionary transformed to list
+        self.tag_strings = ['%s=%s' % tag for tag in self.tags]
         self.http = http
         self.http_username = http_username
         self.http_password = http_password
         self.ssl = ssl
+        self.http_pool = None
+        if http:
+            self.http_pool = HTTPConnectionPool(ssl, compression=http_compression)
         self.hosts = hosts  # A list of (host, port) pairs.
         # Randomize hosts to help even out the load.
         random.shuffle(self.hosts)
@@ -448,13 +975,23 @@ class SenderThread(threading.Thread):
         self.current_tsd = -1  # Index in self.hosts where we're at.
         self.host = None  # The current TSD host we've selected.
         self.port = None  # The port of the current TSD.
-        self.tsd = None   # The socket connected to the aforementioned TSD.
+        self.connections = connections
+        self.conns = []  # The TSDConnections we have open.
+        self.next_connect = 0  # When to reopen the connections we lost.
         self.last_verify = 0
         self.reconnectinterval = reconnectinterval # in seconds.
-        self.time_reconnect = 0  # if reconnectinterval > 0, used to track the time.
         self.sendq = []
         self.self_report_stats = self_report_stats
+        self.stats_interval = stats_interval
+        self.last_stats = 0
         self.maxtags = maxtags # The maximum number of tags TSD will accept.
+        self.encoder = PutEncoder(tags, maxtags, LOG)
+        self.spool = spool
+        self.spool_replay_rate = spool_replay_rate
+        self.last_replay = 0
+        self.batcher = Batcher(max_batch_bytes, max_batch_points,
+                               max_linger_ms, lambda dp: len(dp.to_line()))
+        self.sendq_high_water = STATS.high_water_mark('sender.sendq_high_water')
 
     def pick_connection(self):
         """Picks up a random host/port connection."""
@@ -475,47 +1012,74 @@ class SenderThread(threading.Thread):
         self.host, self.port = hostport
         LOG.info('Selected connection: %s:%d', self.host, self.port)
 
-    def blacklist_connection(self):
-        """Marks the current TSD host we're trying to use as blacklisted.
+    def pick_host(self):
+        """Picks the healthy host/port we have the fewest connections to."""
+        healthy = [hostport for hostport in self.hosts
+                   if hostport not in self.blacklisted_hosts]
+        if not healthy:
+            LOG.info('No more healthy hosts, retry with previously blacklisted')
+            random.shuffle(self.hosts)
+            self.blacklisted_hosts.clear()
+            healthy = self.hosts
+        used = [(conn.host, conn.port) for conn in self.conns]
+        self.host, self.port = min(healthy, key=used.count)
+        LOG.info('Selected connection: %s:%d', self.host, self.port)
+        return self.host, self.port
+
+    def blacklist_connection(self, hostport=None):
+        """Marks the current TSD host we're trying to use, or the given
+           (host, port) pair, as blacklisted.
 
            Blacklisted hosts will get another chance to be elected once there
            will be no more healthy hosts."""
         # FIXME: Enhance this naive strategy.
-        LOG.info('Blacklisting %s:%s for a while', self.host, self.port)
-        self.blacklisted_hosts.add((self.host, self.port))
+        if hostport is None:
+            hostport = (self.host, self.port)
+        LOG.info('Blacklisting %s:%s for a while', *hostport)
+        self.blacklisted_hosts.add(hostport)
 
     def run(self):
         """Main loop.  A simple scheduler.  Loop waiting for 5
            seconds for data on the queue.  If there's no data, just
            loop and make sure our connection is still open.  If there
-           is data, wait 5 more seconds and grab all of the pending data and
-           send it.  A little better than sending every line as its
-           own packet."""
+           is data, keep batching it until the batcher tells us to flush
+           (enough points or bytes, or the first point waited long
+           enough), then send it.  A little better than sending every
+           line as its own packet."""
 
         errors = 0  # How many uncaught exceptions in a row we got.
+        failures = 0  # How many times in a row we failed to send.
         while ALIVE:
             try:
                 self.maintain_conn()
-                try:
-                    line = self.reader.readerq.get(True, 5)
-                except Empty:
+                self.maybe_report_stats()
+                # self.sendq may still hold what we failed to send, it
+                # counts towards the batch limits so it can't grow forever.
+                if not self.batcher.fill(self.reader.readerq, self.sendq, 5,
+                                         self.wait_for_data):
                     continue
-                self.sendq.append(line)
-                time.sleep(5)  # Wait for more data
-                while True:
-                    # prevents self.sendq fast growing in case of sending fails
-                    # in send_data()
-                    if len(self.sendq) > MAX_SENDQ_SIZE:
-                        break
-                    try:
-                        line = self.reader.readerq.get(False)
-                    except Empty:
-                        break
-                    self.sendq.append(line)
+                self.sendq_high_water.observe(len(self.sendq))
 
                 if ALIVE:
                     self.send_data()
-                errors = 0  # We managed to do a successful iteration.
+                    if self.spool is not None:
+                        self.spool_or_replay()
+                    elif self.sendq:
+                        # the TSDs don't keep up: let them write out what
+                        # they have instead of spinning on a full batch
+                        self.wait_for_data(1)
+                errors = failures = 0  # We managed to do a successful iteration.
+            except (urllib2.URLError, socket.error), e:
+                # The TSDs are unreachable: that's what the spool is for, so
+                # back off instead of counting it as an uncaught exception.
+                delay = min(2 ** failures, MAX_SEND_BACKOFF)
+                failures += 1
+                LOG.error('Failed to send data points, retrying in %ds: %s',
+                          delay, e)
+                if self.spool is not None:
+                    self.spool_sendq()
+                self.wait_for_tsd(delay)
+                continue
             except (ArithmeticError, EOFError, EnvironmentError, LookupError,
                     ValueError), e:
                 errors += 1
@@ -523,118 +1087,243 @@ class SenderThread(threading.Thread):
                     shutdown()
                     raise
                 LOG.exception('Uncaught exception in SenderThread, ignoring')
+                if self.spool is not None:
+                    self.spool_sendq()
                 time.sleep(1)
                 continue
             except:
                 LOG.exception('Uncaught exception in SenderThread, going to exit')
                 shutdown()
                 raise
-
-    def verify_conn(self):
-        """Periodically verify that our connection to the TSD is OK
-           and that the TSD is alive/working."""
-        # http connections don't need this
-        if self.http:
-            return True
-
-        if self.tsd is None:
-            return False
-
-        # if the last verification was less than a minute ago, don't re-verify
-        if self.last_verify > time.time() - 60:
-            return True
-
-        # in case reconnect is activated, check if it's time to reconnect
-        if self.reconnectinterval > 0 and self.time_reconnect < time.time() - self.reconnectinterval:
-            # closing the connection and indicating that we need to reconnect.
-            try:
-                self.tsd.close()
-            except socket.error, msg:
-                pass    # not handling that
-            self.time_reconnect = time.time()
-            return False
-
-        # we use the version command as it is very low effort for the TSD
-        # to respond
-        LOG.debug('verifying our TSD connection is alive')
+        for conn in self.conns:
+            self.sendq.extend(conn.close())
+        self.conns = []
+        if self.spool is not None:
+            # keep what we couldn't send for the next time we start
+            self.spool_sendq()
+            self.spool.close()
+
+    def maybe_report_stats(self):
+        """Queues up the metrics of STATS every stats_interval seconds, in
+           front of the next batch, whether we talk telnet or http."""
+        if not self.self_report_stats:
+            return
+        now = time.time()
+        if now - self.last_stats < self.stats_interval:
+            return
+        self.last_stats = now
+        ts = int(now)
+        for metric, tags, value in STATS.collect():
+            if isinstance(value, float):
+                value = '%.3f' % value
+            self.sendq.append(DataPoint(metric, ts, str(value), tags, None))
+
+    def report_stats(self):
+        """Returns (metric, tags, value) tuples for STATS: our batching
+           histograms, what we buffer for the TSDs and what we spooled."""
+        stats = self.batcher.metrics('sender')
+        for conn in self.conns:
+            tags = ('tsd=' + conn.host, 'port=%d' % conn.port)
+            stats.append(('sender.bytes_buffered', tags, conn.buffered))
+        if self.spool is not None:
+            stats.append(('spool.bytes', (), self.spool.size()))
+            stats.append(('spool.segments', (), len(self.spool.segments)))
+            stats.append(('spool.dropped_lines', (),
+                          self.spool.dropped_lines))
+        return stats
+
+    def spool_or_replay(self):
+        """Spools whatever send_data() failed to send, or else replays
+           some of the spooled data points."""
+        if self.sendq:
+            self.spool_sendq()
+        elif not self.spool.is_empty() and not any(conn.full()
+                                                   for conn in self.conns):
+            self.replay_spool()
+
+    def spool_sendq(self):
+        """Moves the data points of self.sendq to the spool."""
+        if not self.sendq:
+            return
+        LOG.debug('spooling %d data points', len(self.sendq))
         try:
-            self.tsd.sendall('version\n')
-        except socket.error, msg:
-            self.tsd = None
-            self.blacklist_connection()
-            return False
+            self.spool.append([dp.to_line() for dp in self.sendq])
+        except EnvironmentError, e:
+            LOG.error('failed to spool %d data points, dropping them: %s',
+                      len(self.sendq), e)
+        self.sendq = []
 
-        bufsize = 4096
+    def replay_spool(self):
+        """Sends the oldest spooled data points, no more than
+           spool_replay_rate per second since the last replay."""
+        now = time.time()
+        count = min(int((now - self.last_replay) * self.spool_replay_rate),
+                    MAX_SENDQ_SIZE)
+        if count <= 0:
+            return
+        self.last_replay = now
+        lines = self.spool.peek(count)
+        if not lines:
+            return
+        self.sendq = [dp for dp in map(parse_line, lines) if dp is not None]
+        try:
+            self.send_data()
+        finally:
+            # if sending failed the data points are still in the spool,
+            # we'll try again after the next successful send.
+            sent = not self.sendq
+            self.sendq = []
+        if sent:
+            self.spool.consume(len(lines))
+            LOG.info('replayed %d spooled data points', len(lines))
+
+    def wait_for_tsd(self, delay):
+        """Sleeps for delay seconds while we're not connected to a TSD,
+           moving what the reader queues up meanwhile to the spool."""
+        if self.spool is None:
+            time.sleep(delay)
+            return
+        deadline = time.time() + delay
         while ALIVE:
-            # try to read as much data as we can.  at some point this is going
-            # to block, but we have set the timeout low when we made the
-            # connection
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 1))
+            while True:
+                try:
+                    self.sendq.append(self.reader.readerq.get(False))
+                except Empty:
+                    break
+                if len(self.sendq) >= MAX_SENDQ_SIZE:
+                    self.spool_sendq()
+            self.spool_sendq()
+
+    def wait_for_data(self, delay):
+        """Sleeps for delay seconds while the reader queues up more data,
+           meanwhile writing out what our connections have buffered and
+           draining what the TSDs answer.  Returns False if we're shutting
+           down."""
+        deadline = time.time() + delay
+        while ALIVE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            if not self.conns:
+                time.sleep(remaining)
+                break
+            writable = [conn for conn in self.conns if conn.chunks]
             try:
-                buf = self.tsd.recv(bufsize)
-            except socket.error, msg:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
+                readable, writable, _ = select.select(self.conns, writable,
+                                                      [], remaining)
+            except select.error, (err, msg):
+                if err == errno.EINTR:
+                    continue
+                raise
+            for conn in readable:
+                self.pump(conn, conn.drain)
+            for conn in writable:
+                if conn.sock is not None:
+                    self.pump(conn, conn.flush)
+        return ALIVE
+
+    def pump(self, conn, method):
+        """Calls conn.drain or conn.flush, drops conn if it's broken."""
+        try:
+            method()
+        except socket.error, e:
+            self.drop_conn(conn, e)
+
+    def drop_conn(self, conn, reason, blacklist=True):
+        """Closes one of our connections.  The data points it didn't
+           write out go back to the front of self.sendq."""
+        if blacklist:
+            LOG.error('dropping connection to %s: %s', conn, reason)
+            self.blacklist_connection((conn.host, conn.port))
+        else:
+            LOG.debug('closing connection to %s: %s', conn, reason)
+        self.conns.remove(conn)
+        STATS.counter('sender.connections_dropped', tsd=conn.host,
+                      port=conn.port).inc()
+        unsent = conn.close()
+        if unsent:
+            self.sendq[:0] = unsent
+
+    def verify_conns(self):
+        """Periodically verify that our connections to the TSDs are OK
+           and that the TSDs are alive/working.
+
+           Each connection gets a `version' command once a minute, and is
+           dropped if the previous one wasn't answered meanwhile.  The
+           answers are read by drain() as they come in, so we never wait
+           for a round trip here."""
+        now = time.time()
+        for conn in list(self.conns):
+            self.pump(conn, conn.drain)
+        for conn in list(self.conns):
+            # in case reconnect is activated, check if it's time to reconnect
+            if (self.reconnectinterval > 0
+                and conn.connected_at < now - self.reconnectinterval):
+                self.drop_conn(conn, 'reconnect interval', blacklist=False)
+            elif conn.stalled(now):
+                self.drop_conn(conn, 'no data written for %ds'
+                               % TSD_SEND_TIMEOUT)
 
-            # If we don't get a response to the `version' request, the TSD
-            # must be dead or overloaded.
-            if not buf:
-                self.tsd = None
-                self.blacklist_connection()
-                return False
+        # if the last verification was less than a minute ago, don't re-verify
+        if self.last_verify > now - 60:
+            return
+        self.last_verify = now
 
-            # Woah, the TSD has a lot of things to tell us...  Let's make
-            # sure we read everything it sent us by looping once more.
-            if len(buf) == bufsize:
+        LOG.debug('verifying our TSD connections are alive')
+        for conn in list(self.conns):
+            if not conn.verify():
+                self.drop_conn(conn, 'no response to `version\'')
                 continue
-
-            # If everything is good, send out our meta stats.  This
-            # helps to see what is going on with the tcollector.
-            # TODO need to fix this for http
-            if self.self_report_stats:
-                strs = [
-                        ('reader.lines_collected',
-                         '', self.reader.lines_collected),
-                        ('reader.lines_dropped',
-                         '', self.reader.lines_dropped)
-                       ]
-
-                for col in all_living_collectors():
-                    strs.append(('collector.lines_sent', 'collector='
-                                 + col.name, col.lines_sent))
-                    strs.append(('collector.lines_received', 'collector='
-                                 + col.name, col.lines_received))
-                    strs.append(('collector.lines_invalid', 'collector='
-                                 + col.name, col.lines_invalid))
-
-                ts = int(time.time())
-                strout = ["tcollector.%s %d %d %s"
-                          % (x[0], ts, x[2], x[1]) for x in strs]
-                for string in strout:
-                    self.sendq.append(string)
-
-            break  # TSD is alive.
-
-        # if we get here, we assume the connection is good
-        self.last_verify = time.time()
-        return True
+            self.pump(conn, conn.flush)
+
+        for conn in self.conns:
+            lines_per_s, bytes_per_s = conn.throughput(now)
+            LOG.debug('%s: %.1f lines/s, %.1f KB/s, %d bytes buffered, '
+                      '%d failed puts', conn, lines_per_s,
+                      bytes_per_s / 1024, conn.buffered, conn.put_errors)
+            if conn.last_error is not None:
+                LOG.warning('%s rejected data points: %s', conn,
+                            conn.last_error)
+                conn.last_error = None
+
+    def open_conns(self):
+        """Opens connections until we have self.connections of them."""
+        for _ in xrange(self.connections - len(self.conns)):
+            conn = TSDConnection(*self.pick_host())
+            if conn.connect():
+                self.conns.append(conn)
+                STATS.counter('sender.connections_opened', tsd=conn.host,
+                              port=conn.port).inc()
+            else:
+                self.blacklist_connection()
+        if len(self.conns) < self.connections:
+            self.next_connect = time.time() + TSD_RECONNECT_DELAY
 
     def maintain_conn(self):
-        """Safely connect to the TSD and ensure that it's up and
-           running and that we're not talking to a ghost connection
-           (no response)."""
+        """Safely connect to the TSDs and ensure that they're up and
+           running and that we're not talking to ghost connections
+           (no response).  This only blocks while we can't get a single
+           connection up, lost connections are reopened in the background
+           as long as another one is still working."""
 
         # dry runs and http are always good
         if self.dryrun or self.http:
             return
 
-        # connection didn't verify, so create a new one.  we might be in
+        self.verify_conns()
+        if len(self.conns) < self.connections and self.conns:
+            if time.time() >= self.next_connect:
+                self.open_conns()
+            return
+
+        # no connection at all, so create new ones.  we might be in
         # this method for a long time while we sort this out.
         try_delay = 1
-        while ALIVE:
-            if self.verify_conn():
-                return
-
+        while ALIVE and not self.conns:
             # increase the try delay by some amount and some random value,
             # in case the TSD is down for a while.  delay at most
             # approximately 10 minutes.
@@ -642,153 +1331,101 @@ class SenderThread(threading.Thread):
             if try_delay > 600:
                 try_delay *= 0.5
             LOG.debug('SenderThread blocking %0.2f seconds', try_delay)
-            time.sleep(try_delay)
+            self.wait_for_tsd(try_delay)
 
-            # Now actually try the connection.
-            self.pick_connection()
-            try:
-                addresses = socket.getaddrinfo(self.host, self.port,
-                                               socket.AF_UNSPEC,
-                                               socket.SOCK_STREAM, 0)
-            except socket.gaierror, e:
-                # Don't croak on transient DNS resolution issues.
-                if e[0] in (socket.EAI_AGAIN, socket.EAI_NONAME,
-                            socket.EAI_NODATA):
-                    LOG.debug('DNS resolution failure: %s: %s', self.host, e)
-                    continue
-                raise
-            for family, socktype, proto, canonname, sockaddr in addresses:
-                try:
-                    self.tsd = socket.socket(family, socktype, proto)
-                    self.tsd.settimeout(15)
-                    self.tsd.connect(sockaddr)
-                    # if we get here it connected
-                    LOG.debug('Connection to %s was successful'%(str(sockaddr)))
-                    break
-                except socket.error, msg:
-                    LOG.warning('Connection attempt failed to %s:%d: %s',
-                                self.host, self.port, msg)
-                self.tsd.close()
-                self.tsd = None
-            if not self.tsd:
-                LOG.error('Failed to connect to %s:%d', self.host, self.port)
-                self.blacklist_connection()
-
-    def add_tags_to_line(self, line):
-        for tag, value in self.tags:
-            if ' %s=' % tag not in line:
-                line += ' %s=%s' % (tag, value)
-        return line
+            # Now actually try the connections.
+            self.open_conns()
+        # don't verify the fresh connections before the next minute
+        self.last_verify = time.time()
 
     def send_data(self):
-        """Sends outstanding data in self.sendq to the TSD in one operation."""
+        """Sends outstanding data in self.sendq to the TSDs.
+
+           Data points are sharded across our connections by series, so
+           that each series keeps going through a single connection, in
+           order.  They are queued on the connections and written out as
+           fast as the TSDs take them.  The data points of a connection
+           that's full(), or of all of them when we have none, stay in
+           self.sendq: they count against the batch limits, so we stop
+           reading more, and get spooled if we have a spool."""
         if self.http:
             return self.send_data_via_http()
 
-        # construct the output string
-        out = ''
-
-        # in case of logging we use less efficient variant
-        if LOG.level == logging.DEBUG:
-            for line in self.sendq:
-                line = "put %s" % self.add_tags_to_line(line)
-                out += line + "\n"
-                LOG.debug('SENDING: %s', line)
-        else:
-            out = "".join("put %s\n" % self.add_tags_to_line(line) for line in self.sendq)
-
-        if not out:
+        if not self.sendq:
             LOG.debug('send_data no data?')
             return
 
-        # try sending our data.  if an exception occurs, just error and
-        # try sending again next time.
-        try:
-            if self.dryrun:
-                print out
-            else:
-                self.tsd.sendall(out)
+        if self.dryrun:
+            print "".join("put %s\n" % dp.to_line(self.tag_strings)
+                          for dp in self.sendq)
             self.sendq = []
-        except socket.error, msg:
-            LOG.error('failed to send data: %s', msg)
-            try:
-                self.tsd.close()
-            except socket.error:
-                pass
-            self.tsd = None
-            self.blacklist_connection()
+            return
 
-        # FIXME: we should be reading the result at some point to drain
-        # the packets out of the kernel's queue
+        conns = list(self.conns)
+        if not conns:
+            return
+        shards = [[] for _ in conns]
+        for dp in self.sendq:
+            shards[hash((dp.metric, dp.tags)) % len(conns)].append(dp)
+        self.sendq = []
+
+        for conn, datapoints in zip(conns, shards):
+            if not datapoints:
+                continue
+            if conn.full():
+                # each series only goes through one connection, so they
+                # stay in order
+                self.sendq.extend(datapoints)
+                continue
+            # construct the output string
+            lines = ["put %s\n" % dp.to_line(self.tag_strings)
+                     for dp in datapoints]
+            # in case of logging we log every line
+            if LOG.level == logging.DEBUG:
+                for line in lines:
+                    LOG.debug('SENDING: %s', line[:-1])
+            conn.queue("".join(lines), datapoints)
+            self.pump(conn, conn.flush)
 
     def send_data_via_http(self):
         """Sends outstanding data in self.sendq to TSD in one HTTP API call."""
-        metrics = []
-        for line in self.sendq:
-            # print " %s" % line
-            parts = line.split(None, 3)
-            # not all metrics have metric-specific tags
-            if len(parts) == 4:
-              (metric, timestamp, value, raw_tags) = parts
-            else:
-              (metric, timestamp, value) = parts
-              raw_tags = ""
-            # process the tags
-            metric_tags = {}
-            for tag in raw_tags.strip().split():
-                (tag_key, tag_value) = tag.split("=", 1)
-                metric_tags[tag_key] = tag_value
-            metric_entry = {}
-            metric_entry["metric"] = metric
-            metric_entry["timestamp"] = long(timestamp)
-            metric_entry["value"] = float(value)
-            metric_entry["tags"] = dict(self.tags).copy()
-            if len(metric_tags) + len(metric_entry["tags"]) > self.maxtags:
-              metric_tags_orig = set(metric_tags)
-              subset_metric_keys = frozenset(metric_tags[:len(metric_tags[:self.maxtags-len(metric_entry["tags"])])])
-              metric_tags = dict((k, v) for k, v in metric_tags.iteritems() if k in subset_metric_keys)
-              LOG.error("Exceeding maximum permitted metric tags - removing %s for metric %s",
-                        str(metric_tags_orig - set(metric_tags)), metric)
-            metric_entry["tags"].update(metric_tags)
-            metrics.append(metric_entry)
+        payload = self.encoder.encode_datapoints(self.sendq)
 
         if self.dryrun:
-            print "Would have sent:\n%s" % json.dumps(metrics,
+            print "Would have sent:\n%s" % json.dumps(json.loads(payload),
                                                       sort_keys=True,
                                                       indent=4)
             return
 
         if((self.current_tsd == -1) or (len(self.hosts) > 1)):
             self.pick_connection()
-        # print "Using server: %s:%s" % (self.host, self.port)
-        # url = "http://%s:%s/api/put?details" % (self.host, self.port)
-        # print "Url is %s" % url
-        LOG.debug("Sending metrics to http://%s:%s/api/put?details",
-                  self.host, self.port)
-        if self.ssl:
-            protocol = "https"
-        else:
-            protocol = "http"
-        req = urllib2.Request("%s://%s:%s/api/put?details" % (
-            protocol, self.host, self.port))
+        LOG.debug("Sending metrics to %s",
+                  self.http_pool.url(self.host, self.port, "/api/put?details"))
+        headers = {"Content-Type": "application/json"}
         if self.http_username and self.http_password:
-          req.add_header("Authorization", "Basic %s"
-                         % base64.b64encode("%s:%s" % (self.http_username, self.http_password)))
-        req.add_header("Content-Type", "application/json")
+            headers["Authorization"] = "Basic %s" % base64.b64encode(
+                "%s:%s" % (self.http_username, self.http_password))
+        start = time.time()
+        bytes_sent = self.http_pool.bytes_sent
         try:
-            response = urllib2.urlopen(req, json.dumps(metrics))
-            LOG.debug("Received response %s", response.getcode())
+            # the connections to the TSDs are kept open between batches
+            self.http_pool.post(self.host, self.port, "/api/put?details",
+                                payload, headers)
+            LOG.debug("Sent %d data points", len(self.sendq))
+            tsd = {'tsd': self.host, 'port': self.port}
+            STATS.timer('sender.send_latency', **tsd).observe(
+                1000 * (time.time() - start))
+            STATS.counter('sender.bytes_sent', **tsd).inc(
+                self.http_pool.bytes_sent - bytes_sent)
+            STATS.counter('sender.lines_sent', **tsd).inc(len(self.sendq))
             # clear out the sendq
             self.sendq = []
-            # print "Got response code: %s" % response.getcode()
-            # print "Content:"
-            # for line in response:
-            #     print line,
-            #     print
         except urllib2.HTTPError, e:
             LOG.error("Got error %s", e)
-            # for line in http_error:
-            #   print line,
+            if 400 <= e.code < 500:
+                # the TSD rejected the data points, sending them again
+                # isn't going to help
+                self.sendq = []
 
 
 def setup_logging(logfile=DEFAULT_LOG, max_bytes=None, backup_count=None):
@@ -840,7 +1477,20 @@ def parse_cmdline(argv):
             'ssl': False,
             'stdin': False,
             'daemonize': False,
-            'hosts': False
+            'hosts': False,
+            'reader_mode': 'epoll',
+            'spool_dir': False,
+            'spool_max_bytes': 128 * 1024 * 1024,
+            'spool_replay_rate': DEFAULT_SPOOL_REPLAY_RATE,
+            'connections': 1,
+            'max_batch_bytes': DEFAULT_MAX_BATCH_BYTES,
+            'max_batch_points': MAX_SENDQ_SIZE,
+            'max_linger_ms': DEFAULT_MAX_LINGER_MS,
+            'http_compression': 'none',
+            'stats_interval': DEFAULT_STATS_INTERVAL,
+            'cpu_budget': 0,
+            'profile_dir': False,
+            'profile_seconds': DEFAULT_DURATION
         }
     except:
         sys.stderr.write("Unexpected error: %s" % sys.exc_info()[0])
@@ -871,6 +1521,10 @@ def parse_cmdline(argv):
                         action='store_true',
                         default=defaults['no_tcollector_stats'],
                         help='Prevent tcollector from reporting its own stats to TSD')
+    parser.add_option('--stats-interval', dest='stats_interval', type='int',
+                        default=defaults['stats_interval'],
+                        help='Number of seconds between two reports of '
+                           'tcollector\'s own stats. default=%default')
     parser.add_option('-s', '--stdin', dest='stdin', action='store_true',
                         default=defaults['stdin'],
                         help='Run once, read and dedup data points from stdin.')
@@ -930,6 +1584,58 @@ def parse_cmdline(argv):
                       help='Password to use for HTTP Basic Auth when sending the data via HTTP')
     parser.add_option('--ssl', dest='ssl', action='store_true', default=defaults['ssl'],
                       help='Enable SSL - used in conjunction with http')
+    parser.add_option('--http-compression', dest='http_compression', type='choice',
+                      choices=COMPRESSIONS, default=defaults['http_compression'],
+                      help='Compress the data sent via the http interface: '
+                           '"none", "gzip" or "deflate". default=%default')
+    parser.add_option('--reader-mode', dest='reader_mode', type='choice',
+                      choices=('epoll', 'poll'), default=defaults['reader_mode'],
+                      help='How the reader waits for collector output: "epoll" '
+                           'wakes up as soon as a collector writes, "poll" '
+                           'checks every collector once a second. '
+                           'default=%default')
+    parser.add_option('--spool-dir', dest='spool_dir', metavar='DIR',
+                      default=defaults['spool_dir'],
+                      help='Directory where data points are spooled while '
+                           'the TSDs are unreachable. Disabled by default.')
+    parser.add_option('--spool-max-bytes', dest='spool_max_bytes', type='int',
+                      default=defaults['spool_max_bytes'],
+                      help='Maximum size of the spool, the oldest data '
+                           'points are dropped beyond it. default=%default')
+    parser.add_option('--spool-replay-rate', dest='spool_replay_rate', type='int',
+                      default=defaults['spool_replay_rate'],
+                      help='Maximum number of spooled data points sent per '
+                           'second once the TSDs are back. default=%default')
+    parser.add_option('--connections', dest='connections', type='int',
+                      default=defaults['connections'],
+                      help='Number of connections to keep open to the TSDs, '
+                           'series are spread across them. default=%default')
+    parser.add_option('--max-batch-bytes', dest='max_batch_bytes', type='int',
+                      default=defaults['max_batch_bytes'],
+                      help='Send the data points once we have that many bytes '
+                           'of them. default=%default')
+    parser.add_option('--max-batch-points', dest='max_batch_points', type='int',
+                      default=defaults['max_batch_points'],
+                      help='Send the data points once we have that many of '
+                           'them. default=%default')
+    parser.add_option('--max-linger-ms', dest='max_linger_ms', type='int',
+                      default=defaults['max_linger_ms'],
+                      help='Send the data points once the oldest of them '
+                           'waited that many milliseconds. default=%default')
+    parser.add_option('--cpu-budget', dest='cpu_budget', type='float',
+                      default=defaults['cpu_budget'],
+                      help='How many CPU seconds a run of a periodic '
+                           'collector may use, those going over it skip '
+                           'their next runs, 0 for no limit. '
+                           'default=%default')
+    parser.add_option('--profile-dir', dest='profile_dir', metavar='DIR',
+                      default=defaults['profile_dir'],
+                      help='Where to write the stacks sampled on SIGUSR2. '
+                           'default: the temp directory')
+    parser.add_option('--profile-seconds', dest='profile_seconds', type='int',
+                      default=defaults['profile_seconds'],
+                      help='For how many seconds the stacks are sampled on '
+                           'SIGUSR2. default=%default')
     (options, args) = parser.parse_args(args=argv[1:])
     if options.dedupinterval < 0:
         parser.error('--dedup-interval must be at least 0 seconds')
@@ -938,6 +1644,24 @@ def parse_cmdline(argv):
                      '--dedup-interval')
     if options.reconnectinterval < 0:
         parser.error('--reconnect-interval must be at least 0 seconds')
+    if options.spool_max_bytes <= 0:
+        parser.error('--spool-max-bytes must be greater than 0')
+    if options.spool_replay_rate <= 0:
+        parser.error('--spool-replay-rate must be greater than 0')
+    if options.connections < 1:
+        parser.error('--connections must be at least 1')
+    if options.max_batch_bytes <= 0:
+        parser.error('--max-batch-bytes must be greater than 0')
+    if options.max_batch_points <= 0:
+        parser.error('--max-batch-points must be greater than 0')
+    if options.max_linger_ms < 0:
+        parser.error('--max-linger-ms must be at least 0')
+    if options.stats_interval <= 0:
+        parser.error('--stats-interval must be greater than 0')
+    if options.cpu_budget < 0:
+        parser.error('--cpu-budget must be at least 0')
+    if options.profile_seconds <= 0:
+        parser.error('--profile-seconds must be greater than 0')
     # We cannot write to stdout when we're a daemon.
     if (options.daemonize or options.max_bytes) and not options.backup_count:
         options.backup_count = 1
@@ -1029,10 +1753,19 @@ def main(argv):
     atexit.register(shutdown)
     for sig in (signal.SIGTERM, signal.SIGINT):
         signal.signal(sig, shutdown_signal)
+    # kill -USR2 samples our stacks for a while, to find out what eats our
+    # CPU; the collectors are processes of their own, profile them apart
+    Profiler('tcollector', options.profile_dir, options.profile_seconds,
+             logger=LOG).install()
 
     # at this point we're ready to start processing, so start the ReaderThread
-    # so we can have it running and pulling in data for us
-    reader = ReaderThread(options.dedupinterval, options.evictinterval)
+    # so we can have it running and pulling in data for us.  The stdin
+    # collector blocks in read(), so it always uses the polling loop.
+    global POLLER
+    if (options.reader_mode == 'epoll' and not options.stdin
+            and hasattr(select, 'epoll')):
+        POLLER = CollectorPoller()
+    reader = ReaderThread(options.dedupinterval, options.evictinterval, POLLER)
     reader.start()
 
     # prepare list of (host, port) of TSDs given on CLI
@@ -1053,11 +1786,21 @@ def main(argv):
         if options.host != "localhost" or options.port != DEFAULT_PORT:
             options.hosts.append((options.host, options.port))
 
+    spool = None
+    if options.spool_dir and not options.dryrun:
+        spool = Spool(options.spool_dir, options.spool_max_bytes, LOG)
+
     # and setup the sender to start writing out to the tsd
     sender = SenderThread(reader, options.dryrun, options.hosts,
                           not options.no_tcollector_stats, tags, options.reconnectinterval,
                           options.http, options.http_username,
-                          options.http_password, options.ssl, options.maxtags)
+                          options.http_password, options.ssl, options.maxtags,
+                          spool, options.spool_replay_rate,
+                          options.connections, options.max_batch_bytes,
+                          options.max_batch_points, options.max_linger_ms,
+                          options.http_compression, options.stats_interval)
+    STATS.add_source(reader.report_stats)
+    STATS.add_source(sender.report_stats)
     sender.start()
     LOG.info('SenderThread startup complete')
 
@@ -1095,14 +1838,24 @@ def stdin_loop(options, modules, sender, tags):
 def main_loop(options, modules, sender, tags):
     """The main loop of the program that runs when we're not in stdin mode."""
 
+    # tells us which collectors and config modules changed as soon as they
+    # do, rather than us listing and stat'ing all of them every time around
+    conf_watcher = watcher(LOG)
+    changed = None  # everything
     next_heartbeat = int(time.time() + 600)
     while ALIVE:
-        populate_collectors(options.cdir)
-        reload_changed_config_modules(modules, options, sender, tags)
-        reap_children()
+        if changed is not None and any(path == options.cdir
+                                       or os.path.dirname(path) == options.cdir
+                                       for path in changed):
+            changed = None  # a directory came or went
+        if changed is None:
+            watch_config_dirs(conf_watcher, options.cdir)
+        populate_collectors(options.cdir, changed)
+        reload_changed_config_modules(modules, options, sender, tags, changed)
+        reap_children(options)
         check_children(options)
         spawn_children()
-        time.sleep(15)
+        changed = conf_watcher.wait(15)
         now = int(time.time())
         if now >= next_heartbeat:
             LOG.info('Heartbeat (%d collectors running)'
@@ -1110,6 +1863,16 @@ def main_loop(options, modules, sender, tags):
             next_heartbeat = now + 600
 
 
+def watch_config_dirs(conf_watcher, coldir):
+    """Watches the interval directories of the collectors and the etc
+       directory, as well as coldir itself for new interval directories."""
+    conf_watcher.watch(coldir)
+    for name in os.listdir(coldir):
+        path = os.path.join(coldir, name)
+        if (name.isdigit() or name == 'etc') and os.path.isdir(path):
+            conf_watcher.watch(path)
+
+
 def list_config_modules(etcdir):
     """Returns an iterator that yields the name of all the config modules."""
     if not os.path.isdir(etcdir):
@@ -1163,16 +1926,21 @@ def load_config_module(name, options, tags):
     return module
 
 
-def reload_changed_config_modules(modules, options, sender, tags):
+def reload_changed_config_modules(modules, options, sender, tags,
+                                  changed=None):
     """Reloads any changed modules from the 'etc' directory.
 
     Args:
       cdir: The path to the 'collectors' directory.
       modules: A dict of path -> (module, timestamp).
+      changed: The paths that changed since the last call, None if unknown.
     Returns: whether or not anything has changed.
     """
 
     etcdir = os.path.join(options.cdir, 'etc')
+    if changed is not None and not any(os.path.dirname(path) == etcdir
+                                       for path in changed):
+        return False
     current_modules = set(list_config_modules(etcdir))
     current_paths = set(os.path.join(etcdir, name)
                         for name in current_modules)
@@ -1274,19 +2042,45 @@ def shutdown():
     sys.exit(1)
 
 
-def reap_children():
+def wait_child(proc):
+    """Like proc.poll(), but also returns the resource usage of the process
+       once it exited, from wait4(2): (status, rusage), with rusage None
+       while it runs or if we can't tell."""
+    if proc.returncode is not None:
+        return proc.returncode, None
+    try:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    except OSError, e:
+        if e.errno != errno.ECHILD:
+            raise
+        return proc.poll(), None
+    if pid == 0:
+        return None, None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, rusage
+
+
+def reap_children(options=None):
     """When a child process dies, we have to determine why it died and whether
-       or not we need to restart it.  This method manages that logic."""
+       or not we need to restart it.  This method manages that logic.  The
+       runs of the periodic collectors are timed along the way, those going
+       over the CPU budget of options delay the next ones."""
 
+    budget = options.cpu_budget if options is not None else 0
     for col in all_living_collectors():
         now = int(time.time())
-        # FIXME: this is not robust.  the asyncproc module joins on the
-        # reader threads when you wait if that process has died.  this can cause
-        # slow dying processes to hold up the main loop.  good for now though.
-        status = col.proc.poll()
+        status, rusage = wait_child(col.proc)
         if status is None:
             continue
+        if POLLER is not None:
+            POLLER.unregister(col)
         col.proc = None
+        skip = 0
+        if col.interval and rusage is not None:
+            skip = col.record_run(rusage, budget)
 
         # behavior based on status.  a code 0 is normal termination, code 13
         # is used to indicate that we don't want to restart this collector.
@@ -1302,7 +2096,8 @@ def reap_children():
             col.dead = True
         else:
             register_collector(Collector(col.name, col.interval, col.filename,
-                                         col.mtime, col.lastspawn))
+                                         col.mtime,
+                                         col.lastspawn + skip * col.interval))
 
 def check_children(options):
     """When a child process hasn't received a datapoint in a while,
@@ -1346,12 +2141,15 @@ def spawn_collector(col):
     # The following line needs to move below this line because it is used in
     # other logic and it makes no sense to update the last spawn time if the
     # collector didn't actually start.
-    col.lastspawn = int(time.time())
+    col.spawned = time.time()
+    col.lastspawn = int(col.spawned)
     # Without setting last_datapoint here, a long running check (>15s) will be 
     # killed by check_children() the first time check_children is called.
     col.last_datapoint = col.lastspawn
     set_nonblocking(col.proc.stdout.fileno())
     set_nonblocking(col.proc.stderr.fileno())
+    if POLLER is not None:
+        POLLER.register(col)
     if col.proc.pid > 0:
         col.dead = False
         LOG.info('spawned %s (pid=%d)', col.name, col.proc.pid)
@@ -1385,6 +2183,7 @@ def spawn_children():
             if col.nextkill > now:
                 continue
             if col.killstate == 0:
+                col.overruns.inc()
                 LOG.warning('warning: %s (interval=%d, pid=%d) overstayed '
                             'its welcome, SIGTERM sent',
                             col.name, col.interval, col.proc.pid)
@@ -1405,12 +2204,31 @@ def spawn_children():
                 col.nextkill = now + 300
 
 
-def populate_collectors(coldir):
+def populate_collectors(coldir, changed=None):
     """Maintains our internal list of valid collectors.  This walks the
        collector directory and looks for files.  In subsequent calls, this
        also looks for changes to the files -- new, removed, or updated files,
        and takes the right action to bring the state of our running processes
-       in line with the filesystem."""
+       in line with the filesystem.
+
+       If given, changed are the only paths that changed since the last
+       call, so that we only look at those."""
+
+    if changed is not None:
+        for filename in changed:
+            interval = os.path.basename(os.path.dirname(filename))
+            colname = os.path.basename(filename)
+            if (os.path.dirname(os.path.dirname(filename)) != coldir
+                    or not interval.isdigit() or colname.startswith('.')):
+                continue
+            if not check_collector(int(interval), colname, filename):
+                col = COLLECTORS.get(colname)
+                if col is not None and col.filename == filename:
+                    LOG.info('collector %s removed from the filesystem, '
+                             'forgetting', col.name)
+                    col.shutdown()
+                    del COLLECTORS[colname]
+        return
 
     global GENERATION
     GENERATION += 1
@@ -1425,41 +2243,8 @@ def populate_collectors(coldir):
         for colname in os.listdir('%s/%d' % (coldir, interval)):
             if colname.startswith('.'):
                 continue
-
-            filename = '%s/%d/%s' % (coldir, interval, colname)
-            if os.path.isfile(filename) and os.access(filename, os.X_OK):
-                mtime = os.path.getmtime(filename)
-
-                # if this collector is already 'known', then check if it's
-                # been updated (new mtime) so we can kill off the old one
-                # (but only if it's interval 0, else we'll just get
-                # it next time it runs)
-                if colname in COLLECTORS:
-                    col = COLLECTORS[colname]
-
-                    # if we get a dupe, then ignore the one we're trying to
-                    # add now.  there is probably a more robust way of doing
-                    # this...
-                    if col.interval != interval:
-                        LOG.error('two collectors with the same name %s and '
-                                   'different intervals %d and %d',
-                                   colname, interval, col.interval)
-                        continue
-
-                    # we have to increase the generation or we will kill
-                    # this script again
-                    col.generation = GENERATION
-                    if col.mtime < mtime:
-                        LOG.info('%s has been updated on disk', col.name)
-                        col.mtime = mtime
-                        if not col.interval:
-                            col.shutdown()
-                            LOG.info('Respawning %s', col.name)
-                            register_collector(Collector(colname, interval,
-                                                         filename, mtime))
-                else:
-                    register_collector(Collector(colname, interval, filename,
-                                                 mtime))
+            check_collector(interval, colname,
+                            '%s/%d/%s' % (coldir, interval, colname))
 
     # now iterate over everybody and look for old generations
     to_delete = []
@@ -1473,5 +2258,45 @@ def populate_collectors(coldir):
         del COLLECTORS[name]
 
 
+def check_collector(interval, colname, filename):
+    """Registers the collector at filename if it's new, respawns it if it
+       was updated.  Returns False if filename isn't an executable file."""
+    if not (os.path.isfile(filename) and os.access(filename, os.X_OK)):
+        return False
+    mtime = os.path.getmtime(filename)
+
+    # if this collector is already 'known', then check if it's
+    # been updated (new mtime) so we can kill off the old one
+    # (but only if it's interval 0, else we'll just get
+    # it next time it runs)
+    if colname in COLLECTORS:
+        col = COLLECTORS[colname]
+
+        # if we get a dupe, then ignore the one we're trying to
+        # add now.  there is probably a more robust way of doing
+        # this...
+        if col.interval != interval:
+            LOG.error('two collectors with the same name %s and '
+                       'different intervals %d and %d',
+                       colname, interval, col.interval)
+            return True
+
+        # we have to increase the generation or we will kill
+        # this script again
+        col.generation = GENERATION
+        if col.mtime < mtime:
+            LOG.info('%s has been updated on disk', col.name)
+            col.mtime = mtime
+            if not col.interval:
+                col.shutdown()
+                LOG.info('Respawning %s', col.name)
+                register_collector(Collector(colname, interval,
+                                             filename, mtime))
+    else:
+        register_collector(Collector(colname, interval, filename,
+                                     mtime))
+    return True
+
+
 if __name__ == '__main__':
     sys.exit(main(sys.argv))
@@ -12,13 +12,60 @@
 # of the GNU Lesser General Public License along with this program.  If not,
 # see <http://www.gnu.org/licenses/>.
 
+import BaseHTTPServer
+import ConfigParser
+import json
+import logging
+import optparse
 import os
+import shutil
+import signal
+import SocketServer
+import socket
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib2
+import zlib
 from stat import S_ISDIR, S_ISREG, ST_MODE
 import unittest
+from Queue import Queue
 
 import mocks
+import runner
 import tcollector
+from collectors.lib.backpressure import CollectorQueue
+from collectors.lib.backpressure import PressureQueue
+from collectors.lib import procfs
+from collectors.lib import scheduler
+from collectors.lib.batching import Batcher
+from collectors.lib.batching import BulkQueue
+from collectors.lib.batching import Histogram
+from collectors.lib.collectorbase import CollectorBase
+from collectors.lib.confwatch import InotifyWatcher
+from collectors.lib.datapoint import DataPoint
+from collectors.lib.datapoint import parse_line
+from collectors.lib.httpengine import HTTPEngine
+from collectors.lib.httpengine import HTTPEngineError
+from collectors.lib.httppool import HTTPConnectionPool
+from collectors.lib.procexec import ProcessCollector
+from collectors.lib.putjson import PutEncoder
+from collectors.lib import rates
+from collectors.lib.rates import RateEngine
+from collectors.lib.sampler import Profiler
+from collectors.lib.sampler import StackSampler
+from collectors.lib.scheduler import Scheduler
+from collectors.lib.selfmetrics import MetricsRegistry
+from collectors.lib.sockdiag import SockDiag
+from collectors.lib.spool import Spool
+
+# the builtin collectors are loaded from their directory, like the runner does
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'collectors', 'builtin'))
+import iostat
+import spark
 
 
 class CollectorsTests(unittest.TestCase):
@@ -104,6 +151,1535 @@ class TSDBlacklistingTests(unittest.TestCase):
         sender.pick_connection()
         self.assertEqual(tsd1, (sender.host, sender.port))
 
+    def test_backOffOnSendFailures(self):
+        sender = tcollector.SenderThread(tcollector.ReaderThread(0, 1),
+                                         False, [("localhost", 4242)],
+                                         False, {}, http=True)
+        delays = []
+        def wait_for_tsd(delay):
+            delays.append(delay)
+            if len(delays) > tcollector.MAX_UNCAUGHT_EXCEPTIONS:
+                tcollector.ALIVE = False
+        def send_data():
+            raise urllib2.URLError("connection refused")
+        def fill(queue, batch, timeout, idle=None):
+            batch.append(parse_line("foo 1500000000 1"))
+            return "points"
+        sender.wait_for_tsd = wait_for_tsd
+        sender.send_data = send_data
+        sender.batcher.fill = fill
+        shutdown, tcollector.shutdown = tcollector.shutdown, self.fail
+        try:
+            sender.run()
+        finally:
+            tcollector.shutdown = shutdown
+            tcollector.ALIVE = True
+        self.assertEqual([1, 2, 4, 8, 16, 32, 64, 64], delays[:8])
+
+class CollectorPollerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = tcollector.CollectorPoller()
+        self.col = tcollector.Collector('echo', 0,
+                                        ['echo', 'foo.bar 1 1'])
+        tcollector.spawn_collector(self.col)
+        self.poller.register(self.col)
+
+    def tearDown(self):
+        self.poller.close()
+
+    def test_readyAndHangup(self):
+        self.assertEqual(set([self.col]), self.poller.poll(5))
+        self.assertEqual(['foo.bar 1 1'], list(self.col.collect()))
+        # both pipes hung up once the process exited, nothing left to watch
+        while self.poller.fds:
+            self.poller.poll(5)
+        self.assertEqual(set(), self.poller.poll(0))
+        self.assertTrue(self.col.exited >= self.col.spawned)
+
+    def test_unregister(self):
+        self.poller.unregister(self.col)
+        self.assertEqual({}, self.poller.fds)
+        self.assertEqual(set(), self.poller.poll(0.1))
+
+
+class ReapChildrenTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict(tcollector.COLLECTORS)
+        tcollector.COLLECTORS.clear()
+
+    def tearDown(self):
+        tcollector.COLLECTORS.clear()
+        tcollector.COLLECTORS.update(self.saved)
+
+    def test_runsTimedAndBudgeted(self):
+        col = tcollector.Collector('spin', 30, ['python', '-c',
+                                   'import time\nend = time.time() + 0.2\n'
+                                   'while time.time() < end: pass'])
+        tcollector.register_collector(col)
+        tcollector.spawn_collector(col)
+        options = optparse.Values({'cpu_budget': 0.05})
+        while col.proc is not None:
+            tcollector.reap_children(options)
+            time.sleep(0.05)
+        self.assertEqual(1, col.duration.count)
+        self.assertTrue(col.duration.total >= 200)
+        self.assertTrue(col.cpu.total >= 100)
+        self.assertEqual(1, col.budget_overruns.value)
+        # the next runs are skipped, by pushing back the last spawn
+        new = tcollector.COLLECTORS['spin']
+        self.assertTrue(new is not col)
+        self.assertTrue(new.lastspawn >= col.lastspawn + 60)
+
+    def test_durationUntilExit(self):
+        col = tcollector.Collector('quick', 30, ['true'])
+        tcollector.register_collector(col)
+        tcollector.spawn_collector(col)
+        while not col.exited:
+            list(col.collect())
+            time.sleep(0.01)
+        # reaped long after it exited
+        time.sleep(0.5)
+        while col.proc is not None:
+            tcollector.reap_children()
+        self.assertEqual(1, col.duration.count)
+        self.assertTrue(col.duration.total < 500)
+
+    def test_waitChild(self):
+        proc = subprocess.Popen(['sh', '-c', 'exit 3'])
+        while True:
+            status, rusage = tcollector.wait_child(proc)
+            if status is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(3, status)
+        self.assertTrue(rusage.ru_utime >= 0)
+        self.assertEqual((3, None), tcollector.wait_child(proc))
+        self.assertEqual(3, proc.poll())
+
+
+class CollectorReadTests(unittest.TestCase):
+
+    class Proc(object):
+        def __init__(self, chunks):
+            self.stdout = self.Pipe(chunks)
+            self.stderr = self.Pipe([])
+
+        class Pipe(object):
+            def __init__(self, chunks):
+                self.chunks = list(chunks)
+
+            def read(self):
+                if not self.chunks:
+                    raise IOError(tcollector.errno.EAGAIN, 'EAGAIN')
+                return self.chunks.pop(0)
+
+    def collect(self, chunks):
+        col = tcollector.Collector('test', 0, 'test')
+        col.proc = self.Proc(chunks)
+        lines = []
+        # collect() stops as soon as a read gives no complete line
+        while col.proc.stdout.chunks:
+            lines.extend(col.collect())
+        return col, lines
+
+    def test_splitChunks(self):
+        col, lines = self.collect(['foo 1 1\nbar 2', ' 2\n\n  baz 3 3 \nqu'])
+        self.assertEqual(['foo 1 1', 'bar 2 2', 'baz 3 3'], lines)
+        self.assertEqual('qu', col.buffer)
+
+    def test_lineSpanningChunks(self):
+        col, lines = self.collect(['f', 'o', 'o 1 1', '\n'])
+        self.assertEqual(['foo 1 1'], lines)
+        self.assertEqual('', col.buffer)
+
+
+class DedupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = tcollector.ReaderThread(300, 600)
+        self.col = tcollector.Collector('test', 0, 'test')
+
+    def process(self, *lines):
+        for line in lines:
+            self.reader.process_line(self.col, line)
+        sent = []
+        while not self.reader.readerq.empty():
+            sent.append(self.reader.readerq.get().to_line())
+        return sent
+
+    def test_replayLastRepeatedValue(self):
+        self.assertEqual(['foo 1500000000 1 a=b'],
+                         self.process('foo 1500000000 1 a=b',
+                                      'foo 1500000010 1 a=b',
+                                      'foo 1500000020 1 a=b'))
+        self.assertEqual(['foo 1500000020 1 a=b', 'foo 1500000030 2 a=b'],
+                         self.process('foo 1500000030 2 a=b'))
+        self.assertEqual(1, len(self.col.values))
+
+    def test_outOfOrder(self):
+        self.process('foo 1500000000 1')
+        self.assertEqual([], self.process('foo 1499999999 2'))
+        self.assertEqual(1, self.col.lines_invalid)
+
+    def test_evictBuckets(self):
+        cache = tcollector.DedupCache(bucket_width=60)
+        cache.put(('foo', ()), '1', 1500000000)
+        cache.put(('bar', ('a=b',)), '1', 1500000100)
+        cache.put(('foo', ()), '2', 1500000200)
+        self.assertEqual(0, cache.evict(1500000100))
+        self.assertEqual(1, cache.evict(1500000200))
+        self.assertEqual(('2', 1500000200, 1500000200), cache.get(('foo', ())))
+        self.assertIsNone(cache.get(('bar', ('a=b',))))
+        # a new value in the same bucket leaves the bucket alone
+        keys = cache.buckets[cache.bucket(1500000200)]
+        cache.put(('foo', ()), '3', 1500000210)
+        self.assertEqual(('3', 1500000210, 1500000210), cache.get(('foo', ())))
+        self.assertEqual(set([('foo', ())]), keys)
+        self.assertEqual(1, cache.evict(1500000300))
+        self.assertEqual({}, cache.buckets)
+
+
+class ConfigWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.watcher = InotifyWatcher(tcollector.LOG)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.dir)
+
+    def write(self, name, mode=0644):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(path, mode)
+        return path
+
+    def test_changedPaths(self):
+        self.watcher.watch(self.dir)
+        self.assertEqual(set(), self.watcher.wait(0.01))
+        foo = self.write('foo.conf')
+        self.write('.bar.conf.swp')
+        os.rename(os.path.join(self.dir, '.bar.conf.swp'),
+                  os.path.join(self.dir, 'bar.conf'))
+        start = time.time()
+        changed = self.watcher.wait(5)
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(set([foo, os.path.join(self.dir, 'bar.conf')])
+                        <= changed)
+        os.unlink(foo)
+        self.assertEqual(set([foo]), self.watcher.wait(5))
+
+    def test_rescanUnwatched(self):
+        missing = os.path.join(self.dir, 'missing')
+        self.watcher.watch(missing)
+        self.assertEqual(None, self.watcher.wait(0.01))
+        os.mkdir(missing)
+        self.watcher.watch(missing)
+        self.assertEqual(set(), self.watcher.wait(0.01))
+        os.rmdir(missing)
+        self.assertEqual(set([missing]), self.watcher.wait(5))
+
+    def test_populateChangedCollectors(self):
+        os.mkdir(os.path.join(self.dir, '0'))
+        self.dir, cdir = os.path.join(self.dir, '0'), self.dir
+        try:
+            path = self.write('confwatch_test_collector.sh', 0755)
+            self.write('not_executable.sh')
+            tcollector.populate_collectors(cdir, set([path]))
+            col = tcollector.COLLECTORS['confwatch_test_collector.sh']
+            self.assertEqual(path, col.filename)
+            self.assertFalse('not_executable.sh' in tcollector.COLLECTORS)
+            os.unlink(path)
+            tcollector.populate_collectors(cdir, set([path]))
+            self.assertFalse('confwatch_test_collector.sh'
+                             in tcollector.COLLECTORS)
+        finally:
+            self.dir = cdir
+
+
+class DataPointTests(unittest.TestCase):
+
+    def test_parseLine(self):
+        dp = parse_line('foo.bar 1500000000 42 a=b c=d')
+        self.assertEqual('foo.bar', dp.metric)
+        self.assertEqual(1500000000, dp.timestamp)
+        self.assertEqual('42', dp.value)
+        self.assertEqual(('a=b', 'c=d'), dp.tags)
+        self.assertEqual({'a': 'b', 'c': 'd'}, dp.tag_dict())
+        self.assertFalse(dp.is_millis())
+        self.assertTrue(parse_line('foo.bar 1500000000000 42').is_millis())
+        # the reader tells whether they're reasonable
+        for timestamp in (150000000, 15000000000, 150000000000):
+            self.assertEqual(timestamp, parse_line('foo.bar %d 42'
+                                                   % timestamp).timestamp)
+
+    def test_parseInvalidLines(self):
+        for line in ('foo.bar 1500000000', 'foo.bar now 42',
+                     'foo:bar 1500000000 42', 'foo.bar 1500000000 42 a',
+                     'foo.bar 1500000000 42 a=b=c', 'foo.bar 1500000000 42 =b',
+                     'foo.bar 1 42', 'foo.bar 1500000000.5 42',
+                     # the collectors' lines are stripped
+                     'foo.bar 1500000000 42 a=b ', 'foo.bar 1500000000 42 '):
+            self.assertIsNone(parse_line(line), line)
+
+    def test_toLine(self):
+        dp = parse_line('foo.bar 1500000000 42 host=a')
+        self.assertEqual('foo.bar 1500000000 42 host=a',
+                         dp.to_line(['host=b']))
+        self.assertEqual('foo.bar 1500000000 42 host=a dc=x',
+                         dp.to_line(['dc=x', 'host=b']))
+        dp = DataPoint('foo.bar', 1500000000, '42', ('a=b',), None)
+        self.assertEqual('foo.bar 1500000000 42 a=b host=c',
+                         dp.to_line(['host=c']))
+
+
+class ProcfsTests(unittest.TestCase):
+
+    def test_sharedPerTick(self):
+        snap = procfs.snapshot(1000)
+        self.assertTrue(snap is procfs.snapshot(1000.5))
+        self.assertFalse(snap is procfs.snapshot(1001))
+        stat = snap.stat()
+        self.assertTrue(stat is snap.stat())
+        self.assertTrue(snap.lines('/proc/stat') is snap.lines('/proc/stat'))
+        self.assertTrue(len(stat.cpu) >= 4)
+        self.assertTrue(stat.ctxt > 0)
+        self.assertTrue(snap.uptime().total > 0)
+        self.assertTrue(snap.meminfo()['MemTotal'] > 0)
+        self.assertRaises(TypeError, snap.meminfo().__setitem__, 'MemTotal', 0)
+        # the old snapshots go away
+        for tick in xrange(1002, 1002 + procfs.MAX_SNAPSHOTS):
+            procfs.snapshot(tick)
+        self.assertFalse(snap is procfs.snapshot(1000))
+
+    def test_processes(self):
+        snap = procfs.snapshot(2000)
+        stat = snap.pid_stat(os.getpid())
+        self.assertEqual(os.getpid(), stat.pid)
+        self.assertEqual(os.getppid(), stat.ppid)
+        self.assertTrue(stat.rss > 0)
+        self.assertEqual(None, snap.pid_stat(2 ** 22 + 1))
+        self.assertEqual((), snap.lines('/proc/%d/status' % (2 ** 22 + 1)))
+
+    def test_walk(self):
+        snap = procfs.snapshot(3000)
+        processes = snap.processes()
+        self.assertTrue(processes is snap.processes())
+        own = [proc for proc in processes if proc.pid == os.getpid()]
+        self.assertEqual(1, len(own))
+        self.assertTrue(os.path.basename(sys.argv[0]) in own[0].cmdline)
+        self.assertTrue(own[0].rss > 0)
+        self.assertTrue(0 < own[0].start_time <= time.time())
+        end = time.time() + 0.3
+        while time.time() < end:
+            pass
+        proc = [proc for proc in procfs.snapshot(3001).processes()
+                if proc.pid == os.getpid()][0]
+        # that's since the previous walk, we spun all along
+        self.assertTrue(proc.pcpu > 20, proc.pcpu)
+        self.assertTrue(snap.pid_dirty(os.getpid()) >= 0)
+
+    def test_parsePidStat(self):
+        stat = procfs.parse_pid_stat(
+            '42 (a (b) c) S 1 42 42 0 -1 4194560 100 0 0 0 7 3 2 1 20 0 1 0 '
+            '1234 1000000 250 18446744073709551615 1 1 0 0 0 0 0 0 0 0 0 0 '
+            '17 0 0 0 0 5 6\n')
+        self.assertEqual((42, 'a (b) c', 'S', 1, 7, 3, 2, 1, 1234, 1000000,
+                          250, 5, 6), stat)
+
+    def test_bufferGrows(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'big')
+            with open(path, 'w') as f:
+                f.write('x' * (procfs.INITIAL_SIZE * 3 + 1))
+            procfile = procfs.ProcFile(path)
+            self.assertEqual(procfs.INITIAL_SIZE * 3 + 1, len(procfile.read()))
+            with open(path, 'w') as f:
+                f.write('y')
+            self.assertEqual('y', procfile.read())
+            procfile.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class FakeSnapshot(object):
+    """The /proc files of a tick, made up."""
+
+    def __init__(self, uptime, diskstats):
+        self._uptime = procfs.Uptime(uptime, 0.0)
+        self._diskstats = procfs.parse_diskstats(diskstats)
+
+    def uptime(self):
+        return self._uptime
+
+    def diskstats(self):
+        return self._diskstats
+
+
+class IostatTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sys_block = tempfile.mkdtemp()
+        for disk in ('sda', 'nvme0n1', 'cciss!c0d0'):
+            os.mkdir(os.path.join(self.sys_block, disk))
+        self.saved = iostat.SYS_BLOCK, procfs.snapshot
+        iostat.SYS_BLOCK = self.sys_block
+
+    def tearDown(self):
+        iostat.SYS_BLOCK, procfs.snapshot = self.saved
+        shutil.rmtree(self.sys_block)
+
+    def collect(self, collector, tick, uptime, diskstats):
+        procfs.snapshot = lambda tick=None: FakeSnapshot(uptime, diskstats)
+        collector.set_tick(tick)
+        collector()
+        lines = collector._readq.get_many(10000)
+        return dict((tuple(line.split()[i] for i in (0, 3)), line.split()[2])
+                    for line in lines)
+
+    def test_extendedStats(self):
+        collector = iostat.Iostat(None, None, tcollector.ReaderQueue(10000))
+        first = self.collect(collector, 1000, 100.0,
+                             "   8       0 sda 100 0 1000 500 50 0 400 200 0 1000 2000\n"
+                             "   8       1 sda1 100 0 1000 500 50 0 400 200 0 1000 2000\n"
+                             "   8       2 sda2 10 20 30 40\n"
+                             " 259       0 nvme0n1 5 0 8 1 0 0 0 0 0 1 1 3 0 24 2 4 1\n"
+                             "   7       0 loop0 0 0 0 0 0 0 0 0 0 0 0\n")
+        self.assertEqual('100', first[('iostat.disk.read_requests', 'dev=sda')])
+        # not until we have the previous counters
+        self.assertFalse(('iostat.disk.util', 'dev=sda') in first)
+        # partitions, of both formats
+        self.assertEqual('100', first[('iostat.part.read_requests', 'dev=sda1')])
+        self.assertEqual('30', first[('iostat.part.write_issued', 'dev=sda2')])
+        self.assertEqual('40', first[('iostat.part.write_sectors', 'dev=sda2')])
+        # the discards and flushes of the later kernels
+        self.assertEqual('3', first[('iostat.disk.discard_requests', 'dev=nvme0n1')])
+        self.assertEqual('1', first[('iostat.disk.msec_flush', 'dev=nvme0n1')])
+        # never read
+        self.assertFalse([key for key in first if key[1] == 'dev=loop0'])
+
+        second = self.collect(collector, 1010, 110.0,
+                              "   8       0 sda 200 0 3000 900 150 0 2400 1400 2 3000 7000\n"
+                              "   8       1 sda1 200 0 3000 900 150 0 2400 1400 2 3000 7000\n")
+        expected = {
+            'reads_per_sec': '10.00',
+            'writes_per_sec': '10.00',
+            'read_kbytes_per_sec': '100.00',
+            'write_kbytes_per_sec': '100.00',
+            'avgrq_sz': '20.00',
+            'avgqu_sz': '0.50',
+            'svctm': '10.00',
+            'r_await': '4.00',
+            'w_await': '12.00',
+            'await': '8.00',
+            'util': '20.00',
+            'ios_in_progress': '2',
+        }
+        for name, value in expected.iteritems():
+            self.assertEqual(value, second[('iostat.disk.' + name, 'dev=sda')], name)
+        self.assertFalse(('iostat.part.util', 'dev=sda1') in second)
+        self.assertEqual(['sda', 'sda1'],
+                         sorted(key[2] for key in collector.devices.index))
+
+    def test_utilIsCapped(self):
+        collector = iostat.Iostat(None, None, tcollector.ReaderQueue(10000))
+        self.collect(collector, 1000, 100.0,
+                     " 259       0 nvme0n1 1 0 0 0 0 0 0 0 0 0 0\n")
+        # busy for longer than the interval, across its queues
+        stats = self.collect(collector, 1010, 110.0,
+                             " 259       0 nvme0n1 2 0 0 0 0 0 0 0 0 15000 0\n")
+        self.assertEqual('100.00', stats[('iostat.disk.util', 'dev=nvme0n1')])
+
+    def test_deviceTable(self):
+        table = iostat.DeviceTable()
+        self.assertEqual(0, table.lookup(8, 0, 'sda'))
+        self.assertEqual(1, table.lookup(8, 1, 'sda1'))
+        self.assertEqual(2, table.lookup(259, 0, 'nvme0n1'))
+        self.assertEqual(0, table.lookup(8, 0, 'sda'))
+        self.assertEqual([iostat.DISK, iostat.PART, iostat.DISK], table.kinds)
+        self.assertTrue(all(len(column) == 3 for column in table.columns))
+        table.columns[0][2] = 42
+        table.seen[2] = 1
+        # sda1 went away
+        table.forget(set([(8, 0, 'sda'), (259, 0, 'nvme0n1')]))
+        self.assertEqual({(8, 0, 'sda'): 0, (259, 0, 'nvme0n1'): 1}, table.index)
+        self.assertEqual([iostat.DISK, iostat.DISK], table.kinds)
+        self.assertEqual(42, table.columns[0][1])
+        self.assertEqual(1, table.seen[1])
+        self.assertTrue(all(len(column) == 2 for column in table.columns))
+        self.assertEqual(2, table.lookup(8, 1, 'sda1'))
+
+    def test_classify(self):
+        self.assertEqual(iostat.DISK, iostat.classify(8, 0, 'sda'))
+        self.assertEqual(iostat.PART, iostat.classify(8, 1, 'sda1'))
+        # the minors of NVMe namespaces don't come by 16
+        self.assertEqual(iostat.DISK, iostat.classify(259, 3, 'nvme0n1'))
+        self.assertEqual(iostat.PART, iostat.classify(259, 0, 'nvme0n1p1'))
+        self.assertEqual(iostat.DISK, iostat.classify(104, 0, 'cciss/c0d0'))
+        # without sysfs, by the minor
+        iostat.SYS_BLOCK = os.path.join(self.sys_block, 'nonexistent')
+        self.assertEqual(iostat.DISK, iostat.classify(8, 16, 'sdb'))
+        self.assertEqual(iostat.PART, iostat.classify(8, 17, 'sdb1'))
+
+
+class SockDiagTests(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.client = socket.create_connection(self.listener.getsockname())
+        self.server, _ = self.listener.accept()
+
+    def tearDown(self):
+        for sock in (self.client, self.server, self.listener):
+            sock.close()
+
+    def test_dump(self):
+        diag = SockDiag()
+        port = self.listener.getsockname()[1]
+        try:
+            sockets = list(diag.dump(socket.AF_INET))
+        finally:
+            diag.close()
+        listening = [(state, src, uid) for state, sport, _, src, _, uid in sockets
+                     if sport == port and state == 10]
+        self.assertEqual([(10, socket.inet_aton('127.0.0.1'), os.getuid())],
+                         listening)
+        self.assertEqual(2, len([sock for sock in sockets if sock[0] == 1 and
+                                 port in sock[1:3]]))
+
+    def test_onlyTheStatesAskedFor(self):
+        diag = SockDiag()
+        try:
+            states = set(sock[0] for sock in diag.dump(socket.AF_INET, (10,)))
+            # the socket is still good for another dump
+            self.assertTrue(list(diag.dump(socket.AF_INET6)) is not None)
+        finally:
+            diag.close()
+        self.assertEqual(set([10]), states)
+
+
+class SpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def mkSpool(self, max_bytes=1024 * 1024, segment_bytes=1024):
+        return Spool(self.dir, max_bytes, tcollector.LOG, segment_bytes)
+
+    def test_replayInTimestampOrder(self):
+        spool = self.mkSpool()
+        spool.append(['foo 1500000002 1', 'foo 1500000000 1'])
+        spool.append(['foo 1500000001 1'])
+        self.assertEqual(['foo 1500000000 1', 'foo 1500000001 1'],
+                         spool.peek(2))
+        spool.consume(2)
+        self.assertEqual(['foo 1500000002 1'], spool.peek(10))
+        spool.consume(1)
+        self.assertTrue(spool.is_empty())
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_peekWithoutConsume(self):
+        spool = self.mkSpool()
+        spool.append(['foo 1500000000 1'])
+        self.assertEqual(['foo 1500000000 1'], spool.peek(10))
+        self.assertEqual(['foo 1500000000 1'], spool.peek(10))
+
+    def test_reopen(self):
+        spool = self.mkSpool()
+        spool.append(['foo 1500000000 1'])
+        spool.close()
+        self.assertEqual(['foo 1500000000 1'], self.mkSpool().peek(10))
+
+    def test_dropOldestSegments(self):
+        spool = self.mkSpool(max_bytes=300, segment_bytes=100)
+        for i in xrange(10):
+            spool.append(['foo %d %s' % (1500000000 + i, 'x' * 50)])
+        self.assertTrue(spool.size() <= 300)
+        # 75 bytes records, one per segment: the last 4 fit
+        self.assertEqual('foo 1500000006', spool.peek(1)[0][:14])
+
+    def test_corruptedRecord(self):
+        spool = self.mkSpool()
+        spool.append(['foo 1500000000 1'])
+        spool.append(['foo 1500000001 1'])
+        spool.close()
+        path = os.path.join(self.dir, os.listdir(self.dir)[0])
+        data = open(path).read()
+        open(path, 'w').write(data[:-1] + 'X')
+        self.assertEqual(['foo 1500000000 1'], self.mkSpool().peek(10))
+
+
+class BatcherTests(unittest.TestCase):
+
+    def queue(self, lines):
+        q = Queue()
+        for line in lines:
+            q.put(line)
+        return q
+
+    def test_flushOnPoints(self):
+        batcher = Batcher(1000000, 3, 10000)
+        q = self.queue(["a", "b", "c", "d"])
+        batch = []
+        self.assertEqual("points", batcher.fill(q, batch, 1))
+        self.assertEqual(["a", "b", "c"], batch)
+        self.assertEqual(1, q.qsize())
+
+    def test_flushOnBytes(self):
+        batcher = Batcher(5, 1000, 10000)
+        batch = ["xxxx"]
+        self.assertEqual("bytes", batcher.fill(self.queue(["yy", "z"]), batch, 1))
+        self.assertEqual(["xxxx", "yy"], batch)
+
+    def test_flushOnLinger(self):
+        batcher = Batcher(1000000, 1000, 50)
+        batch = []
+        self.assertEqual("linger", batcher.fill(self.queue(["a"]), batch, 1))
+        self.assertEqual(["a"], batch)
+        self.assertEqual(None, batcher.fill(Queue(), [], 0.01))
+        self.assertEqual(1, batcher.batch_points.count)
+        self.assertTrue(batcher.batch_linger_ms.sum >= 50)
+        self.assertTrue(("sender.batch_linger_ms.count", (), 1)
+                        in batcher.metrics("sender"))
+
+    def test_bulkQueue(self):
+        q = BulkQueue(5)
+        self.assertEqual(3, q.put_many(["a", "b", "c"]))
+        self.assertEqual(2, q.put_many(["d", "e", "f"]))
+        self.assertEqual(0, q.put_many(["g"]))
+        self.assertEqual(["a", "b"], q.get_many(2))
+        self.assertEqual(["c", "d", "e"], q.get_many(10))
+        self.assertEqual([], q.get_many(10))
+
+    def test_bulkDrainKeepsLimits(self):
+        q = BulkQueue()
+        q.put_many(["xx"] * 100)
+        batch = []
+        self.assertEqual("points", Batcher(1000000, 30, 10000).fill(q, batch, 1))
+        self.assertEqual(30, len(batch))
+        batch = []
+        self.assertEqual("bytes", Batcher(21, 1000, 10000).fill(q, batch, 1))
+        self.assertEqual(11, len(batch))
+        self.assertEqual(59, q.qsize())
+
+    def check_queue_wait(self, q, put):
+        batcher = Batcher(1000000, 1, 10000)
+        put("a")
+        time.sleep(0.1)
+        put("b")
+        self.assertEqual("points", batcher.fill(q, [], 1))
+        self.assertEqual("points", batcher.fill(q, [], 1))
+        # the first point waited in the queue, the second one barely did
+        self.assertEqual(2, batcher.queue_wait_ms.count)
+        self.assertTrue(batcher.queue_wait_ms.sum >= 100)
+        self.assertEqual(1, batcher.queue_wait_ms.counts[0])
+        self.assertTrue(("sender.queue_wait_ms.count", (), 2)
+                        in batcher.metrics("sender"))
+
+    def test_queueWait(self):
+        q = BulkQueue()
+        self.check_queue_wait(q, q.put)
+        q = PressureQueue(0)
+        self.check_queue_wait(q, q.nput)
+
+    def test_histogram(self):
+        histogram = Histogram((1, 10))
+        for value in (0, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual([(1, 2), (10, 3), ("inf", 4)], histogram.buckets())
+        self.assertEqual(10, histogram.percentile(75))
+        self.assertEqual(("h.bucket", ("le=inf",), 4), histogram.metrics("h")[2])
+
+
+class CollectorBaseTests(unittest.TestCase):
+
+    def test_collectorTimestamp(self):
+        collector = CollectorBase(None, None, None)
+        self.assertTrue(abs(collector.timestamp() - time.time()) <= 1)
+        collector.set_tick(1500000030.2)
+        self.assertEqual(1500000030, collector.timestamp())
+
+    def test_collectorBatch(self):
+        q = tcollector.ReaderQueue(10)
+        collector = CollectorBase(None, None, q)
+        try:
+            with collector.batch():
+                collector._readq.nput("a")
+                self.assertEqual(0, q.qsize())
+                collector._readq.nput("b")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue(collector._readq is q)
+        self.assertEqual(["a", "b"], q.get_many(10))
+
+    def test_emitCounters(self):
+        config = ConfigParser.RawConfigParser()
+        config.add_section('base')
+        config.set('base', 'rates', 'true')
+        config.set('base', 'skip_unchanged', 'true')
+        q = tcollector.ReaderQueue(10)
+        collector = CollectorBase(config, None, q)
+        collector.emit_counters(1000, [("foo", "10", "a=b"), ("bar", "3", "")])
+        self.assertEqual(["foo 1000 10 a=b", "bar 1000 3"], q.get_many(10))
+        collector.emit_counters(1010, [("foo", "30", "a=b"), ("bar", "3", "")])
+        self.assertEqual(["foo 1010 30 a=b", "foo.rate 1010 2.000 a=b",
+                          "bar.rate 1010 0.000"], q.get_many(10))
+
+
+class RateEngineTests(unittest.TestCase):
+
+    def test_deltasAndRates(self):
+        engine = RateEngine()
+        self.assertEqual([(None, None, True), (None, None, True)],
+                         engine.update(100, ["a", "b"], ["5", 7]))
+        self.assertEqual([(10, 1, True), (0, 0, True)],
+                         engine.update(110, ["a", "b"], [15, 7]))
+        # a new series doesn't disturb the others
+        self.assertEqual([(None, None, True), (5, 0.5, True)],
+                         engine.update(120, ["c", "a"], [1, 20]))
+        self.assertEqual(3, len(engine))
+
+    def test_wrapAndReset(self):
+        engine = RateEngine()
+        engine.update(0, ["32", "64", "reset"], [2 ** 32 - 10, 2 ** 40, 1000])
+        self.assertEqual([(15, 1.5, True), (None, None, True), (None, None, True)],
+                         engine.update(10, ["32", "64", "reset"], [5, 3, 10]))
+        self.assertEqual((5, 0.5, True), engine.update(20, ["reset"], [15])[0])
+
+    def test_resend(self):
+        engine = RateEngine()
+        sends = [engine.update(ts, ["a"], [1], resend=30)[0][2]
+                 for ts in xrange(0, 70, 10)]
+        self.assertEqual([True, False, False, True, False, False, True], sends)
+
+    def test_expire(self):
+        engine = RateEngine()
+        engine.update(0, ["old", "new"], [1, 1])
+        engine.update(rates.EXPIRE_AGE, ["new"], [2])
+        self.assertEqual(2, len(engine))
+        engine.update(2 * rates.EXPIRE_AGE, ["new"], [3])
+        self.assertEqual(1, len(engine))
+        self.assertEqual([(1, 1, True)], engine.update(2 * rates.EXPIRE_AGE + 1,
+                                                       ["new"], [4]))
+
+
+class PutEncoderTests(unittest.TestCase):
+
+    def test_encodeLines(self):
+        encoder = PutEncoder({"host": "foo", "dc": "x"}, 8)
+        payload = json.loads(encoder.encode_lines(
+            ["foo.bar 1500000000 42 a=b dc=y", "bad line", "foo.baz 1500000000 0.5"],
+            '{"token":"t","metrics":[', ']}'))
+        self.assertEqual("t", payload["token"])
+        self.assertEqual([{"metric": "foo.bar", "timestamp": 1500000000,
+                           "value": 42, "tags": {"host": "foo", "a": "b", "dc": "y"}},
+                          {"metric": "foo.baz", "timestamp": 1500000000,
+                           "value": 0.5, "tags": {"host": "foo", "dc": "x"}}],
+                         payload["metrics"])
+        self.assertEqual(1, encoder.invalid)
+        self.assertEqual("[]", encoder.encode_lines([]))
+
+    def test_encodeDatapoints(self):
+        encoder = PutEncoder({"host": "foo"}, 2)
+        metrics = json.loads(encoder.encode_datapoints(
+            [parse_line('foo 1500000000 nan a=b c=d')]))
+        self.assertEqual({"host": "foo", "a": "b"}, metrics[0]["tags"])
+        self.assertTrue(metrics[0]["value"] != metrics[0]["value"])
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def test_collect(self):
+        stats = MetricsRegistry('t.')
+        stats.counter('sent', tsd='a', port=1).inc(3)
+        stats.counter('sent', port=1, tsd='a').inc()
+        stats.timer('latency').observe(5)
+        stats.timer('latency').observe(2)
+        stats.add_source(lambda: [('queue', ('q=r',), 7)])
+        self.assertEqual([('t.latency.count', (), 2),
+                          ('t.latency.total_ms', (), 7.0),
+                          ('t.latency.max_ms', (), 5.0),
+                          ('t.sent', ('port=1', 'tsd=a'), 4),
+                          ('t.queue', ('q=r',), 7)], stats.collect())
+        # the max of timers restarts from scratch on every report
+        self.assertEqual(0.0, dict((m, v) for m, _, v in stats.collect())
+                         ['t.latency.max_ms'])
+
+    def test_highWaterMark(self):
+        stats = MetricsRegistry()
+        mark = stats.high_water_mark('depth')
+        for depth in (3, 10, 4):
+            mark.observe(depth)
+        self.assertEqual([('depth', (), 10)], stats.collect())
+        self.assertEqual([('depth', (), 0)], stats.collect())
+
+    def test_readerQueueHighWater(self):
+        queue = tcollector.ReaderQueue(10)
+        for i in range(4):
+            queue.nput(i)
+        queue.get()
+        self.assertEqual(4, queue.report_high_water())
+        self.assertEqual(3, queue.report_high_water())
+
+
+class SchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = MetricsRegistry()
+        self.scheduler = Scheduler(2, stats=self.stats)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_runsEveryInterval(self):
+        calls = []
+        job = self.scheduler.add('fast', lambda: calls.append(time.time()), 0.05)
+        self.wait_for(lambda: len(calls) >= 4)
+        self.scheduler.remove(job)
+        self.assertTrue(job.done.wait(1) or job.done.is_set())
+        count = len(calls)
+        time.sleep(0.15)
+        self.assertEqual(count, len(calls))
+        self.assertEqual(0, job.skips.value)
+
+    def test_skipsWhileRunning(self):
+        release = threading.Event()
+        calls = []
+        def slow():
+            calls.append(1)
+            release.wait(5)
+        job = self.scheduler.add('slow', slow, 0.05, timeout=5)
+        self.wait_for(lambda: job.skips.value >= 2)
+        self.assertEqual(1, len(calls))
+        release.set()
+        self.wait_for(lambda: len(calls) >= 2)
+        self.assertTrue(job.overruns.value >= 1)
+
+    def test_alignedTicks(self):
+        scheduler = Scheduler(1, align=True, offset=7)
+        self.assertEqual(1027, scheduler.first_run(30, 1000))
+        self.assertEqual(1057, scheduler.first_run(30, 1028))
+        self.assertEqual(1027, scheduler.first_run(30, 1027))
+        self.assertEqual(1000, Scheduler(1).first_run(30, 1000))
+
+    def test_jobTick(self):
+        ticks = []
+        job = self.scheduler.add('tick', lambda: ticks.append(job.tick), 0.05)
+        self.wait_for(lambda: len(ticks) >= 3)
+        self.assertAlmostEqual(0.05, ticks[2] - ticks[1], 6)
+
+    def test_timeoutReplacesWorker(self):
+        release = threading.Event()
+        cleaned = []
+        stuck = [self.scheduler.add('stuck%d' % i, lambda: release.wait(5), 60,
+                                    timeout=0.1, cleanup=lambda: cleaned.append(1))
+                 for i in range(2)]
+        calls = []
+        self.scheduler.add('other', lambda: calls.append(1), 0.05)
+        # both workers are stuck, until they get replaced after the timeout
+        self.wait_for(lambda: len(calls) >= 2)
+        self.assertEqual([1, 1], [job.timeouts.value for job in stuck])
+        self.assertEqual(4, self.scheduler.threads)
+        for job in stuck:
+            self.scheduler.remove(job)
+        self.assertEqual([], cleaned)
+        release.set()
+        self.wait_for(lambda: len(cleaned) == 2)
+        self.wait_for(lambda: self.scheduler.threads == 2)
+
+    def test_cpuBudgetSkips(self):
+        calls = []
+        def spin():
+            calls.append(time.time())
+            # on CPU time, the other threads may hold the GIL meanwhile
+            end = scheduler.thread_cpu_time() + 0.03
+            while scheduler.thread_cpu_time() < end:
+                pass
+        job = self.scheduler.add('spin', spin, 0.05, budget=0.01)
+        self.wait_for(lambda: len(calls) >= 2)
+        self.assertTrue(job.budget_overruns.value >= 1)
+        self.assertTrue(job.skips.value >= 1)
+        self.assertTrue(job.cpu.total >= 20)
+        # the run after an overrun skipped two intervals at least
+        self.assertTrue(calls[1] - calls[0] >= 0.1)
+        self.assertEqual(0, scheduler.budget_skips(0.5, 1))
+        self.assertEqual(3, scheduler.budget_skips(3.5, 1))
+        self.assertEqual(scheduler.MAX_BUDGET_SKIPS,
+                         scheduler.budget_skips(100, 1))
+        self.assertEqual(0, scheduler.budget_skips(100, 0))
+
+    def test_otherCpuCounts(self):
+        job = self.scheduler.add('child', lambda: 2.0, 60, budget=1)
+        self.wait_for(lambda: job.budget_overruns.value == 1)
+        self.assertEqual(2, job.skip)
+        self.assertTrue(job.cpu.total >= 2000)
+
+    def test_timeoutInterrupts(self):
+        release = threading.Event()
+        job = self.scheduler.add('stuck', lambda: release.wait(5), 60,
+                                 timeout=0.1, interrupt=release.set)
+        self.wait_for(lambda: job.timeouts.value == 1)
+        self.wait_for(lambda: job.started is None)
+
+    def test_running(self):
+        release = threading.Event()
+        idents = []
+        def stuck():
+            idents.append(threading.current_thread().ident)
+            release.wait(5)
+        job = self.scheduler.add('stuck', stuck, 60)
+        self.wait_for(lambda: idents)
+        self.assertEqual({idents[0]: 'stuck'}, self.scheduler.running())
+        release.set()
+        self.wait_for(lambda: job.started is None)
+        self.assertEqual({}, self.scheduler.running())
+
+
+class StackSamplerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.release = threading.Event()
+        self.busy = threading.Thread(target=self.release.wait, args=(5,),
+                                     name='busy')
+        self.busy.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.busy.join()
+        shutil.rmtree(self.tmpdir)
+
+    def test_collapsedStacks(self):
+        path = os.path.join(self.tmpdir, 'stacks')
+        sampler = StackSampler(path, 0.1, 0.01,
+                               lambda: {self.busy.ident: 'spin'})
+        sampler.run()
+        stacks = [line.rsplit(' ', 1) for line in open(path)]
+        busy = [(stack, int(count)) for stack, count in stacks
+                if stack.startswith('collector:spin;busy;')]
+        # one sample of every thread every time, busiest stack first
+        self.assertEqual(sampler.samples, sum(count for _, count in busy))
+        self.assertTrue(busy[0][0].endswith(';wait (threading.py:%d)'
+                                         % threading._Condition.wait.im_func.func_code.co_firstlineno))
+        self.assertTrue(sampler.samples >= 5)
+        # not the thread sampling, which is ours here
+        self.assertFalse(any(stack.startswith('MainThread;') for stack, _ in stacks))
+
+    def test_oneAtATime(self):
+        profiler = Profiler('test', self.tmpdir, 0.1)
+        path = profiler.start()
+        self.assertTrue(path.startswith(os.path.join(self.tmpdir, 'test-%d-' % os.getpid())))
+        self.assertEqual(None, profiler.start())
+        profiler.sampler.join()
+        self.assertTrue(os.path.exists(path))
+
+
+class PressureQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def mkQueue(self, maxsize, spool=False, **kwargs):
+        if spool:
+            spool = Spool(self.dir, 1024 * 1024, tcollector.LOG)
+        else:
+            spool = None
+        return PressureQueue(maxsize, spool, logger=tcollector.LOG,
+                             stats=MetricsRegistry(), **kwargs)
+
+    def test_healthFirst(self):
+        q = self.mkQueue(10)
+        readq = CollectorQueue(q, 'foo')
+        readq.nput_many(['foo.bar 1500000000 1', 'foo.state 1500000000 0'])
+        q.nput('collector.batchCount 1500000000 3')
+        self.assertEqual(['foo.state 1500000000 0',
+                          'collector.batchCount 1500000000 3',
+                          'foo.bar 1500000000 1'], q.get_many(10))
+
+    def test_healthEvictsBulk(self):
+        q = self.mkQueue(2)
+        readq = CollectorQueue(q, 'foo')
+        self.assertTrue(readq.nput_many(['foo.bar 1500000000 1',
+                                         'foo.bar 1500000001 1']))
+        self.assertFalse(readq.nput('foo.bar 1500000002 1'))
+        readq.nput('foo.state 1500000002 0')
+        self.assertEqual(['foo.state 1500000002 0', 'foo.bar 1500000001 1'],
+                         q.get_many(10))
+        self.assertEqual(2, q.dropped.value)
+
+    def test_quota(self):
+        q = self.mkQueue(10, quota=2)
+        foo = CollectorQueue(q, 'foo')
+        bar = CollectorQueue(q, 'bar', 3)
+        self.assertFalse(foo.nput_many(['foo %d 1' % i for i in xrange(5)]))
+        self.assertFalse(bar.nput_many(['bar %d 1' % i for i in xrange(5)]))
+        self.assertEqual(5, q.qsize())
+        self.assertEqual(['foo 0 1', 'foo 1 1'], q.get_many(2))
+        # foo has room again
+        self.assertTrue(foo.nput('foo 5 1'))
+
+    def test_downsampleUnderPressure(self):
+        q = self.mkQueue(20, lossy_interval=60)
+        readq = CollectorQueue(q, 'foo')
+        readq.nput_many(['foo %d 1 a=b' % (1500000000 + i) for i in xrange(16)])
+        self.assertTrue(q.lossy)
+        readq.nput_many(['foo %d 1 a=b' % (1500000020 + i * 30)
+                         for i in xrange(4)] + ['bar 1500000020 1'])
+        # one point of foo a minute, and the first of bar
+        self.assertEqual(['foo 1500000020 1 a=b', 'foo 1500000080 1 a=b',
+                          'bar 1500000020 1'], q.get_many(20)[16:])
+        self.assertEqual(2, q.downsampled.value)
+        readq.nput('foo 1500000100 1 a=b')
+        self.assertFalse(q.lossy)
+
+    def test_spillAndRefill(self):
+        q = self.mkQueue(4, spool=True)
+        readq = CollectorQueue(q, 'foo')
+        lines = ['foo %d 1' % (1500000000 + i) for i in xrange(10)]
+        self.assertFalse(readq.nput_many(lines))
+        self.assertEqual(lines[:4], q.get_many(4))
+        # at most half of the queue is refilled at once
+        self.assertEqual(2, q.refill())
+        self.assertEqual(lines[4:6], q.get_many(10))
+        self.assertEqual(2, q.refill())
+        self.assertEqual(0, q.refill())
+        self.assertEqual(lines[6:8], q.get_many(10))
+        self.assertEqual(2, q.refill())
+        self.assertEqual(lines[8:10], q.get_many(10))
+        self.assertEqual(0, q.refill())
+        self.assertEqual(0, q.dropped.value)
+
+    def test_requeueAndClose(self):
+        q = self.mkQueue(4, spool=True)
+        q.nput('foo 1500000001 1')
+        q.requeue(['foo 1500000000 1'])
+        self.assertEqual(['foo 1500000001 1', 'foo 1500000000 1'],
+                         q.get_many(10))
+        q.requeue(['foo 1500000000 1'])
+        q.nput('foo 1500000001 1')
+        q.close()
+        self.assertEqual(0, q.qsize())
+        spool = Spool(self.dir, 1024 * 1024, tcollector.LOG)
+        self.assertEqual(['foo 1500000000 1', 'foo 1500000001 1'],
+                         spool.peek(10))
+
+
+class CollectorStartupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stats = runner.STATS
+        runner.STATS = MetricsRegistry('collector.')
+        runner.SCHEDULER = Scheduler(2, tcollector.LOG, runner.STATS)
+        runner.SCHEDULER.start()
+
+    def tearDown(self):
+        runner.SCHEDULER.shutdown()
+        runner.SCHEDULER = None
+        runner.STATS = self.stats
+        shutil.rmtree(self.dir)
+
+    def test_moduleCache(self):
+        path = os.path.join(self.dir, 'startup_test_collector.py')
+        with open(path, 'w') as f:
+            f.write('class StartupTestCollector(object):\n    pass\n')
+        cls = runner.load_collector_module('startup_test_collector', self.dir)
+        self.assertTrue(cls is runner.load_collector_module(
+            'startup_test_collector', self.dir))
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        self.assertFalse(cls is runner.load_collector_module(
+            'startup_test_collector', self.dir))
+
+    def test_startInBackground(self):
+        started = threading.Event()
+        collected = []
+
+        class Collector(CollectorBase):
+            def __call__(self):
+                collected.append(self._tick)
+
+        def factory():
+            started.wait(5)
+            return Collector(None, None, None), 1.0, 2.0
+
+        collector = runner.CollectorExec('startup', factory, 1)
+        time.sleep(0.1)
+        # the collection waits for the collector to be built
+        self.assertEqual([], collected)
+        started.set()
+        for _ in xrange(50):
+            if collected:
+                break
+            time.sleep(0.1)
+        self.assertEqual(1, len(collected))
+        collector.shutdown()
+        metrics = dict(((metric, tags), value) for metric, tags, value
+                       in runner.STATS.collect())
+        self.assertEqual(2.0, metrics[('collector.startup.construct_ms',
+                                       ('collector=startup',))])
+        self.assertTrue(('collector.startup.first_collection_ms',
+                         ('collector=startup',)) in metrics)
+
+
+    def test_firstCollectionHasTick(self):
+        collected = []
+
+        class Collector(CollectorBase):
+            def __call__(self):
+                collected.append(self._tick)
+
+        add = runner.SCHEDULER.add
+        def slow_add(*args):
+            # the first collection is dispatched before add() returns,
+            # and there isn't another one before long
+            job = add(*args)
+            time.sleep(0.2)
+            return job
+        runner.SCHEDULER.add = slow_add
+        collector = runner.CollectorExec(
+            'first', lambda: (Collector(None, None, None), 0, 0), 60)
+        for _ in xrange(50):
+            if collected:
+                break
+            time.sleep(0.1)
+        collector.shutdown()
+        self.assertEqual(1, len(collected))
+        self.assertTrue(collected[0] is not None)
+
+class PidCollector(object):
+    """Sends its pid, then many lines, or fails, as its config tells."""
+
+    def __init__(self, config, logger, readq):
+        self.config = config
+        self.logger = logger
+        self.readq = readq
+
+    def __call__(self):
+        if self.config.get('log'):
+            self.logger.warning('collecting in process %d', os.getpid())
+        if self.config.get('fail'):
+            raise ValueError('failing as told')
+        time.sleep(self.config.get('sleep', 0))
+        self.readq.nput('pid %d' % os.getpid())
+        for i in xrange(self.config.get('lines', 0)):
+            self.readq.nput('line %d' % i)
+
+    def signal_exit(self):
+        pass
+
+    def cleanup(self):
+        open(self.config['cleaned'], 'w').close()
+
+
+class ProcessCollectorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cleaned = os.path.join(self.tmpdir, 'cleaned')
+        self.readq = tcollector.ReaderQueue(10000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def drain(self):
+        lines = []
+        while not self.readq.empty():
+            lines.append(self.readq.get())
+        return lines
+
+    def test_collectInChild(self):
+        collector = ProcessCollector('pid', PidCollector,
+                                     {'lines': 2500, 'cleaned': self.cleaned},
+                                     None, self.readq)
+        collector()
+        lines = self.drain()
+        self.assertEqual(2501, len(lines))
+        pid = int(lines[0].split()[1])
+        self.assertNotEqual(os.getpid(), pid)
+        self.assertEqual('line 2499', lines[-1])
+        # a dead child is replaced on the next collection
+        os.kill(pid, signal.SIGKILL)
+        collector.process.join()
+        collector()
+        self.assertNotEqual(pid, int(self.drain()[0].split()[1]))
+        collector.signal_exit()
+        collector.cleanup()
+        self.assertTrue(os.path.exists(self.cleaned))
+        self.assertEqual(None, collector.process)
+
+    def test_failureInChild(self):
+        errors = []
+        logger = logging.getLogger('ProcessCollectorTests')
+        logger.propagate = False
+        handler = logging.Handler()
+        handler.emit = lambda record: errors.append(record.getMessage())
+        logger.addHandler(handler)
+        collector = ProcessCollector('fail', PidCollector,
+                                     {'fail': True, 'cleaned': self.cleaned},
+                                     logger, self.readq)
+        collector()
+        self.assertEqual([], self.drain())
+        self.assertTrue('failing as told' in errors[-1])
+        self.assertTrue(collector.process.is_alive())
+        collector.cleanup()
+
+    def test_loggingLockHeldAtFork(self):
+        logger = logging.getLogger('ProcessCollectorTests.fork')
+        logger.propagate = False
+        handler = logging.Handler()
+        handler.emit = lambda record: None
+        logger.addHandler(handler)
+        held = threading.Event()
+        def hold_lock():
+            # another thread of the runner logging while we fork
+            with handler.lock:
+                held.set()
+                time.sleep(0.5)
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        held.wait()
+        collector = ProcessCollector('log', PidCollector,
+                                     {'log': True, 'cleaned': self.cleaned},
+                                     logger, self.readq)
+        thread.join()
+        thread = threading.Thread(target=collector)
+        thread.start()
+        thread.join(5)
+        if thread.is_alive():
+            collector.interrupt()
+            thread.join()
+        self.assertEqual(1, len(self.drain()))
+        collector.cleanup()
+        logger.removeHandler(handler)
+
+    def test_interruptChild(self):
+        collector = ProcessCollector('stuck', PidCollector,
+                                     {'sleep': 10, 'cleaned': self.cleaned},
+                                     None, self.readq)
+        thread = threading.Thread(target=collector)
+        thread.start()
+        time.sleep(0.5)
+        collector.interrupt()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(None, collector.child_cpu)
+        # restarted on the next collection, which reports its CPU time
+        collector.config = {'cleaned': self.cleaned}
+        collector()
+        self.assertEqual(1, len(self.drain()))
+        self.assertTrue(isinstance(collector.child_cpu, float))
+        collector.cleanup()
+
+
+class PutHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        self.server.connections += 1
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.server.bodies.append(body)
+        if self.path == "/slow":
+            time.sleep(1)
+        self.send_response(400 if self.path == "/bad" else 204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        if self.path == "/close":
+            # hang up without telling the client, like an idle timeout
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class PutServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class HTTPConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PutServer(("127.0.0.1", 0), PutHandler)
+        self.server.connections = 0
+        self.server.bodies = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.port = self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keepAlive(self):
+        pool = HTTPConnectionPool(compression="gzip")
+        pool.post("127.0.0.1", self.port, "/api/put", "[1]")
+        pool.post("127.0.0.1", self.port, "/api/put", "[2]")
+        self.assertEqual(["[1]", "[2]"], self.server.bodies)
+        self.assertEqual(1, pool.connections_opened)
+        pool.close()
+
+    def test_errors(self):
+        pool = HTTPConnectionPool()
+        self.assertRaises(urllib2.HTTPError, pool.post, "127.0.0.1",
+                          self.port, "/bad", "[]")
+        pool.close()
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        closed_port = sock.getsockname()[1]
+        sock.close()
+        self.assertRaises(urllib2.URLError, pool.post, "127.0.0.1",
+                          closed_port, "/api/put", "[]")
+
+    def test_staleConnection(self):
+        pool = HTTPConnectionPool()
+        pool.post("127.0.0.1", self.port, "/close", "[1]")
+        time.sleep(0.1)
+        pool.post("127.0.0.1", self.port, "/api/put", "[2]")
+        self.assertEqual(["[1]", "[2]"], self.server.bodies)
+        self.assertEqual(2, pool.connections_opened)
+        pool.close()
+
+    def test_timeoutNotRetried(self):
+        pool = HTTPConnectionPool(timeout=0.2)
+        pool.post("127.0.0.1", self.port, "/api/put", "[1]")
+        self.assertRaises(urllib2.URLError, pool.post, "127.0.0.1",
+                          self.port, "/slow", "[2]")
+        time.sleep(1)
+        self.assertEqual(["[1]", "[2]"], self.server.bodies)
+        self.assertEqual(1, pool.connections_opened)
+        pool.close()
+
+
+class JSONHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers /<n> with {"path": n} after n tenths of a second."""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        try:
+            if self.path == "/missing":
+                body, status = "", 404
+            else:
+                time.sleep(int(self.path[1:]) / 10.0)
+                body, status = json.dumps({"path": int(self.path[1:])}), 200
+        finally:
+            with server.lock:
+                server.running -= 1
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class JSONServer(PutServer):
+
+    def handle_error(self, request, client_address):
+        pass  # the clients we time out hang up on us
+
+
+class StubEngine(object):
+    """Answers the requests of a collector without any HTTP."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.urls = []
+
+    def get_json(self, urls, headers=None, timeout=None, deadline=None):
+        self.urls.extend(urls)
+        return [self.responses(url) for url in urls]
+
+
+class SparkTests(unittest.TestCase):
+
+    def setUp(self):
+        self.get_engine = spark.get_engine
+
+    def tearDown(self):
+        spark.get_engine = self.get_engine
+
+    def test_appMetrics(self):
+        fields = dict((metric, 7) for metric in spark.JOB_METRICS +
+                      spark.STAGE_METRICS + spark.EXECUTOR_METRICS +
+                      spark.RDD_METRCIS)
+        fields.update(jobId=3, stageId=4, id=5)
+
+        def responses(url):
+            if url.endswith('/executors'):
+                return HTTPEngineError(url, 'HTTP status 500', 500)
+            return [fields]
+        engine = StubEngine(responses)
+        spark.get_engine = lambda: engine
+        readq = tcollector.ReaderQueue(1000)
+        collector = spark.Spark(None, None, readq)
+        collector._spark_app_metrics({'app-1': ('myapp', 'http://driver:4040/')})
+        self.assertEqual(['http://driver:4040/api/v1/applications/myapp/%s' % path
+                          for path in ('jobs', 'stages', 'executors', 'storage/rdd')],
+                         engine.urls)
+        lines = [line.split(' ', 2) for line in readq.get_many(1000)]
+        emitted = set((metric, rest) for metric, _, rest in lines)
+        self.assertTrue(('spark.job.numTasks', '7 host=localhost name=myapp id=3') in emitted)
+        self.assertTrue(('spark.stage.%s' % spark.STAGE_METRICS[0],
+                         '7 host=localhost name=myapp id=4') in emitted)
+        self.assertTrue(('spark.rdd.%s' % spark.RDD_METRCIS[0],
+                         '7 host=localhost name=myapp id=5') in emitted)
+        for kind in ('job', 'stage', 'rdd'):
+            self.assertTrue(('spark.%s.count' % kind, '1 host=localhost') in emitted)
+        # the executors failed, and only them
+        self.assertFalse([metric for metric, _ in emitted
+                          if metric.startswith('spark.executor.')])
+        self.assertTrue(('spark.state', '1') in emitted)
+
+
+class HTTPEngineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = JSONServer(("127.0.0.1", 0), JSONHandler)
+        self.server.lock = threading.Lock()
+        self.server.running = 0
+        self.server.max_running = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+
+    def tearDown(self):
+        while self.server.running:
+            time.sleep(0.05)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrentBatch(self):
+        engine = HTTPEngine(workers=8, per_endpoint=3, timeout=5)
+        start = time.time()
+        results = engine.get_json([self.url + "2"] * 6 + [self.url + "missing"])
+        # two rounds of three concurrent requests
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual([{"path": 2}] * 6, results[:6])
+        self.assertTrue(isinstance(results[6], HTTPEngineError))
+        self.assertEqual(404, results[6].status)
+        self.assertEqual(3, self.server.max_running)
+
+    def test_timeouts(self):
+        engine = HTTPEngine(workers=2, timeout=0.2)
+        results = engine.get_json([self.url + "5", self.url + "0"])
+        self.assertTrue(isinstance(results[0], HTTPEngineError))
+        self.assertEqual({"path": 0}, results[1])
+        engine = HTTPEngine(workers=2, timeout=5)
+        results = engine.get_json([self.url + "5", self.url + "0"],
+                                  deadline=0.2)
+        self.assertTrue(isinstance(results[0], HTTPEngineError))
+        self.assertEqual({"path": 0}, results[1])
+
+
+class TSDConnectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sender = tcollector.SenderThread(None, False, [("tsd", 4242)],
+                                              False, {"host": "foo"},
+                                              connections=2)
+        self.peers = []
+        for i in xrange(2):
+            ours, theirs = socket.socketpair()
+            self.sender.conns.append(tcollector.TSDConnection("tsd%d" % i,
+                                                              4242, ours))
+            self.peers.append(theirs)
+
+    def tearDown(self):
+        for conn in self.sender.conns:
+            conn.close()
+        for peer in self.peers:
+            peer.close()
+
+    def received(self, peer):
+        peer.setblocking(0)
+        try:
+            return peer.recv(65536).splitlines()
+        except socket.error:
+            return []
+
+    def test_shardBySeries(self):
+        self.sender.sendq = [parse_line("foo.%d %d 1 i=%d"
+                                        % (i % 10, 1500000000 + t, i % 10))
+                             for t in xrange(10) for i in xrange(10)]
+        self.sender.send_data()
+        self.assertEqual([], self.sender.sendq)
+        lines = [self.received(peer) for peer in self.peers]
+        self.assertEqual(100, len(lines[0]) + len(lines[1]))
+        series = [set(line.split()[1] for line in l) for l in lines]
+        self.assertFalse(series[0] & series[1])
+        for l in lines:
+            # every series is sent in order
+            self.assertEqual(sorted(l, key=lambda line: int(line.split()[2])), l)
+            for line in l:
+                self.assertTrue(line.endswith(" host=foo"))
+
+    def test_fullConnection(self):
+        full, other = self.sender.conns
+        full.buffered = tcollector.TSD_MAX_BUFFERED_BYTES
+        self.sender.sendq = [parse_line("foo.%d 1500000000 1" % i)
+                             for i in xrange(20)]
+        self.sender.send_data()
+        # what would go through the full connection is held back
+        self.assertTrue(self.sender.sendq)
+        self.assertFalse(full.chunks)
+        held = set(dp.metric for dp in self.sender.sendq)
+        sent = set(line.split()[1] for line in self.received(self.peers[1]))
+        self.assertEqual(20, len(held) + len(sent))
+        self.assertFalse(held & sent)
+
+    def test_drainResponses(self):
+        conn = self.sender.conns[0]
+        self.assertTrue(conn.verify())
+        self.assertFalse(conn.verify())
+        self.peers[0].sendall("put: illegal argument: bad value\nnet.opentsdb")
+        conn.drain()
+        self.assertEqual(1, conn.put_errors)
+        self.assertTrue(conn.verify())
+
+    def test_dropConnection(self):
+        self.sender.sendq = [parse_line("foo %d 1" % (1500000000 + t))
+                             for t in xrange(5)]
+        conn = self.sender.conns[0]
+        conn.queue("put bar 1500000000 1\n", [parse_line("bar 1500000000 1")])
+        self.sender.drop_conn(conn, "test")
+        self.assertEqual(1, len(self.sender.conns))
+        self.assertEqual(6, len(self.sender.sendq))
+        self.assertEqual("bar", self.sender.sendq[0].metric)
+        self.assertTrue(("tsd0", 4242) in self.sender.blacklisted_hosts)
+
+
 class UDPCollectorTests(unittest.TestCase):
 
     def setUp(self):